@@ -1,26 +1,47 @@
 #!/usr/bin/env python3
 
-import platform, os, sys, colorama, ssl, glob, argparse, textwrap, time, shutil, subprocess, zipfile
+import os, sys, glob, argparse, textwrap, time, shutil, subprocess, zipfile, threading, concurrent.futures, struct, re, json, hashlib, hmac, tempfile, base64, mmap, zlib, contextlib, errno
 from pathlib import Path
 from signal import signal, SIGINT
-from urllib import request
-from lxml import etree
+try:
+    import resource
+except ImportError:
+    # not available on Windows, CPU time and peak RSS of the tools are not recorded
+    resource = None
 
-# enabling color for Windows CMD and PowerShell
-colorama.init()
-# bypass CERTIFICATE_VERIFY_FAILED error when downloading files
-ssl._create_default_https_context = ssl._create_unverified_context
+# colorama, lxml, ssl and urllib take the most of the startup time, they are imported only when they are needed
+colorama = None
 
 script_version = '1.0'
 prefix = Path(sys.argv[0]).resolve().name
 output_suffix = '-patched'
 output_ext = '.apk'
 decomp_dir_suffix = '-decompiled'
-global start_time
-global time_sum
-time_sum = 0
-global garbage
-garbage = {'files': [], 'dirs': []}
+decomp_stamp_name = 'apk-rebuild.json'
+source_exts = ['.apk', '.aab', '.xapk']
+# the install on the device is retried on the errors of adb (device offline, broken connection), the errors of the package manager are not retried
+install_attempts = 3
+install_retry_delay = 2
+# heap of apktool and bundletool: the base part and the parts for the bytes of .dex files, resource files and the bytes of the resource table of the input file
+jvm_heap_base = 256 * 1024 * 1024
+jvm_heap_min = 512 * 1024 * 1024
+jvm_heap_dex_ratio = 16
+jvm_heap_resource_size = 16 * 1024
+jvm_heap_table_ratio = 8
+# part of the available memory which the tools launched at the same time may take
+jvm_memory_share = 0.75
+# java exits with this code on OutOfMemoryError with -XX:+ExitOnOutOfMemoryError, the tool is restarted with the doubled heap
+jvm_oom_exit_code = 3
+jvm_oom_retries = 2
+# size of the decompiled files relative to the uncompressed size of the .apk file, smali files are ~3 times bigger than .dex files
+decompiled_size_ratio = 3
+android_ns = 'http://schemas.android.com/apk/res/android'
+# jobs which are processed now, temp files and directories of them are removed on CTRL-C
+active_jobs = []
+# stream for log messages and tools output, parallel workers set their own one
+log_stream = threading.local()
+# lock for printing the logs of parallel workers
+print_lock = threading.Lock()
 
 class colors:
     HEADER = '\033[95m'
@@ -40,7 +61,7 @@ class tools:
     home_path = str(Path.home())
 
     # path where apktool, bundletool and uder-apk-signer will be placed
-    platforn_name = platform.system()
+    platforn_name = {'darwin': 'Darwin', 'linux': 'Linux', 'win32': 'Windows'}.get(sys.platform)
     if platforn_name == 'Darwin':
         tools_dir = Path(home_path).joinpath('Library', 'Application Support', 'apk-rebuild').resolve()
     elif platforn_name == 'Linux':
@@ -54,19 +75,26 @@ class tools:
             'file_name': 'bundletool-all-',
             'version': '1.18.3',
             'url': 'https://github.com/google/bundletool/releases/download/',
-            'name': 'bundletool'
+            'name': 'bundletool',
+            'version_args': ['version'],
+            'jvm_flags': []
         },
         {
             'file_name': 'apktool_',
             'version': '2.12.1',
             'url': 'https://github.com/iBotPeaches/Apktool/releases/download/v',
-            'name': 'apktool'
+            'name': 'apktool',
+            'version_args': ['--version'],
+            'jvm_flags': []
         },
         {
             'file_name': 'uber-apk-signer-',
             'version': '1.2.1', # do not update to 1.2.2
             'url': 'https://github.com/patrickfav/uber-apk-signer/releases/download/v',
-            'name': 'uber-apk-signer'
+            'name': 'uber-apk-signer',
+            'version_args': ['--version'],
+            # short-living tool, C1 compiler only and serial GC start faster
+            'jvm_flags': ['-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC']
         }
     ]
 
@@ -75,6 +103,205 @@ class tools:
     apktool_path = Path(tools_dir).joinpath(tools_data[1]['file_name'] + tools_data[1]['version'] + '.jar').resolve()
     uber_apk_signer_path = Path(tools_dir).joinpath(tools_data[2]['file_name'] + tools_data[2]['version'] + '.jar').resolve()
 
+    # results of check_tools(): java version, jar files and checked keystores, the tools are not launched again while the files are not changed
+    preflight_path = Path(tools_dir).joinpath('preflight.json').resolve()
+
+    # cache of the rebuilded files, the size is limited by --cache-size argument
+    cache_dir = Path(tools_dir).joinpath('cache').resolve()
+
+    # java version, it's detected by check_tools()
+    java_version = ''
+    java_major_version = 0
+
+    # AppCDS (class data sharing) archives of the tools, dynamic archives are supported since java 13
+    cds_min_java_version = 13
+    cds_data_path = Path(tools_dir).joinpath('cds.json').resolve()
+    cds_data = None
+    cds_lock = threading.Lock()
+    cds_dumping = set()
+    # JVM startup time saved by the archives
+    cds_saved_time = 0
+
+    # device spec for '--device-spec' argument, it's read once from the file or the connected device by load_device_spec() when the first .aab file is processed
+    device_spec = None
+    device_spec_error = None
+    device_spec_lock = threading.Lock()
+
+
+# phases of the processing and launched tools, they are saved with '--trace' and '--metrics' arguments
+class trace:
+    start_time = time.perf_counter()
+    events = []
+    lock = threading.Lock()
+    # short thread numbers for the trace viewer
+    threads = {}
+
+
+
+# state of the service started with '--serve' argument
+class service:
+    jobs = {}
+    queue = None
+    # notified when the job is finished or its log is changed
+    condition = threading.Condition()
+    storage_path = None
+    workers = 0
+    start_time = 0
+    counters = {'done': 0, 'failed': 0, 'cancelled': 0}
+    # the last wall times of the phases of the finished jobs
+    phase_samples = {}
+    max_samples = 1000
+    # finished jobs are removed with their files when there are more of them
+    max_finished_jobs = 100
+    # options which can be set for the single job in the query string
+    job_options = {'no_decompile': True, 'no_src': '--no-src', 'only_main_classes': '--only-main-classes', 'only_pinning_dex': True, 'jar_signer': True, 'no_cache': True}
+
+
+
+# bytes reserved in the work directory by the running jobs, the jobs which don't fit wait until the running ones are finished
+class work_space:
+    condition = threading.Condition()
+    reserved = 0
+
+
+
+# devices for '--install' argument, every device has own single thread executor: the installs on the same device are sequential, the devices are processed in parallel
+class installer:
+    devices = []
+    executors = {}
+    futures = []
+    lock = threading.Lock()
+
+
+
+# heap reserved by the running tools, the heavy phases (decode, build, build-apks) wait until the heap fits the memory budget instead of swapping
+class jvm_memory:
+    condition = threading.Condition()
+    reserved = 0
+    # the budget is detected when the first tool is launched, None if the available memory is unknown
+    budget = None
+    budget_detected = False
+
+
+
+# types of the chunks of the compiled resources (binary XML and resources.arsc)
+class chunk_types:
+    STRING_POOL = 0x0001
+    TABLE = 0x0002
+    XML = 0x0003
+    XML_START_NAMESPACE = 0x0100
+    XML_END_NAMESPACE = 0x0101
+    XML_START_ELEMENT = 0x0102
+    XML_END_ELEMENT = 0x0103
+    XML_CDATA = 0x0104
+    XML_RESOURCE_MAP = 0x0180
+    TABLE_PACKAGE = 0x0200
+    TABLE_TYPE = 0x0201
+    TABLE_TYPE_SPEC = 0x0202
+
+
+
+# values and flags of the compiled resources
+class res_values:
+    NO_INDEX = 0xffffffff
+    TYPE_REFERENCE = 0x01
+    TYPE_STRING = 0x03
+    TYPE_INT_DEC = 0x10
+    TYPE_INT_BOOLEAN = 0x12
+    STRING_POOL_SORTED = 0x0001
+    STRING_POOL_UTF8 = 0x0100
+    TYPE_FLAG_SPARSE = 0x01
+    TYPE_FLAG_OFFSET16 = 0x02
+    ENTRY_FLAG_COMPLEX = 0x0001
+    ENTRY_FLAG_COMPACT = 0x0008
+    # android:networkSecurityConfig
+    ATTR_NETWORK_SECURITY_CONFIG = 0x01010527
+    # android:minSdkVersion
+    ATTR_MIN_SDK_VERSION = 0x0101020c
+
+
+
+# types of SSL pinning and custom certificate validation, only the .dex files which reference them are decompiled with '--only-pinning-dex' argument
+class pinning:
+    TYPES = [
+        'Lokhttp3/CertificatePinner;',
+        'Lcom/squareup/okhttp/CertificatePinner;',
+        'Ljavax/net/ssl/X509TrustManager;',
+        'Ljavax/net/ssl/X509ExtendedTrustManager;',
+        'Ljavax/net/ssl/TrustManagerFactory;',
+        'Ljavax/net/ssl/HostnameVerifier;',
+        'Landroid/net/http/X509TrustManagerExtensions;',
+        'Lorg/apache/http/conn/ssl/SSLSocketFactory;'
+    ]
+    # libraries which are referenced by the package, e.g. TrustKit
+    TYPE_PREFIXES = ['Lcom/datatheorem/android/trustkit/', 'Lio/appmattus/certificatetransparency/']
+    # hashes of the pinned public keys in the strings, e.g. 'sha256/AAAA...='
+    PIN_PATTERN = re.compile(rb'sha(?:256|1)/[A-Za-z0-9+/]{27,43}=')
+    DEX_NAME_PATTERN = re.compile(r'classes\d*\.dex')
+
+
+
+# constants of the built-in signer (JKS keystore, JAR signature and APK Signature Scheme v2/v3)
+class signing:
+    JKS_MAGIC = 0xfeedfeed
+    JCEKS_MAGIC = 0xcececece
+    JKS_PRIVATE_KEY_ENTRY = 1
+    JKS_TRUSTED_CERT_ENTRY = 2
+    OID_JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+    OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+    OID_SHA1 = '1.3.14.3.2.26'
+    OID_SHA256 = '2.16.840.1.101.3.4.2.1'
+    OID_PKCS7_DATA = '1.2.840.113549.1.7.1'
+    OID_PKCS7_SIGNED_DATA = '1.2.840.113549.1.7.2'
+    # digests of the MAC of PKCS12 keystore, the MAC key is derived from the password
+    PKCS12_MAC_HASHES = {'1.3.14.3.2.26': 'sha1', '2.16.840.1.101.3.4.2.1': 'sha256', '2.16.840.1.101.3.4.2.2': 'sha384', '2.16.840.1.101.3.4.2.3': 'sha512'}
+    PKCS12_MAC_KEY_ID = 3
+    # DER encoded DigestInfo without the digest for RSA PKCS#1 v1.5 signature
+    DIGEST_INFO_PREFIX = {'sha1': bytes.fromhex('3021300906052b0e03021a05000414'), 'sha256': bytes.fromhex('3031300d060960864801650304020105000420')}
+    # SHA-256 digests of JAR signature are supported since Android 4.3, SHA-1 is used for older versions
+    JAR_SHA256_MIN_SDK = 18
+    APK_SIG_BLOCK_MAGIC = b'APK Sig Block 42'
+    V2_BLOCK_ID = 0x7109871a
+    V3_BLOCK_ID = 0xf05368c0
+    V3_MIN_SDK = 28
+    V3_MAX_SDK = 0x7fffffff
+    RSA_PKCS1_V1_5_SHA256 = 0x0103
+    # v2 attribute which protects from removing v3 signature
+    STRIPPING_PROTECTION_ATTR_ID = 0xbeeff00d
+    CHUNK_SIZE = 1024 * 1024
+    # keystore checked by check_tools(), None if the keystore is supported by uber-apk-signer only
+    keystore = None
+    # keystore resolved by check_tools() ('--ks' argument or the debug keystore) for any signer, the cached results depend on it
+    resolved_keystore = None
+    # private key and certificates, they are loaded on the first signing
+    key = None
+    key_lock = threading.Lock()
+
+
+
+# raised when the processing can't be continued, temp files and directories are removed by main()
+class rebuild_error(Exception):
+    pass
+
+
+
+# raised when the .apk file can't be patched without decompiling, apktool is used instead
+class binary_patch_error(Exception):
+    pass
+
+
+
+# raised when the keystore or the .apk file is not supported by the built-in signer, uber-apk-signer is used instead
+class signer_error(Exception):
+    pass
+
+
+
+# raised when the tool runs out of the heap, it's launched again with the larger heap
+class jvm_memory_error(rebuild_error):
+    pass
+
+
 
 class source_file:
     directory_path = ''
@@ -91,52 +318,174 @@ class output_files:
 
 
 
+# state of the processing of the single source file, several jobs are processed at the same time in batch mode
+class job:
+    def __init__(self, arg_args, arg_source_file_path):
+        # arguments of the script, '--output' is set for every job in batch mode
+        self.args = arg_args
+        self.source_file = source_file()
+        self.output_files = output_files()
+        # temp files, directories and running tools
+        self.garbage = {'files': [], 'dirs': [], 'processes': []}
+        # processing time without pause
+        self.start_time = 0
+        self.time_sum = 0
+        self.pause_time = 0
+        # recorded phases and tools of the job
+        self.events = []
+        # list of the rebuilded .apk files for .xapk source file
+        self.new_apk_list = []
+        # temp directory of the job for the intermediate files and the space reserved in it
+        self.work_dir = None
+        self.work_space = 0
+        self.status = 'queued'
+        self.error = None
+        # id, submission time and log of the job submitted to the service ('--serve' argument)
+        self.service = None
+        # status, attempts and duration of the installs on the devices ('--install' argument)
+        self.installs = []
+        # .dex files of the decompiled .apk files and the pinning types they reference ('--only-pinning-dex' argument)
+        self.dex_index = {}
+
+        # get necessary data about the source file
+        self.source_file.ext = Path(arg_source_file_path).resolve().suffix
+        self.source_file.name_wo_ext = Path(arg_source_file_path).resolve().stem
+        self.source_file.directory_path = Path(arg_source_file_path).resolve().parent
+        self.source_file.full_path = Path(arg_source_file_path).resolve()
+        self.source_file.full_path_wo_ext = self.source_file.full_path.with_suffix('')
+
+
+
+def init_colors():
+    # enabling color for Windows CMD and PowerShell
+    global colorama
+    import colorama
+    colorama.init()
+
+
+
 def exit_script(arg_code):
-    colorama.deinit()
+    if colorama != None:
+        colorama.deinit()
     sys.exit(arg_code)
 
 
 
+def get_log_stream():
+    return getattr(log_stream, 'file', sys.stdout)
+
+
+
 def log_err(arg_msg):
-    print(f'{colors.FAIL}[ERROR] {arg_msg}{colors.ENDC}')
+    print(f'{colors.FAIL}[ERROR] {arg_msg}{colors.ENDC}', file=get_log_stream())
 
 
 
 def log_warn(arg_msg):
-    print(f'{colors.WARNING}[WARNING] {arg_msg}{colors.ENDC}')
+    print(f'{colors.WARNING}[WARNING] {arg_msg}{colors.ENDC}', file=get_log_stream())
 
 
 
 def log_succ(arg_msg):
-    print(f'{colors.OKGREEN}[SUCCESS] {arg_msg}{colors.ENDC}')
+    print(f'{colors.OKGREEN}[SUCCESS] {arg_msg}{colors.ENDC}', file=get_log_stream())
 
 
 
 def log_info(arg_msg):
-    print(f'{colors.OKBLUE}[INFO] {arg_msg}{colors.ENDC}')
+    print(f'{colors.OKBLUE}[INFO] {arg_msg}{colors.ENDC}', file=get_log_stream())
 
 
 
-def check_tools():
-    have_all_tools = True
+def get_file_stamp(arg_file_path):
+    # the file is considered unchanged while its size and modification time are the same
+    file_stat = os.stat(arg_file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
 
+
+def load_preflight():
+    # the results of the previous check_tools() are dropped when the script is updated
     try:
-        command_output = subprocess.run(['java', '-version'], stderr=subprocess.PIPE).stderr.decode('utf-8')
-        if not 'build' in command_output.lower():
-            have_all_tools = False
-            log_err(f'java not found')
-    except:
-        have_all_tools = False
-        log_err(f'java not found')
+        preflight = json.loads(tools.preflight_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        preflight = {}
+    if preflight.get('script_version') != script_version:
+        preflight = {'script_version': script_version}
+    preflight.setdefault('jars', {})
+    preflight.setdefault('keystores', {})
+    return preflight
+
+
+
+def save_preflight(arg_preflight):
+    # the file is replaced at once to be never read partially by the parallel run
+    temp_preflight_path = tools.preflight_path.with_name(f'{tools.preflight_path.name}.{os.getpid()}.tmp')
+    try:
+        temp_preflight_path.write_text(json.dumps(arg_preflight, indent=4), encoding='utf-8')
+        os.replace(temp_preflight_path, tools.preflight_path)
+    except OSError:
+        log_warn(f'Unable to save {tools.preflight_path}')
+
+
+
+def set_java_version(arg_java_version):
+    # version looks like "1.8.0_292" or "17.0.1"
+    tools.java_version = arg_java_version
+    version_parts = re.findall(r'\d+', tools.java_version)
+    tools.java_major_version = int(version_parts[1] if version_parts[0] == '1' and len(version_parts) > 1 else version_parts[0])
+    log_info(f'Java version: {tools.java_version}')
+
 
+
+def get_keystore_id(arg_keystore):
+    # the format of the keystore file is cached, the passwords are not used (the hash of them could be brute-forced offline)
+    keystore_data = [str(arg_keystore[0])] + get_file_stamp(arg_keystore[0]) + [str(arg_keystore[2])]
+    return hashlib.sha256(json.dumps(keystore_data).encode('utf-8')).hexdigest()
+
+
+
+def check_tools():
+    have_all_tools = True
     log_info(f'Tools directory: {colors.WARNING}{tools.tools_dir}')
     # creating tools directory if it's missing
     Path(tools.tools_dir).mkdir(parents=True, exist_ok=True)
+    preflight = load_preflight()
+    preflight_data = json.dumps(preflight, sort_keys=True)
+
+    # java is launched only if the executable was changed since the previous run
+    java_full_path = shutil.which('java')
+    java_stamp = [os.path.realpath(java_full_path)] + get_file_stamp(java_full_path) if java_full_path else None
+    if java_stamp and preflight.get('java', {}).get('stamp') == java_stamp:
+        set_java_version(preflight['java']['version'])
+    else:
+        preflight.pop('java', None)
+        try:
+            command_output = subprocess.run(['java', '-version'], stderr=subprocess.PIPE).stderr.decode('utf-8')
+            if not 'build' in command_output.lower():
+                have_all_tools = False
+                log_err(f'java not found')
+            else:
+                java_version = re.search(r'version "([^"]+)"', command_output)
+                if java_version:
+                    set_java_version(java_version.group(1))
+                    if java_stamp:
+                        preflight['java'] = {'stamp': java_stamp, 'version': tools.java_version}
+        except:
+            have_all_tools = False
+            log_err(f'java not found')
 
     # checking tools presence in a loop
     for tool in tools.tools_data:
         tool_file = Path(tools.tools_dir).joinpath(tool['file_name'] + tool['version'] + '.jar').resolve()
         tool_url = tool['url'] + tool['version'] + '/' + tool['file_name'] + tool['version'] + '.jar'
+        # the tool checked by the previous run is not hashed again
+        tool_record = preflight['jars'].get(tool_file.name)
+        try:
+            if tool_record and tool_record['stamp'] == get_file_stamp(tool_file):
+                continue
+        except OSError:
+            pass
+        preflight['jars'].pop(tool_file.name, None)
         # checking the single tool presence
         if not tool_file.exists():
             log_err(f"{tool['file_name']}{tool['version']} is missing")
@@ -146,17 +495,24 @@ def check_tools():
             for rm_file_path in rm_files_list:
                 try:
                     rm_file_path.unlink()
+                    preflight['jars'].pop(rm_file_path.name, None)
                 except:
                     log_err(f'Error while deleting the file {rm_file_path}')
-            # downloading the tool
+            # downloading the tool, bypass CERTIFICATE_VERIFY_FAILED error when downloading files
+            import ssl
+            from urllib import request
+            ssl._create_default_https_context = ssl._create_unverified_context
             log_info(f"Downloading {tool['file_name']}{tool['version']}")
             request.urlretrieve(tool_url, tool_file)
             # recheck tool after downloading
             if not tool_file.exists():
                 have_all_tools = False
                 log_err(f"Unable to download {tool['file_name']}{tool['version']}")
-    
-    # keystore checking
+                continue
+        preflight['jars'][tool_file.name] = {'stamp': get_file_stamp(tool_file), 'sha256': get_file_hash(tool_file)}
+
+    # keystore checking, the key is loaded by the built-in signer on the first signing
+    keystore = None
     if not args.ks:
         debug_keystore_path = Path(tools.home_path).joinpath('.android').resolve()
         debug_keystore_path.mkdir(parents=True, exist_ok=True)
@@ -165,6 +521,7 @@ def check_tools():
             debug_keystore_source_full_path = Path(sys.argv[0]).parent.joinpath('debug.keystore').resolve()
             log_warn(f'File {debug_keystore_full_path} not found, copying it from {debug_keystore_source_full_path}')
             shutil.copyfile(debug_keystore_source_full_path, debug_keystore_full_path)
+        keystore = [debug_keystore_full_path, 'android', 'androiddebugkey', 'android']
     else:
         if not Path(args.ks).resolve().exists():
             log_err(f'Keystore file {Path(args.ks).resolve()} not found')
@@ -181,13 +538,38 @@ def check_tools():
                     log_err(f'Key password is missing, specify it with --ks-key-pass argument')
                     have_all_tools = False
             else:
-                command_output = subprocess.run(['keytool', '-J-Duser.language=en', '-list', '-keystore', str(Path(args.ks).resolve()) ,'-storepass', args.ks_pass, '-alias', args.ks_alias], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('utf-8')
-                if 'password was incorrect' in command_output:
-                    log_err(f"Provided key password '{args.ks_pass}' is incorrect")
-                    have_all_tools=False
-                elif 'does not exist' in command_output:
-                    log_err(f"Provided alias name '{args.ks_alias}' is not found")
-                    have_all_tools=False
+                keystore = [Path(args.ks).resolve(), args.ks_pass, args.ks_alias, args.ks_alias_pass]
+    if keystore != None:
+        signing.resolved_keystore = keystore
+        keystore_id = get_keystore_id(keystore)
+        # only the format of the keystore is cached: 'native' - it's supported by the built-in signer, 'keytool' - by uber-apk-signer only,
+        # the passwords and the alias are checked on every run, the key is loaded without launching java
+        keystore_status = preflight['keystores'].get(keystore_id)
+        if keystore_status != 'keytool':
+            try:
+                signing.key = load_signing_key(*keystore)
+                keystore_status = 'native'
+            except rebuild_error as e:
+                log_err(e)
+                have_all_tools = False
+            except signer_error as e:
+                log_warn(f'Keystore {keystore[0]} is not supported by the built-in signer ({e}), uber-apk-signer will be used')
+                keystore_status = 'keytool'
+        if keystore_status == 'keytool' and args.ks:
+            command_output = subprocess.run(['keytool', '-J-Duser.language=en', '-list', '-keystore', str(Path(args.ks).resolve()) ,'-storepass', args.ks_pass, '-alias', args.ks_alias], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('utf-8')
+            if 'password was incorrect' in command_output:
+                log_err(f"Provided key password '{args.ks_pass}' is incorrect")
+                have_all_tools=False
+            elif 'does not exist' in command_output:
+                log_err(f"Provided alias name '{args.ks_alias}' is not found")
+                have_all_tools=False
+        if keystore_status != None:
+            preflight['keystores'][keystore_id] = keystore_status
+        if keystore_status == 'native' and signing.key != None:
+            signing.keystore = keystore
+
+    if json.dumps(preflight, sort_keys=True) != preflight_data:
+        save_preflight(preflight)
 
     if not have_all_tools:
         log_err('Some tools are missing, stopping the script')
@@ -195,40 +577,1628 @@ def check_tools():
 
 
 
-def handle_exit(signal_received, frame):
-    log_warn('SIGINT or CTRL-C detected, removing temp files and directories')
-    global garbage
-    for single_file in garbage['files']:
+def load_device_spec(arg_job):
+    # the device spec for '--device-spec' argument is read once for all .aab files, from the .json file or from the connected device via bundletool,
+    # the failure is remembered too, so the next .aab files don't query the device again
+    with tools.device_spec_lock:
+        if tools.device_spec == None and tools.device_spec_error == None:
+            try:
+                with phase(arg_job, 'device spec'):
+                    tools.device_spec = read_device_spec(arg_job)
+            except rebuild_error as e:
+                tools.device_spec_error = str(e)
+            else:
+                log_info('Device spec: ' + ', '.join(f'{name} {tools.device_spec[name]}' for name in ['sdkVersion', 'supportedAbis', 'screenDensity', 'supportedLocales'] if name in tools.device_spec))
+        if tools.device_spec_error != None:
+            raise rebuild_error(tools.device_spec_error)
+
+
+
+def read_device_spec(arg_job):
+    if args.device_spec == 'device':
+        log_info('Reading the device spec from the connected device')
+        spec_fd, spec_full_path = tempfile.mkstemp(prefix='apk-rebuild-', suffix='.json', dir=args.work_dir)
+        os.close(spec_fd)
+        arg_job.garbage['files'].append(Path(spec_full_path))
+        command = ['get-device-spec', '--output=' + spec_full_path, '--overwrite']
+        adb_full_path = shutil.which('adb')
+        if adb_full_path:
+            command.append('--adb=' + adb_full_path)
+        if os.environ.get('ANDROID_SERIAL'):
+            command.append('--device-id=' + os.environ['ANDROID_SERIAL'])
+        try:
+            run_jar(arg_job, 'bundletool', command)
+            spec_text = Path(spec_full_path).read_text(encoding='utf-8')
+        except rebuild_error as e:
+            raise rebuild_error(f'Unable to read the device spec from the connected device: {e}')
+        finally:
+            Path(spec_full_path).unlink(missing_ok=True)
+            arg_job.garbage['files'].remove(Path(spec_full_path))
+    else:
+        try:
+            spec_text = Path(args.device_spec).read_text(encoding='utf-8')
+        except OSError as e:
+            raise rebuild_error(f'Unable to read the device spec {Path(args.device_spec).resolve()}: {e}')
+    try:
+        device_spec = json.loads(spec_text)
+    except ValueError:
+        device_spec = None
+    if not isinstance(device_spec, dict):
+        raise rebuild_error(f'The device spec {args.device_spec} is not a JSON object')
+    return device_spec
+
+
+
+def clean_garbage(arg_job):
+    # stopping the running tools first, they may still write to the temp directories
+    for process in list(arg_job.garbage['processes']):
+        process.kill()
+    for single_file in arg_job.garbage['files']:
         single_file.unlink(missing_ok=True)
-    for single_dir in garbage['dirs']:
+    for single_dir in arg_job.garbage['dirs']:
         shutil.rmtree(single_dir, ignore_errors=True)
+
+
+
+def handle_exit(signal_received, frame):
+    log_warn('SIGINT or CTRL-C detected, removing temp files and directories')
+    for single_job in list(active_jobs):
+        clean_garbage(single_job)
     exit_script(0)
 
 
 
-def rebuild_single_apk(arg_source_apk_full_path, arg_output_apk_full_path):
-    # path of the directory, where .apk file will be decompiled
-    decompiled_path = Path(str(arg_source_apk_full_path) + decomp_dir_suffix).resolve()
-    global garbage
-    garbage['dirs'].append(decompiled_path)
+def get_peak_rss(arg_rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return arg_rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+
+def record_event(arg_job, arg_event):
+    arg_event['job'] = str(arg_job.source_file.full_path) if arg_job != None else None
+    with trace.lock:
+        arg_event['thread'] = trace.threads.setdefault(threading.get_ident(), len(trace.threads) + 1)
+        # the events of all jobs are kept only to be saved, the service doesn't accumulate them
+        if args.trace or args.metrics:
+            trace.events.append(arg_event)
+    if arg_job != None:
+        arg_job.events.append(arg_event)
+
+
+
+@contextlib.contextmanager
+def phase(arg_job, arg_name, **arg_fields):
+    # recording wall time without pause, CPU time of the current thread and peak RSS of the script, the caller can add the fields to the yielded dict
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    start_pause_time = arg_job.pause_time if arg_job != None else 0
+    event = {'type': 'phase', 'name': arg_name, 'start': start_time - trace.start_time}
+    event.update(arg_fields)
+    try:
+        yield event
+        event['status'] = 'done'
+    except BaseException:
+        event['status'] = 'failed'
+        raise
+    finally:
+        event['wall'] = time.perf_counter() - start_time - ((arg_job.pause_time - start_pause_time) if arg_job != None else 0)
+        event['cpu'] = time.thread_time() - start_cpu_time
+        if resource != None:
+            event['peak_rss'] = get_peak_rss(resource.getrusage(resource.RUSAGE_SELF))
+        record_event(arg_job, event)
+
+
+
+def get_phases_summary(arg_job):
+    # total wall time of the phases of the job by name
+    phases = {}
+    for event in arg_job.events:
+        if event['type'] == 'phase':
+            phases[event['name']] = round(phases.get(event['name'], 0) + event['wall'], 3)
+    return phases
+
+
+
+def get_trace_info():
+    # the versions of the script and the tools to compare the runs, the passwords are not saved
+    options = {name: value for name, value in vars(args).items() if name not in ['ks_pass', 'ks_alias_pass']}
+    return {'script_version': script_version, 'python_version': sys.version.split()[0], 'java_version': tools.java_version, 'tools': {tool['name']: tool['version'] for tool in tools.tools_data}, 'options': options}
+
+
+
+def save_trace(arg_trace_full_path):
+    # Chrome trace event format, the file can be opened in Perfetto UI or chrome://tracing
+    trace_events = []
+    for thread_id in sorted(trace.threads.values()):
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id, 'args': {'name': 'main' if thread_id == 1 else f'worker {thread_id - 1}'}})
+    for event in trace.events:
+        trace_args = {key: value for key, value in event.items() if key not in ['type', 'name', 'start', 'wall', 'thread']}
+        trace_events.append({'name': event['name'], 'cat': event['type'], 'ph': 'X', 'ts': round(event['start'] * 1000000), 'dur': round(event['wall'] * 1000000), 'pid': os.getpid(), 'tid': event['thread'], 'args': trace_args})
+    Path(arg_trace_full_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(arg_trace_full_path).write_text(json.dumps({'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': get_trace_info()}), encoding='utf-8')
+    log_info(f'Trace saved to {colors.WARNING}{Path(arg_trace_full_path).resolve()}')
+
+
+
+def save_metrics(arg_metrics_full_path):
+    # JSON lines: the first line describes the run, the next ones are the phases and the tools
+    Path(arg_metrics_full_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(arg_metrics_full_path, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(json.dumps(dict(type='run', **get_trace_info())) + '\n')
+        for event in trace.events:
+            metrics_file.write(json.dumps(event) + '\n')
+    log_info(f'Metrics saved to {colors.WARNING}{Path(arg_metrics_full_path).resolve()}')
+
+
+
+def run_tool(arg_job, arg_name, arg_command, arg_trace_name=None, **arg_fields):
+    # running the tool with the output to the current log stream
+    stream = get_log_stream()
+    stream.flush()
+    start_time = time.perf_counter()
+    process = subprocess.Popen(arg_command, stdout=stream, stderr=stream)
+    arg_job.garbage['processes'].append(process)
+    event = {'type': 'process', 'name': arg_trace_name or arg_name, 'start': start_time - trace.start_time}
+    event.update(arg_fields)
+    try:
+        if hasattr(os, 'wait4'):
+            # CPU time and peak RSS of the single tool, RUSAGE_CHILDREN sums all the tools launched in parallel
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = return_code = os.waitstatus_to_exitcode(status)
+            event.update({'cpu': rusage.ru_utime + rusage.ru_stime, 'peak_rss': get_peak_rss(rusage)})
+        else:
+            return_code = process.wait()
+    finally:
+        arg_job.garbage['processes'].remove(process)
+        event['wall'] = time.perf_counter() - start_time
+        event['exit_code'] = process.returncode
+        record_event(arg_job, event)
+    if return_code == jvm_oom_exit_code and '-XX:+ExitOnOutOfMemoryError' in arg_command:
+        raise jvm_memory_error(f'{arg_name} failed with OutOfMemoryError')
+    if return_code != 0:
+        raise rebuild_error(f'{arg_name} failed with exit code {return_code}')
+
+
+
+def get_tool(arg_name):
+    for tool in tools.tools_data:
+        if tool['name'] == arg_name:
+            return tool
+
+
+
+def get_tool_path(arg_tool):
+    return Path(tools.tools_dir).joinpath(arg_tool['file_name'] + arg_tool['version'] + '.jar').resolve()
+
+
+
+def load_cds_data():
+    # data about AppCDS archives: jar file the archive was created for and saved startup time
+    if tools.cds_data == None:
+        try:
+            tools.cds_data = json.loads(tools.cds_data_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            tools.cds_data = {}
+    return tools.cds_data
+
+
+
+def get_cds_archive_path(arg_tool):
+    # the archive depends on the tool version and java version, the old versions of the tool are removed with the archives by check_tools()
+    return Path(tools.tools_dir).joinpath(f"{arg_tool['file_name']}{arg_tool['version']}-java{tools.java_version}.jsa").resolve()
+
+
+
+def measure_cds_saving(arg_tool, arg_archive_path):
+    # comparing the startup time of the tool without and with the archive
+    def launch_time(arg_flags):
+        times = []
+        for _ in range(3):
+            launch_start_time = time.time()
+            subprocess.run(['java', '-XX:-UsePerfData'] + arg_tool['jvm_flags'] + arg_flags + ['-jar', str(get_tool_path(arg_tool))] + arg_tool['version_args'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.time() - launch_start_time)
+        return min(times)
+    return max(0, launch_time([]) - launch_time([f'-XX:SharedArchiveFile={arg_archive_path}']))
+
+
+
+def estimate_jvm_heap(arg_job, arg_name, arg_args, arg_input_full_path):
+    # the heap is estimated from the central directory of the input .apk or .aab file, apktool with --no-src doesn't load .dex files
+    load_dex = not (arg_name == 'apktool' and (arg_job.args.no_src or '--no-src' in arg_args))
+    heap = jvm_heap_base
+    try:
+        with zipfile.ZipFile(arg_input_full_path, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                name = info.filename
+                if name.endswith('.dex'):
+                    heap += jvm_heap_dex_ratio * info.file_size if load_dex else 0
+                elif name.endswith('resources.arsc') or name.endswith('resources.pb'):
+                    heap += jvm_heap_table_ratio * info.file_size
+                elif name.startswith('res/') or '/res/' in name:
+                    heap += jvm_heap_resource_size
+    except (OSError, zipfile.BadZipFile):
+        pass
+    # rounding up to 64 MB
+    return max(jvm_heap_min, -(-heap // (64 * 1024 * 1024)) * 64 * 1024 * 1024)
+
+
+
+def get_jvm_memory_budget():
+    with jvm_memory.condition:
+        if not jvm_memory.budget_detected:
+            available_memory = get_available_memory()
+            if available_memory != None:
+                jvm_memory.budget = max(jvm_heap_min, int(available_memory * jvm_memory_share))
+            jvm_memory.budget_detected = True
+        return jvm_memory.budget
+
+
+
+def reserve_jvm_memory(arg_name, arg_heap):
+    # the tool waits while the running ones take the budget, the single tool may take the whole budget
+    waiting = False
+    wait_start_time = time.perf_counter()
+    with jvm_memory.condition:
+        while jvm_memory.reserved != 0 and jvm_memory.reserved + arg_heap > jvm_memory.budget:
+            if not waiting:
+                log_info(f'Waiting for {arg_heap // 1024 // 1024} MB of memory for {arg_name}, {jvm_memory.reserved // 1024 // 1024} MB of {jvm_memory.budget // 1024 // 1024} MB is taken by the running tools')
+                waiting = True
+            jvm_memory.condition.wait()
+        jvm_memory.reserved += arg_heap
+    return time.perf_counter() - wait_start_time
+
+
+
+def release_jvm_memory(arg_heap):
+    with jvm_memory.condition:
+        jvm_memory.reserved -= arg_heap
+        jvm_memory.condition.notify_all()
+
+
+
+def get_jar_output_path(arg_args):
+    # output of the tool, it's removed before the tool is launched again
+    for i, arg in enumerate(arg_args):
+        if arg == '--output' and i + 1 < len(arg_args):
+            return Path(arg_args[i + 1])
+        if arg.startswith('--output='):
+            return Path(arg[len('--output='):])
+    return None
+
+
+
+def run_jar(arg_job, arg_name, arg_args, arg_input_full_path=None):
+    # running the tool via java with the AppCDS archive, the archive is created during the first run of the tool
+    # the heavy tools get the heap estimated from the input file (arg_input_full_path) and wait for the memory budget
+    tool = get_tool(arg_name)
+    tool_path = get_tool_path(tool)
+    command = ['java', '-XX:-UsePerfData'] + tool['jvm_flags']
+    # the temp files of the tools are written to the work directory too
+    if arg_job.work_dir != None:
+        command.append(f'-Djava.io.tmpdir={arg_job.work_dir}')
+    archive_path = None
+    dump_path = None
+    if not arg_job.args.no_cds and tools.java_major_version >= tools.cds_min_java_version:
+        archive_path = get_cds_archive_path(tool)
+        with tools.cds_lock:
+            cds_data = load_cds_data()
+            tool_stat = tool_path.stat()
+            archive_data = cds_data.get(archive_path.name)
+            if archive_path.exists() and archive_data and archive_data['jar_size'] == tool_stat.st_size and archive_data['jar_mtime'] == tool_stat.st_mtime:
+                command.append(f'-XX:SharedArchiveFile={archive_path}')
+                tools.cds_saved_time += archive_data['saved']
+            elif archive_path.name not in tools.cds_dumping:
+                # only one run of the tool creates the archive, it's written to the temp file and renamed when the tool is finished
+                tools.cds_dumping.add(archive_path.name)
+                dump_path = archive_path.with_name(f'{archive_path.name}.{os.getpid()}.tmp')
+                arg_job.garbage['files'].append(dump_path)
+                command.append(f'-XX:ArchiveClassesAtExit={dump_path}')
+    command.extend(['-jar', str(tool_path)] + arg_args)
+
+    heap = None
+    if arg_input_full_path != None and get_jvm_memory_budget() != None:
+        heap = min(estimate_jvm_heap(arg_job, arg_name, arg_args, arg_input_full_path), jvm_memory.budget)
+    try:
+        # the command of the tool is added to the name of the trace event, e.g. 'apktool decode'
+        trace_name = f'{arg_name} {arg_args[0]}' if not arg_args[0].startswith('-') else arg_name
+        if heap == None:
+            run_tool(arg_job, arg_name, command, trace_name)
+        else:
+            for attempt in range(jvm_oom_retries + 1):
+                memory_wait = reserve_jvm_memory(arg_name, heap)
+                try:
+                    heap_flags = [f'-Xmx{heap // 1024 // 1024}m', '-XX:+ExitOnOutOfMemoryError']
+                    run_tool(arg_job, arg_name, command[:2] + heap_flags + command[2:], trace_name, heap=heap, memory_wait=round(memory_wait, 3))
+                    break
+                except jvm_memory_error:
+                    larger_heap = min(2 * heap, jvm_memory.budget)
+                    if attempt == jvm_oom_retries or larger_heap == heap:
+                        raise
+                    log_warn(f'{arg_name} ran out of {heap // 1024 // 1024} MB heap, launching it again with {larger_heap // 1024 // 1024} MB heap')
+                finally:
+                    release_jvm_memory(heap)
+                heap = larger_heap
+                # the partial output of the failed run is removed
+                output_path = get_jar_output_path(arg_args)
+                if output_path != None and output_path.is_dir():
+                    shutil.rmtree(output_path, ignore_errors=True)
+                elif output_path != None:
+                    output_path.unlink(missing_ok=True)
+    finally:
+        if dump_path != None:
+            with tools.cds_lock:
+                tools.cds_dumping.discard(archive_path.name)
+    if dump_path != None and dump_path.exists():
+        # removing the archives created for the other java versions
+        for old_archive_path in Path(tools.tools_dir).glob(f"{tool['file_name']}{tool['version']}-java*.jsa"):
+            old_archive_path.unlink(missing_ok=True)
+        dump_path.replace(archive_path)
+        saved = measure_cds_saving(tool, archive_path)
+        log_info(f'AppCDS archive for {arg_name} is created, JVM startup is {saved:.2f} seconds faster with it')
+        with tools.cds_lock:
+            tool_stat = tool_path.stat()
+            cds_data = load_cds_data()
+            cds_data[archive_path.name] = {'jar_size': tool_stat.st_size, 'jar_mtime': tool_stat.st_mtime, 'saved': saved}
+            tools.cds_data_path.write_text(json.dumps(cds_data, indent=4), encoding='utf-8')
+
+
+
+def string_pool_read(arg_data, arg_offset):
+    # parsing ResStringPool chunk, the original encoded strings are kept to write them back unchanged
+    chunk_type, header_size, chunk_size, string_count, style_count, flags, strings_start, styles_start = struct.unpack_from('<HHIIIIII', arg_data, arg_offset)
+    if chunk_type != chunk_types.STRING_POOL:
+        raise binary_patch_error('string pool not found')
+    offsets = struct.unpack_from(f'<{string_count}I', arg_data, arg_offset + header_size)
+    style_offsets = list(struct.unpack_from(f'<{style_count}I', arg_data, arg_offset + header_size + string_count * 4))
+    is_utf8 = flags & res_values.STRING_POOL_UTF8
+    strings_base = arg_offset + strings_start
+    pool = {'flags': flags, 'strings': [], 'raw': [], 'style_offsets': style_offsets, 'styles': b''}
+    for string_offset in offsets:
+        pos = strings_base + string_offset
+        if is_utf8:
+            # length in characters and length in bytes, each one is 1 or 2 bytes long
+            for _ in range(2):
+                length = arg_data[pos]
+                if length & 0x80:
+                    length = ((length & 0x7f) << 8) | arg_data[pos + 1]
+                    pos += 1
+                pos += 1
+            value = arg_data[pos:pos + length].decode('utf-8', errors='replace')
+            end = pos + length + 1
+        else:
+            length = struct.unpack_from('<H', arg_data, pos)[0]
+            pos += 2
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', arg_data, pos)[0]
+                pos += 2
+            value = arg_data[pos:pos + length * 2].decode('utf-16-le', errors='replace')
+            end = pos + length * 2 + 2
+        pool['strings'].append(value)
+        pool['raw'].append(bytes(arg_data[strings_base + string_offset:end]))
+    if style_count:
+        pool['styles'] = bytes(arg_data[arg_offset + styles_start:arg_offset + chunk_size])
+    return pool
+
+
+
+def string_pool_encode(arg_pool, arg_value):
+    # encoding the string the same way as aapt does
+    utf16_length = len(arg_value.encode('utf-16-le')) // 2
+    if arg_pool['flags'] & res_values.STRING_POOL_UTF8:
+        encoded = arg_value.encode('utf-8')
+        result = b''
+        for length in [utf16_length, len(encoded)]:
+            if length > 0x7f:
+                result += bytes([0x80 | (length >> 8), length & 0xff])
+            else:
+                result += bytes([length])
+        return result + encoded + b'\0'
+    if utf16_length > 0x7fff:
+        result = struct.pack('<HH', 0x8000 | (utf16_length >> 16), utf16_length & 0xffff)
+    else:
+        result = struct.pack('<H', utf16_length)
+    return result + arg_value.encode('utf-16-le') + b'\0\0'
+
+
+
+def string_pool_add(arg_pool, arg_value, arg_index=None):
+    if arg_index == None:
+        arg_index = len(arg_pool['strings'])
+    # styles are bound to the first strings of the pool by index
+    if arg_index < len(arg_pool['style_offsets']):
+        raise binary_patch_error('unable to insert a string into the styled strings')
+    arg_pool['strings'].insert(arg_index, arg_value)
+    arg_pool['raw'].insert(arg_index, string_pool_encode(arg_pool, arg_value))
+    # the pool is not sorted anymore
+    arg_pool['flags'] &= ~res_values.STRING_POOL_SORTED
+    return arg_index
+
+
+
+def string_pool_write(arg_pool):
+    offsets = []
+    data = b''
+    for raw in arg_pool['raw']:
+        offsets.append(len(data))
+        data += raw
+    data += b'\0' * (-len(data) % 4)
+    header_size = 28
+    strings_start = header_size + 4 * (len(offsets) + len(arg_pool['style_offsets']))
+    styles_start = strings_start + len(data) if arg_pool['styles'] else 0
+    chunk_size = strings_start + len(data) + len(arg_pool['styles'])
+    header = struct.pack('<HHIIIIII', chunk_types.STRING_POOL, header_size, chunk_size, len(offsets), len(arg_pool['style_offsets']), arg_pool['flags'], strings_start, styles_start)
+    return header + struct.pack(f'<{len(offsets)}I', *offsets) + struct.pack(f'<{len(arg_pool["style_offsets"])}I', *arg_pool['style_offsets']) + data + arg_pool['styles']
+
+
+
+def axml_read(arg_data):
+    # parsing compiled (binary) XML file into the list of nodes
+    chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', arg_data, 0)
+    if chunk_type != chunk_types.XML:
+        raise binary_patch_error('file is not a binary XML')
+    doc = {'pool': None, 'res_map': [], 'nodes': []}
+    pos = header_size
+    while pos < min(chunk_size, len(arg_data)):
+        chunk_type, header_size, node_size = struct.unpack_from('<HHI', arg_data, pos)
+        if node_size < 8:
+            raise binary_patch_error('broken binary XML chunk')
+        if chunk_type == chunk_types.STRING_POOL:
+            doc['pool'] = string_pool_read(arg_data, pos)
+        elif chunk_type == chunk_types.XML_RESOURCE_MAP:
+            doc['res_map'] = list(struct.unpack_from(f'<{(node_size - header_size) // 4}I', arg_data, pos + header_size))
+        elif chunk_types.XML_START_NAMESPACE <= chunk_type <= chunk_types.XML_CDATA:
+            line, comment = struct.unpack_from('<II', arg_data, pos + 8)
+            node = {'type': chunk_type, 'line': line, 'comment': comment}
+            ext = pos + header_size
+            if chunk_type in [chunk_types.XML_START_NAMESPACE, chunk_types.XML_END_NAMESPACE]:
+                node['prefix'], node['uri'] = struct.unpack_from('<II', arg_data, ext)
+            elif chunk_type == chunk_types.XML_START_ELEMENT:
+                node['ns'], node['name'], attr_start, attr_size, attr_count, node['id_index'], node['class_index'], node['style_index'] = struct.unpack_from('<IIHHHHHH', arg_data, ext)
+                if attr_size != 20:
+                    raise binary_patch_error('unsupported size of binary XML attribute')
+                node['attrs'] = []
+                for i in range(attr_count):
+                    attr = dict(zip(['ns', 'name', 'raw', 'size', 'res0', 'type', 'data'], struct.unpack_from('<IIIHBBI', arg_data, ext + attr_start + i * attr_size)))
+                    node['attrs'].append(attr)
+            elif chunk_type == chunk_types.XML_END_ELEMENT:
+                node['ns'], node['name'] = struct.unpack_from('<II', arg_data, ext)
+            else:
+                node['data'], node['value_size'], node['value_res0'], node['value_type'], node['value_data'] = struct.unpack_from('<IHBBI', arg_data, ext)
+            doc['nodes'].append(node)
+        else:
+            raise binary_patch_error(f'unknown binary XML chunk 0x{chunk_type:04x}')
+        pos += node_size
+    if doc['pool'] == None:
+        raise binary_patch_error('string pool not found')
+    return doc
+
+
+
+def axml_write(arg_doc):
+    body = string_pool_write(arg_doc['pool'])
+    if arg_doc['res_map']:
+        body += struct.pack(f'<HHI{len(arg_doc["res_map"])}I', chunk_types.XML_RESOURCE_MAP, 8, 8 + 4 * len(arg_doc['res_map']), *arg_doc['res_map'])
+    for node in arg_doc['nodes']:
+        if node['type'] in [chunk_types.XML_START_NAMESPACE, chunk_types.XML_END_NAMESPACE]:
+            ext = struct.pack('<II', node['prefix'], node['uri'])
+        elif node['type'] == chunk_types.XML_START_ELEMENT:
+            ext = struct.pack('<IIHHHHHH', node['ns'], node['name'], 20, 20, len(node['attrs']), node['id_index'], node['class_index'], node['style_index'])
+            for attr in node['attrs']:
+                ext += struct.pack('<IIIHBBI', attr['ns'], attr['name'], attr['raw'], 8, 0, attr['type'], attr['data'])
+        elif node['type'] == chunk_types.XML_END_ELEMENT:
+            ext = struct.pack('<II', node['ns'], node['name'])
+        else:
+            ext = struct.pack('<IHBBI', node['data'], 8, 0, node['value_type'], node['value_data'])
+        body += struct.pack('<HHIII', node['type'], 16, 16 + len(ext), node['line'], node['comment']) + ext
+    return struct.pack('<HHI', chunk_types.XML, 8, 8 + len(body)) + body
+
+
+
+def axml_new():
+    return {'pool': {'flags': 0, 'strings': [], 'raw': [], 'style_offsets': [], 'styles': b''}, 'res_map': [], 'nodes': []}
+
+
+
+def axml_shift_strings(arg_doc, arg_index):
+    # increasing the indexes of the strings which were moved by the inserted string
+    def shift(arg_value):
+        return arg_value + 1 if arg_value != res_values.NO_INDEX and arg_value >= arg_index else arg_value
+    for node in arg_doc['nodes']:
+        node['comment'] = shift(node['comment'])
+        for key in ['prefix', 'uri', 'ns', 'name', 'data']:
+            if key in node:
+                node[key] = shift(node[key])
+        if node.get('value_type') == res_values.TYPE_STRING:
+            node['value_data'] = shift(node['value_data'])
+        for attr in node.get('attrs', []):
+            for key in ['ns', 'name', 'raw']:
+                attr[key] = shift(attr[key])
+            if attr['type'] == res_values.TYPE_STRING:
+                attr['data'] = shift(attr['data'])
+
+
+
+def axml_add_string(arg_doc, arg_value, arg_res_id=0):
+    strings = arg_doc['pool']['strings']
+    res_map = arg_doc['res_map']
+    if arg_res_id:
+        # the names of the attributes with resource id are placed in the beginning of the pool, index of the string is index in the resource map
+        for i, res_id in enumerate(res_map):
+            if res_id == arg_res_id and strings[i] == arg_value:
+                return i
+        index = len(res_map)
+        axml_shift_strings(arg_doc, index)
+        string_pool_add(arg_doc['pool'], arg_value, index)
+        res_map.append(arg_res_id)
+        return index
+    # strings without resource id must not be in the range of the resource map
+    for i in range(len(res_map), len(strings)):
+        if strings[i] == arg_value:
+            return i
+    return string_pool_add(arg_doc['pool'], arg_value)
+
+
+
+def axml_string(arg_doc, arg_index):
+    if arg_index == res_values.NO_INDEX:
+        return None
+    return arg_doc['pool']['strings'][arg_index]
+
+
+
+def axml_attr_value(arg_doc, arg_attr):
+    if arg_attr['raw'] != res_values.NO_INDEX:
+        return axml_string(arg_doc, arg_attr['raw'])
+    if arg_attr['type'] == res_values.TYPE_STRING:
+        return axml_string(arg_doc, arg_attr['data'])
+    return None
+
+
+
+def axml_end_index(arg_doc, arg_start_index):
+    # searching the end of the element
+    depth = 0
+    for i in range(arg_start_index, len(arg_doc['nodes'])):
+        if arg_doc['nodes'][i]['type'] == chunk_types.XML_START_ELEMENT:
+            depth += 1
+        elif arg_doc['nodes'][i]['type'] == chunk_types.XML_END_ELEMENT:
+            depth -= 1
+            if depth == 0:
+                return i
+    raise binary_patch_error('end of the binary XML element not found')
+
+
+
+def axml_children(arg_doc, arg_parent_index, arg_name):
+    # indexes of the direct child elements with the name
+    if arg_parent_index == None:
+        # children of the document are the root elements
+        start, end, depth = 0, len(arg_doc['nodes']), 0
+    else:
+        start, end, depth = arg_parent_index + 1, axml_end_index(arg_doc, arg_parent_index), 0
+    children = []
+    for i in range(start, end):
+        node = arg_doc['nodes'][i]
+        if node['type'] == chunk_types.XML_START_ELEMENT:
+            if depth == 0 and axml_string(arg_doc, node['name']) == arg_name:
+                children.append(i)
+            depth += 1
+        elif node['type'] == chunk_types.XML_END_ELEMENT:
+            depth -= 1
+    return children
+
+
+
+def axml_find_all(arg_doc, arg_parent_index, arg_path):
+    # analog of lxml findall() for the path like 'base-config/trust-anchors'
+    found = [arg_parent_index]
+    for name in arg_path.split('/'):
+        found = [child for parent in found for child in axml_children(arg_doc, parent, name)]
+    return found
+
+
+
+def axml_find(arg_doc, arg_parent_index, arg_path):
+    found = axml_find_all(arg_doc, arg_parent_index, arg_path)
+    return found[0] if found else None
+
+
+
+def axml_append_element(arg_doc, arg_parent_index, arg_name, arg_attrs={}):
+    # adding the element to the end of the parent element, boolean values are typed like aapt does
+    attrs = []
+    for attr_name, attr_value in arg_attrs.items():
+        raw = axml_add_string(arg_doc, attr_value)
+        if attr_value in ['true', 'false']:
+            value_type, value_data = res_values.TYPE_INT_BOOLEAN, (0xffffffff if attr_value == 'true' else 0)
+        else:
+            value_type, value_data = res_values.TYPE_STRING, raw
+        attrs.append({'ns': res_values.NO_INDEX, 'name': axml_add_string(arg_doc, attr_name), 'raw': raw, 'type': value_type, 'data': value_data})
+    name = axml_add_string(arg_doc, arg_name)
+    if arg_parent_index == None:
+        index, line = len(arg_doc['nodes']), 1
+    else:
+        index, line = axml_end_index(arg_doc, arg_parent_index), arg_doc['nodes'][arg_parent_index]['line']
+    start_node = {'type': chunk_types.XML_START_ELEMENT, 'line': line, 'comment': res_values.NO_INDEX, 'ns': res_values.NO_INDEX, 'name': name, 'id_index': 0, 'class_index': 0, 'style_index': 0, 'attrs': attrs}
+    end_node = {'type': chunk_types.XML_END_ELEMENT, 'line': line, 'comment': res_values.NO_INDEX, 'ns': res_values.NO_INDEX, 'name': name}
+    arg_doc['nodes'][index:index] = [start_node, end_node]
+    return index
+
+
+
+def axml_create_network_security_config():
+    doc = axml_new()
+    root = axml_append_element(doc, None, 'network-security-config')
+    elem_base = axml_append_element(doc, root, 'base-config', {'cleartextTrafficPermitted': 'false'})
+    elem_trust = axml_append_element(doc, elem_base, 'trust-anchors')
+    for ca_type in ['system', 'user']:
+        axml_append_element(doc, elem_trust, 'certificates', {'src': ca_type})
+    return doc
+
+
+
+def axml_patch_network_security_config(arg_doc):
+    # the same rules as for the decompiled network_security_config.xml in rebuild_single_apk()
+    root = axml_find(arg_doc, None, 'network-security-config')
+    if root == None:
+        raise binary_patch_error('root element of network_security_config.xml not found')
+    for elem_cert in axml_find_all(arg_doc, root, 'base-config/trust-anchors/certificates'):
+        if any(axml_string(arg_doc, attr['name']) == 'src' and axml_attr_value(arg_doc, attr) == 'user' for attr in arg_doc['nodes'][elem_cert]['attrs']):
+            log_succ('File /res/xml/network_security_config.xml meets the requirements')
+            return False
+    log_warn("File /res/xml/network_security_config.xml doesn't meet the requirements")
+
+    # checking the 'base-config' tag
+    elem_base = axml_find(arg_doc, root, 'base-config')
+    if elem_base == None:
+        log_info('Adding element <base-config cleartextTrafficPermitted="false">')
+        elem_base = axml_append_element(arg_doc, root, 'base-config', {'cleartextTrafficPermitted': 'false'})
+
+    # checking the 'trust-anchors' tag
+    elem_trust = axml_find(arg_doc, elem_base, 'trust-anchors')
+    if elem_trust == None:
+        log_info('Adding element <trust-anchors>')
+        elem_trust = axml_append_element(arg_doc, elem_base, 'trust-anchors')
+
+    # checking the 'certificates' tags with 'src' attribute
+    for ca_type in ['system', 'user']:
+        ca_found = False
+        for elem_cert in axml_children(arg_doc, elem_trust, 'certificates'):
+            ca_found = ca_found or any(axml_string(arg_doc, attr['name']) == 'src' and axml_attr_value(arg_doc, attr) == ca_type for attr in arg_doc['nodes'][elem_cert]['attrs'])
+        if not ca_found:
+            log_info(f'Adding element <certificates src="{ca_type}">')
+            axml_append_element(arg_doc, elem_trust, 'certificates', {'src': ca_type})
+    return True
+
+
+
+def axml_patch_android_manifest(arg_doc, arg_config_res_id):
+    elem_application = axml_find(arg_doc, None, 'manifest/application')
+    if elem_application == None:
+        raise binary_patch_error('element <application> not found in AndroidManifest.xml')
+    node = arg_doc['nodes'][elem_application]
+    res_map = arg_doc['res_map']
+
+    # searching for the android:networkSecurityConfig attribute
+    attr_config = None
+    for attr in node['attrs']:
+        if (attr['name'] < len(res_map) and res_map[attr['name']] == res_values.ATTR_NETWORK_SECURITY_CONFIG) or (axml_string(arg_doc, attr['name']) == 'networkSecurityConfig' and axml_string(arg_doc, attr['ns']) == android_ns):
+            attr_config = attr
+    if attr_config != None and attr_config['type'] == res_values.TYPE_REFERENCE and attr_config['data'] == arg_config_res_id:
+        log_succ('File AndroidManifest.xml meets the requirements')
+        return False
+
+    log_warn("File AndroidManifest.xml doesn't meet the requirements")
+    log_info('Adding attribute android:networkSecurityConfig="@xml/network_security_config"')
+    if attr_config == None:
+        if android_ns not in arg_doc['pool']['strings']:
+            raise binary_patch_error('android namespace not found in AndroidManifest.xml')
+        name = axml_add_string(arg_doc, 'networkSecurityConfig', res_values.ATTR_NETWORK_SECURITY_CONFIG)
+        attr_config = {'ns': arg_doc['pool']['strings'].index(android_ns), 'name': name}
+        # attributes with resource id must be sorted by id
+        position = 0
+        for attr in node['attrs']:
+            if attr['name'] >= len(res_map) or res_map[attr['name']] > res_values.ATTR_NETWORK_SECURITY_CONFIG:
+                break
+            position += 1
+        node['attrs'].insert(position, attr_config)
+        # 1-based indexes of the special attributes
+        for key in ['id_index', 'class_index', 'style_index']:
+            if node[key] > position:
+                node[key] += 1
+    attr_config.update({'raw': res_values.NO_INDEX, 'type': res_values.TYPE_REFERENCE, 'data': arg_config_res_id})
+    return True
+
+
+
+def arsc_read(arg_data):
+    # parsing resources.arsc, the chunks which are not changed by the script are kept as is
+    chunk_type, header_size, chunk_size, package_count = struct.unpack_from('<HHII', arg_data, 0)
+    if chunk_type != chunk_types.TABLE:
+        raise binary_patch_error('file is not a resources table')
+    table = {'header': arg_data[8:header_size], 'pool': None, 'packages': [], 'chunks': []}
+    pos = header_size
+    while pos < min(chunk_size, len(arg_data)):
+        chunk_type, header_size, chunk_size_single = struct.unpack_from('<HHI', arg_data, pos)
+        if chunk_size_single < 8:
+            raise binary_patch_error('broken resources table chunk')
+        if chunk_type == chunk_types.STRING_POOL and table['pool'] == None:
+            table['pool'] = string_pool_read(arg_data, pos)
+            table['chunks'].append('pool')
+        elif chunk_type == chunk_types.TABLE_PACKAGE:
+            package = arsc_read_package(arg_data, pos)
+            table['packages'].append(package)
+            table['chunks'].append(package)
+        else:
+            table['chunks'].append(bytes(arg_data[pos:pos + chunk_size_single]))
+        pos += chunk_size_single
+    if table['pool'] == None or not table['packages']:
+        raise binary_patch_error('resources table is incomplete')
+    return table
+
+
+
+def arsc_read_package(arg_data, arg_offset):
+    header_size, chunk_size = struct.unpack_from('<HI', arg_data, arg_offset + 2)
+    package_id = struct.unpack_from('<I', arg_data, arg_offset + 8)[0]
+    type_strings, last_public_type, key_strings, last_public_key = struct.unpack_from('<IIII', arg_data, arg_offset + 268)
+    type_id_offset = struct.unpack_from('<I', arg_data, arg_offset + 284)[0] if header_size >= 288 else 0
+    if type_strings != header_size or type_id_offset:
+        raise binary_patch_error('unsupported resources table package layout')
+    package = {'header': bytearray(arg_data[arg_offset:arg_offset + header_size]), 'id': package_id, 'chunks': []}
+    pos = arg_offset + header_size
+    while pos < arg_offset + chunk_size:
+        chunk_type, _, chunk_size_single = struct.unpack_from('<HHI', arg_data, pos)
+        if chunk_size_single < 8:
+            raise binary_patch_error('broken resources table chunk')
+        if pos - arg_offset == type_strings:
+            package['type_strings'] = string_pool_read(arg_data, pos)
+        elif pos - arg_offset == key_strings:
+            package['key_strings'] = string_pool_read(arg_data, pos)
+        else:
+            package['chunks'].append(bytearray(arg_data[pos:pos + chunk_size_single]))
+        pos += chunk_size_single
+    if 'type_strings' not in package or 'key_strings' not in package:
+        raise binary_patch_error('resources table package is incomplete')
+    return package
+
+
+
+def arsc_write(arg_table):
+    body = b''
+    for chunk in arg_table['chunks']:
+        if isinstance(chunk, bytes):
+            body += chunk
+        elif chunk == 'pool':
+            body += string_pool_write(arg_table['pool'])
+        else:
+            type_strings = string_pool_write(chunk['type_strings'])
+            key_strings = string_pool_write(chunk['key_strings'])
+            content = type_strings + key_strings + b''.join(chunk['chunks'])
+            header = chunk['header']
+            struct.pack_into('<I', header, 4, len(header) + len(content))
+            struct.pack_into('<I', header, 268, len(header))
+            struct.pack_into('<I', header, 276, len(header) + len(type_strings))
+            body += bytes(header) + content
+    header = struct.pack('<HHI', chunk_types.TABLE, 8 + len(arg_table['header']), 8 + len(arg_table['header']) + len(body)) + arg_table['header']
+    return header + body
+
+
+
+def arsc_type_offsets(arg_chunk):
+    # entry offsets of ResTable_type chunk, None for missing entries
+    header_size = struct.unpack_from('<H', arg_chunk, 2)[0]
+    flags, entry_count, entries_start = struct.unpack_from('<BxxII', arg_chunk, 9)
+    offsets = {}
+    if flags & res_values.TYPE_FLAG_SPARSE:
+        for i in range(entry_count):
+            index, offset = struct.unpack_from('<HH', arg_chunk, header_size + i * 4)
+            offsets[index] = entries_start + offset * 4
+    elif flags & res_values.TYPE_FLAG_OFFSET16:
+        for i, offset in enumerate(struct.unpack_from(f'<{entry_count}H', arg_chunk, header_size)):
+            if offset != 0xffff:
+                offsets[i] = entries_start + offset * 4
+    else:
+        for i, offset in enumerate(struct.unpack_from(f'<{entry_count}I', arg_chunk, header_size)):
+            if offset != res_values.NO_INDEX:
+                offsets[i] = entries_start + offset
+    return offsets
+
+
+
+def arsc_read_entry(arg_chunk, arg_offset):
+    # returns key index, value type and value data of the entry
+    size, flags, key = struct.unpack_from('<HHI', arg_chunk, arg_offset)
+    if flags & res_values.ENTRY_FLAG_COMPACT:
+        return size, flags >> 8, key
+    if flags & res_values.ENTRY_FLAG_COMPLEX:
+        return key, None, None
+    value_type, value_data = struct.unpack_from('<xxxBI', arg_chunk, arg_offset + size)
+    return key, value_type, value_data
+
+
+
+def arsc_is_default_config(arg_chunk):
+    config_size = struct.unpack_from('<I', arg_chunk, 20)[0]
+    return not any(arg_chunk[24:20 + config_size])
+
+
+
+def arsc_find_resource(arg_table, arg_type, arg_name):
+    # searching resource like @xml/network_security_config, returns resource id and path of the file in the default configuration
+    package = arg_table['packages'][0]
+    if arg_type not in package['type_strings']['strings'] or arg_name not in package['key_strings']['strings']:
+        return None, None
+    type_id = package['type_strings']['strings'].index(arg_type) + 1
+    key_index = package['key_strings']['strings'].index(arg_name)
+    res_id, res_path = None, None
+    for chunk in package['chunks']:
+        if struct.unpack_from('<H', chunk, 0)[0] != chunk_types.TABLE_TYPE or chunk[8] != type_id:
+            continue
+        for entry_index, offset in arsc_type_offsets(chunk).items():
+            key, value_type, value_data = arsc_read_entry(chunk, offset)
+            if key == key_index:
+                res_id = (package['id'] << 24) | (type_id << 16) | entry_index
+                if value_type == res_values.TYPE_STRING and (res_path == None or arsc_is_default_config(chunk)):
+                    res_path = arg_table['pool']['strings'][value_data]
+    if res_id != None and res_path == None:
+        raise binary_patch_error(f'file of the resource @{arg_type}/{arg_name} not found')
+    return res_id, res_path
+
+
+
+def arsc_add_file_resource(arg_table, arg_type, arg_name, arg_path):
+    # adding the entry to the default configuration of the existing resource type, returns resource id
+    package = arg_table['packages'][0]
+    if arg_type not in package['type_strings']['strings']:
+        raise binary_patch_error(f'resource type {arg_type} not found in resources.arsc')
+    type_id = package['type_strings']['strings'].index(arg_type) + 1
+    spec_index, type_index = None, None
+    for i, chunk in enumerate(package['chunks']):
+        chunk_type = struct.unpack_from('<H', chunk, 0)[0]
+        if chunk[8] != type_id:
+            continue
+        if chunk_type == chunk_types.TABLE_TYPE_SPEC:
+            spec_index = i
+        elif chunk_type == chunk_types.TABLE_TYPE and chunk[9] == 0 and arsc_is_default_config(chunk):
+            type_index = i
+    if spec_index == None or type_index == None:
+        raise binary_patch_error(f'default configuration of the resource type {arg_type} not found in resources.arsc')
+
+    # adding the entry to the type specification
+    spec = package['chunks'][spec_index]
+    spec_header_size, _ = struct.unpack_from('<HI', spec, 2)
+    entry_index = struct.unpack_from('<I', spec, 12)[0]
+    spec = spec[:spec_header_size + entry_index * 4] + struct.pack('<I', 0) + spec[spec_header_size + entry_index * 4:]
+    struct.pack_into('<I', spec, 4, len(spec))
+    struct.pack_into('<I', spec, 12, entry_index + 1)
+    package['chunks'][spec_index] = spec
+
+    # adding the strings
+    if arg_name in package['key_strings']['strings']:
+        key_index = package['key_strings']['strings'].index(arg_name)
+    else:
+        key_index = string_pool_add(package['key_strings'], arg_name)
+        if struct.unpack_from('<I', package['header'], 280)[0] == key_index:
+            struct.pack_into('<I', package['header'], 280, key_index + 1)
+    path_index = string_pool_add(arg_table['pool'], arg_path)
+
+    # adding the entry to the type chunk of the default configuration
+    chunk = package['chunks'][type_index]
+    header_size = struct.unpack_from('<H', chunk, 2)[0]
+    entry_count, entries_start = struct.unpack_from('<II', chunk, 12)
+    offsets = list(struct.unpack_from(f'<{entry_count}I', chunk, header_size))
+    entries = bytes(chunk[entries_start:])
+    offsets += [res_values.NO_INDEX] * (entry_index - entry_count) + [len(entries)]
+    entries += struct.pack('<HHIHBBI', 8, 0, key_index, 8, 0, res_values.TYPE_STRING, path_index)
+    chunk = bytearray(chunk[:header_size]) + struct.pack(f'<{len(offsets)}I', *offsets) + entries
+    struct.pack_into('<I', chunk, 4, len(chunk))
+    struct.pack_into('<II', chunk, 12, len(offsets), header_size + 4 * len(offsets))
+    package['chunks'][type_index] = chunk
+    return (package['id'] << 24) | (type_id << 16) | entry_index
+
+
+
+def dex_read_types(arg_data):
+    # descriptors of the types defined and referenced by .dex file, only the header, the type table and the string table are read
+    if arg_data[:4] != b'dex\n':
+        raise ValueError('not a .dex file')
+    string_ids_size, string_ids_offset, type_ids_size, type_ids_offset = struct.unpack_from('<IIII', arg_data, 0x38)
+    types = []
+    for string_index in struct.unpack_from(f'<{type_ids_size}I', arg_data, type_ids_offset):
+        if string_index >= string_ids_size:
+            raise ValueError('broken type table')
+        offset = struct.unpack_from('<I', arg_data, string_ids_offset + string_index * 4)[0]
+        # the string data starts with ULEB128 length in UTF-16 code units, MUTF-8 bytes end with zero byte
+        while arg_data[offset] & 0x80:
+            offset += 1
+        offset += 1
+        types.append(arg_data[offset:arg_data.index(b'\x00', offset)].decode('utf-8', errors='replace'))
+    return types
+
+
+
+def dex_find_pinning(arg_data):
+    # pinning types referenced by .dex file as java class names and 'certificate pins' if the pins are found in the strings
+    found = []
+    for descriptor in dex_read_types(arg_data):
+        if descriptor in pinning.TYPES or any(descriptor.startswith(type_prefix) for type_prefix in pinning.TYPE_PREFIXES):
+            found.append(descriptor[1:-1].replace('/', '.'))
+    if pinning.PIN_PATTERN.search(arg_data):
+        found.append('certificate pins')
+    return found
+
+
+
+def scan_pinning_dex(arg_apk_full_path):
+    # index of the .dex files in the root of the .apk file with the pinning types they reference, the broken .dex file is decompiled to be safe
+    dex_index = {}
+    with zipfile.ZipFile(arg_apk_full_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if not pinning.DEX_NAME_PATTERN.fullmatch(info.filename):
+                continue
+            try:
+                dex_index[info.filename] = dex_find_pinning(zip_ref.read(info))
+            except (ValueError, struct.error, IndexError) as e:
+                dex_index[info.filename] = [f'unreadable .dex file ({e})']
+    return dex_index
+
+
+
+def decode_selected_dex(arg_job, arg_source_apk_full_path, arg_decompiled_path, arg_dex_names):
+    # the .apk file was decompiled with --no-src, the selected .dex files are decompiled to smali from the separate .apk file with them only,
+    # their raw copies are removed from the decompiled directory, apktool build assembles smali and copies the other .dex files as is
+    dex_apk_full_path = arg_job.work_dir.joinpath(f'{arg_decompiled_path.name}-dex.apk')
+    smali_path = arg_job.work_dir.joinpath(f'{arg_decompiled_path.name}-smali')
+    arg_job.garbage['files'].append(dex_apk_full_path)
+    arg_job.garbage['dirs'].append(smali_path)
+    with zipfile.ZipFile(arg_source_apk_full_path, 'r') as zip_ref:
+        entries = [(arg_source_apk_full_path, info) for info in zip_ref.infolist() if info.filename in arg_dex_names or info.filename == 'AndroidManifest.xml']
+    try:
+        zip_write_apk(entries, {}, dex_apk_full_path)
+    except signer_error as e:
+        raise rebuild_error(f'Unable to copy .dex files from {arg_source_apk_full_path}: {e}')
+    command = ['decode', str(dex_apk_full_path), '--no-res', '--output', str(smali_path)]
+    if arg_job.args.only_main_classes:
+        command.append(arg_job.args.only_main_classes)
+    run_jar(arg_job, 'apktool', command, dex_apk_full_path)
+    for dex_name in arg_dex_names:
+        smali_dir_name = 'smali' if dex_name == 'classes.dex' else 'smali_' + dex_name[:-len('.dex')]
+        if not smali_path.joinpath(smali_dir_name).is_dir():
+            raise rebuild_error(f'apktool did not decompile {dex_name}')
+        shutil.move(str(smali_path.joinpath(smali_dir_name)), str(arg_decompiled_path.joinpath(smali_dir_name)))
+        arg_decompiled_path.joinpath(dex_name).unlink(missing_ok=True)
+    shutil.rmtree(smali_path, ignore_errors=True)
+    dex_apk_full_path.unlink()
+
+
+
+def is_signature_file(arg_name):
+    # files of the v1 signature, the output .apk file is signed again
+    return arg_name == 'META-INF/MANIFEST.MF' or (arg_name.startswith('META-INF/') and arg_name.count('/') == 1 and Path(arg_name).suffix.upper() in ['.SF', '.RSA', '.DSA', '.EC'])
+
+
+
+def patch_apk_binary(arg_job, arg_source_apk_full_path, arg_output_apk_full_path):
+    # the errors of the parsers on the malformed or unusual files (missing string or resource, broken archive) are reported as binary_patch_error,
+    # apktool is used for such files instead
+    try:
+        patch_apk_binary_files(arg_job, arg_source_apk_full_path, arg_output_apk_full_path)
+    except (struct.error, IndexError, KeyError, ValueError, zipfile.BadZipFile, zlib.error) as e:
+        raise binary_patch_error(str(e))
+
+
+
+def patch_apk_binary_files(arg_job, arg_source_apk_full_path, arg_output_apk_full_path):
+    # patching binary AndroidManifest.xml, resources.arsc and network_security_config.xml without decompiling the .apk file
+    changed_files = {}
+    with zipfile.ZipFile(arg_source_apk_full_path, 'r') as zip_ref:
+        names = zip_ref.namelist()
+        if 'AndroidManifest.xml' not in names or 'resources.arsc' not in names:
+            raise binary_patch_error('AndroidManifest.xml or resources.arsc not found')
+        table = arsc_read(zip_ref.read('resources.arsc'))
+        manifest = axml_read(zip_ref.read('AndroidManifest.xml'))
+
+        # processing network_security_config.xml
+        config_res_id, config_path = arsc_find_resource(table, 'xml', 'network_security_config')
+        if config_res_id == None:
+            log_warn('File /res/xml/network_security_config.xml not found, creating')
+            config_path = 'res/xml/network_security_config.xml'
+            while config_path in names:
+                config_path = config_path.replace('.xml', '_.xml')
+            config_res_id = arsc_add_file_resource(table, 'xml', 'network_security_config', config_path)
+            changed_files['resources.arsc'] = arsc_write(table)
+            changed_files[config_path] = axml_write(axml_create_network_security_config())
+        else:
+            if config_path not in names:
+                raise binary_patch_error(f'file {config_path} not found')
+            config = axml_read(zip_ref.read(config_path))
+            if axml_patch_network_security_config(config):
+                changed_files[config_path] = axml_write(config)
+
+        # processing AndroidManifest.xml
+        if axml_patch_android_manifest(manifest, config_res_id):
+            changed_files['AndroidManifest.xml'] = axml_write(manifest)
+
+        # writing the new .apk file, the unchanged entries are copied without recompressing, old signature is removed
+        entries = []
+        for info in zip_ref.infolist():
+            if info.filename in changed_files or is_signature_file(info.filename):
+                continue
+            if is_raw_copy_allowed(info):
+                entries.append((arg_source_apk_full_path, info))
+            else:
+                changed_files[info.filename] = zip_ref.read(info)
+    log_info('Writing a new .apk file')
+    arg_job.garbage['files'].append(arg_output_apk_full_path)
+    try:
+        zip_write_apk(entries, changed_files, arg_output_apk_full_path)
+    except signer_error as e:
+        raise binary_patch_error(str(e))
+
+
+
+def der_read(arg_data, arg_offset):
+    # returns the tag, the start of the value and the end of the DER element
+    tag = arg_data[arg_offset]
+    length = arg_data[arg_offset + 1]
+    offset = arg_offset + 2
+    if length & 0x80:
+        length_size = length & 0x7f
+        length = int.from_bytes(arg_data[offset:offset + length_size], 'big')
+        offset += length_size
+    if offset + length > len(arg_data):
+        raise signer_error('broken DER element')
+    return tag, offset, offset + length
+
+
+
+def der_children(arg_data, arg_offset):
+    # list of (tag, start of the element, start of the value, end of the element) of the constructed element
+    _, start, end = der_read(arg_data, arg_offset)
+    children = []
+    while start < end:
+        tag, value_start, value_end = der_read(arg_data, start)
+        children.append((tag, start, value_start, value_end))
+        start = value_end
+    return children
+
+
+
+def der_encode(arg_tag, arg_value):
+    length = len(arg_value)
+    if length < 0x80:
+        return bytes([arg_tag, length]) + arg_value
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([arg_tag, 0x80 | len(length_bytes)]) + length_bytes + arg_value
+
+
+
+def der_int(arg_value):
+    return der_encode(0x02, arg_value.to_bytes(arg_value.bit_length() // 8 + 1, 'big'))
+
+
+
+def der_oid(arg_oid):
+    # value of OBJECT IDENTIFIER without the tag, used for encoding and comparing
+    numbers = [int(number) for number in arg_oid.split('.')]
+    value = bytes([numbers[0] * 40 + numbers[1]])
+    for number in numbers[2:]:
+        encoded = [number & 0x7f]
+        number >>= 7
+        while number:
+            encoded.insert(0, 0x80 | (number & 0x7f))
+            number >>= 7
+        value += bytes(encoded)
+    return value
+
+
+
+def der_algorithm(arg_oid):
+    # AlgorithmIdentifier with NULL parameters
+    return der_encode(0x30, der_encode(0x06, der_oid(arg_oid)) + der_encode(0x05, b''))
+
+
+
+def rsa_read_private_key(arg_data):
+    # PKCS#8 PrivateKeyInfo with RSAPrivateKey inside
+    _, algorithm, private_key = der_children(arg_data, 0)[:3]
+    oid = der_children(arg_data, algorithm[1])[0]
+    if arg_data[oid[2]:oid[3]] != der_oid(signing.OID_RSA_ENCRYPTION):
+        raise signer_error('only RSA keys are supported')
+    rsa_key = arg_data[private_key[2]:private_key[3]]
+    values = [int.from_bytes(rsa_key[child[2]:child[3]], 'big') for child in der_children(rsa_key, 0)]
+    return dict(zip(['version', 'n', 'e', 'd', 'p', 'q', 'dp', 'dq', 'qinv'], values))
+
+
+
+def rsa_sign(arg_key, arg_data, arg_hash_name):
+    # RSA PKCS#1 v1.5 signature, the private exponent is applied with CRT
+    digest_info = signing.DIGEST_INFO_PREFIX[arg_hash_name] + hashlib.new(arg_hash_name, arg_data).digest()
+    key_size = (arg_key['n'].bit_length() + 7) // 8
+    message = int.from_bytes(b'\x00\x01' + b'\xff' * (key_size - len(digest_info) - 3) + b'\x00' + digest_info, 'big')
+    m1 = pow(message, arg_key['dp'], arg_key['p'])
+    m2 = pow(message, arg_key['dq'], arg_key['q'])
+    h = (arg_key['qinv'] * (m1 - m2)) % arg_key['p']
+    return (m2 + h * arg_key['q']).to_bytes(key_size, 'big')
+
+
+
+def x509_read(arg_cert):
+    # raw DER serial number, issuer and SubjectPublicKeyInfo of the certificate
+    tbs_certificate = der_children(arg_cert, 0)[0]
+    fields = der_children(arg_cert, tbs_certificate[1])
+    if fields[0][0] == 0xa0:
+        # optional version
+        fields = fields[1:]
+    serial, _, issuer, _, _, public_key = fields[:6]
+    return {'serial': arg_cert[serial[1]:serial[3]], 'issuer': arg_cert[issuer[1]:issuer[3]], 'public_key': arg_cert[public_key[1]:public_key[3]]}
+
+
+
+def jks_read_utf(arg_data, arg_offset):
+    size = struct.unpack_from('>H', arg_data, arg_offset)[0]
+    return arg_data[arg_offset + 2:arg_offset + 2 + size].decode('utf-8', errors='replace'), arg_offset + 2 + size
+
+
+
+def jks_read_cert(arg_data, arg_offset):
+    _, offset = jks_read_utf(arg_data, arg_offset)
+    size = struct.unpack_from('>I', arg_data, offset)[0]
+    return arg_data[offset + 4:offset + 4 + size], offset + 4 + size
+
+
+
+def jks_decrypt_key(arg_data, arg_key_pass):
+    # EncryptedPrivateKeyInfo protected by the proprietary Sun algorithm: the key is XORed with the chain of SHA-1 digests of the password and the salt
+    algorithm, encrypted_data = der_children(arg_data, 0)[:2]
+    oid = der_children(arg_data, algorithm[1])[0]
+    if arg_data[oid[2]:oid[3]] != der_oid(signing.OID_JKS_KEY_PROTECTOR):
+        raise signer_error('unsupported key protection algorithm')
+    encrypted = arg_data[encrypted_data[2]:encrypted_data[3]]
+    salt, encrypted_key, check = encrypted[:20], encrypted[20:-20], encrypted[-20:]
+    password = arg_key_pass.encode('utf-16-be')
+    keystream = b''
+    digest = salt
+    while len(keystream) < len(encrypted_key):
+        digest = hashlib.sha1(password + digest).digest()
+        keystream += digest
+    key = (int.from_bytes(encrypted_key, 'big') ^ int.from_bytes(keystream[:len(encrypted_key)], 'big')).to_bytes(len(encrypted_key), 'big')
+    if hashlib.sha1(password + key).digest() != check:
+        raise rebuild_error(f"Provided key password '{arg_key_pass}' is incorrect")
+    return key
+
+
+
+def jks_load(arg_data, arg_store_pass, arg_alias, arg_key_pass):
+    magic, version, count = struct.unpack_from('>III', arg_data, 0)
+    if magic != signing.JKS_MAGIC or version != 2:
+        raise signer_error(f'unsupported JKS version {version}')
+    offset = 12
+    entries = {}
+    for _ in range(count):
+        tag = struct.unpack_from('>I', arg_data, offset)[0]
+        alias, offset = jks_read_utf(arg_data, offset + 4)
+        # skipping the creation date
+        offset += 8
+        if tag == signing.JKS_PRIVATE_KEY_ENTRY:
+            size = struct.unpack_from('>I', arg_data, offset)[0]
+            encrypted_key = arg_data[offset + 4:offset + 4 + size]
+            chain_size = struct.unpack_from('>I', arg_data, offset + 4 + size)[0]
+            offset += 8 + size
+            certs = []
+            for _ in range(chain_size):
+                cert, offset = jks_read_cert(arg_data, offset)
+                certs.append(cert)
+            entries[alias.lower()] = (encrypted_key, certs)
+        elif tag == signing.JKS_TRUSTED_CERT_ENTRY:
+            _, offset = jks_read_cert(arg_data, offset)
+        else:
+            raise signer_error(f'unknown JKS entry type {tag}')
+    # the keystore integrity is checked with the store password
+    if hashlib.sha1(arg_store_pass.encode('utf-16-be') + b'Mighty Aphrodite' + arg_data[:offset]).digest() != arg_data[offset:offset + 20]:
+        raise rebuild_error(f"Provided keystore password '{arg_store_pass}' is incorrect")
+    if arg_alias.lower() not in entries:
+        raise rebuild_error(f"Provided alias name '{arg_alias}' is not found")
+    encrypted_key, certs = entries[arg_alias.lower()]
+    return rsa_read_private_key(jks_decrypt_key(encrypted_key, arg_key_pass)), certs
+
+
+
+def pkcs12_derive_key(arg_hash_name, arg_password, arg_salt, arg_iterations, arg_id):
+    # PKCS12 key derivation (RFC 7292, appendix B.2), the password is BMPString with the trailing zero character
+    hash_size = hashlib.new(arg_hash_name).digest_size
+    block_size = hashlib.new(arg_hash_name).block_size
+    password = (arg_password + '\x00').encode('utf-16-be')
+    diversifier = bytes([arg_id]) * block_size
+    salt = (arg_salt * block_size)[:block_size * -(-len(arg_salt) // block_size)]
+    password = (password * block_size)[:block_size * -(-len(password) // block_size)]
+    data = bytearray(salt + password)
+    result = b''
+    while len(result) < hash_size:
+        digest = hashlib.new(arg_hash_name, diversifier + data).digest()
+        for _ in range(arg_iterations - 1):
+            digest = hashlib.new(arg_hash_name, digest).digest()
+        result += digest
+        addend = int.from_bytes((digest * block_size)[:block_size], 'big') + 1
+        for offset in range(0, len(data), block_size):
+            value = (int.from_bytes(data[offset:offset + block_size], 'big') + addend) % (1 << (block_size * 8))
+            data[offset:offset + block_size] = value.to_bytes(block_size, 'big')
+    return result[:hash_size]
+
+
+
+def pkcs12_check_password(arg_data, arg_store_pass):
+    # the MAC of PKCS12 keystore is checked with the password to tell the wrong password from the broken or unsupported file,
+    # returns None if the MAC is missing or its format is not supported (e.g. BER with the indefinite length or PBMAC1)
+    try:
+        version, auth_safe, mac_data = der_children(arg_data, 0)[:3]
+        content = der_children(arg_data, auth_safe[1])[1]
+        octets = der_children(arg_data, content[1])[0]
+        digest_info, mac_salt = der_children(arg_data, mac_data[1])[:2]
+        iterations = der_children(arg_data, mac_data[1])[2:]
+        algorithm, mac = der_children(arg_data, digest_info[1])
+        hash_oid = der_children(arg_data, algorithm[1])[0]
+    except (signer_error, ValueError, IndexError):
+        return None
+    hash_names = {der_oid(oid): hash_name for oid, hash_name in signing.PKCS12_MAC_HASHES.items()}
+    hash_name = hash_names.get(arg_data[hash_oid[2]:hash_oid[3]])
+    if octets[0] != 0x04 or hash_name == None:
+        return None
+    iterations = int.from_bytes(arg_data[iterations[0][2]:iterations[0][3]], 'big') if iterations else 1
+    key = pkcs12_derive_key(hash_name, arg_store_pass, arg_data[mac_salt[2]:mac_salt[3]], iterations, signing.PKCS12_MAC_KEY_ID)
+    return hmac.compare_digest(hmac.new(key, arg_data[octets[2]:octets[3]], hash_name).digest(), arg_data[mac[2]:mac[3]])
+
+
+
+def pkcs12_load(arg_data, arg_store_pass, arg_alias, arg_key_pass):
+    # PKCS12 encryption (PBES2, 3DES, RC2) is not implemented here, the optional cryptography package is used
+    if pkcs12_check_password(arg_data, arg_store_pass) == False:
+        raise rebuild_error(f"Provided keystore password '{arg_store_pass}' is incorrect")
+    # keytool ignores the key password of PKCS12 keystore, the key is protected by the keystore password
+    if arg_key_pass != arg_store_pass:
+        raise rebuild_error('Provided key password differs from the keystore password, PKCS12 keystores use the keystore password for the key')
+    try:
+        from cryptography.hazmat.primitives.serialization import pkcs12, Encoding, PrivateFormat, NoEncryption
+    except ImportError:
+        raise signer_error('PKCS12 keystores require the cryptography package')
+    try:
+        keystore = pkcs12.load_pkcs12(arg_data, arg_store_pass.encode('utf-8'))
+    except ValueError as e:
+        # the password is checked by the MAC, the file is broken or its encryption is not supported
+        raise signer_error(f'unable to read PKCS12 keystore: {e}')
+    if keystore.key == None or keystore.cert == None:
+        raise rebuild_error('Private key is not found in the keystore')
+    if keystore.cert.friendly_name == None:
+        raise signer_error('the key in PKCS12 keystore has no alias')
+    if keystore.cert.friendly_name.decode('utf-8', errors='replace').lower() != arg_alias.lower():
+        raise rebuild_error(f"Provided alias name '{arg_alias}' is not found")
+    key = keystore.key.private_bytes(Encoding.DER, PrivateFormat.PKCS8, NoEncryption())
+    certs = [keystore.cert.certificate.public_bytes(Encoding.DER)] + [cert.certificate.public_bytes(Encoding.DER) for cert in keystore.additional_certs]
+    return rsa_read_private_key(key), certs
+
+
+
+def load_signing_key(arg_keystore_full_path, arg_store_pass, arg_alias, arg_key_pass):
+    # loading the key from JKS or PKCS12 keystore, raises rebuild_error if the password or the alias is wrong
+    data = Path(arg_keystore_full_path).read_bytes()
+    try:
+        magic = struct.unpack_from('>I', data, 0)[0]
+        if magic == signing.JCEKS_MAGIC:
+            raise signer_error('JCEKS keystores are not supported')
+        if magic == signing.JKS_MAGIC:
+            key, certs = jks_load(data, arg_store_pass, arg_alias, arg_key_pass)
+        else:
+            key, certs = pkcs12_load(data, arg_store_pass, arg_alias, arg_key_pass)
+        return {'key': key, 'certs': certs, 'cert': x509_read(certs[0])}
+    except (struct.error, IndexError, ValueError):
+        raise signer_error('broken keystore')
+
+
+
+def get_signing_key():
+    # the key checked by check_tools() is loaded once for all the parallel jobs
+    with signing.key_lock:
+        if signing.key == None:
+            signing.key = load_signing_key(*signing.keystore)
+    return signing.key
+
+
+
+def get_min_sdk_version(arg_zip_ref):
+    # minSdkVersion from the binary AndroidManifest.xml, it defines the digest algorithm of v1 signature
+    try:
+        doc = axml_read(arg_zip_ref.read('AndroidManifest.xml'))
+        elem_uses_sdk = axml_find(doc, None, 'manifest/uses-sdk')
+    except (KeyError, binary_patch_error, struct.error, IndexError, UnicodeDecodeError):
+        return 1
+    if elem_uses_sdk == None:
+        return 1
+    for attr in doc['nodes'][elem_uses_sdk]['attrs']:
+        if attr['name'] < len(doc['res_map']) and doc['res_map'][attr['name']] == res_values.ATTR_MIN_SDK_VERSION:
+            # the codename of the preview platform is the string
+            return attr['data'] if attr['type'] == res_values.TYPE_INT_DEC else 10000
+    return 1
+
+
+
+def jar_manifest_line(arg_name, arg_value):
+    # lines are wrapped by 70 bytes like apksigner does, continuation lines start with the space
+    line = f'{arg_name}: {arg_value}'.encode('utf-8')
+    result = line[:70] + b'\r\n'
+    for i in range(70, len(line), 69):
+        result += b' ' + line[i:i + 69] + b'\r\n'
+    return result
+
+
+
+def jar_entry_digest(arg_zip_ref, arg_info, arg_hash_name):
+    entry_hash = hashlib.new(arg_hash_name)
+    with arg_zip_ref.open(arg_info, 'r') as entry_file:
+        for chunk in iter(lambda: entry_file.read(signing.CHUNK_SIZE), b''):
+            entry_hash.update(chunk)
+    return base64.b64encode(entry_hash.digest()).decode('ascii')
+
+
+
+def jar_signature_files(arg_zip_ref, arg_entries, arg_hash_name):
+    # v1 signature: MANIFEST.MF with the digests of the entries, CERT.SF with the digests of the manifest sections and PKCS#7 signature of CERT.SF
+    digest_name = 'SHA-256' if arg_hash_name == 'sha256' else 'SHA1'
+    created_by = f'apk-rebuild {script_version}'
+    entries = sorted([info for info in arg_entries if not info.is_dir()], key=lambda info: info.filename)
+    # zlib and hashlib release GIL, the entries are decompressed and hashed in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        digests = list(executor.map(lambda info: jar_entry_digest(arg_zip_ref, info, arg_hash_name), entries))
+
+    manifest = jar_manifest_line('Manifest-Version', '1.0') + jar_manifest_line('Created-By', created_by) + b'\r\n'
+    sections = []
+    for info, digest in zip(entries, digests):
+        section = jar_manifest_line('Name', info.filename) + jar_manifest_line(f'{digest_name}-Digest', digest) + b'\r\n'
+        manifest += section
+        sections.append((info.filename, section))
+
+    signature_file = jar_manifest_line('Signature-Version', '1.0') + jar_manifest_line('Created-By', created_by)
+    signature_file += jar_manifest_line(f'{digest_name}-Digest-Manifest', base64.b64encode(hashlib.new(arg_hash_name, manifest).digest()).decode('ascii'))
+    # the .apk file must be rejected if v2 and v3 signatures are stripped
+    signature_file += jar_manifest_line('X-Android-APK-Signed', '2, 3') + b'\r\n'
+    for name, section in sections:
+        signature_file += jar_manifest_line('Name', name) + jar_manifest_line(f'{digest_name}-Digest', base64.b64encode(hashlib.new(arg_hash_name, section).digest()).decode('ascii')) + b'\r\n'
+
+    # PKCS#7 SignedData without the signed attributes, the signature is calculated over CERT.SF
+    key = get_signing_key()
+    digest_algorithm = der_algorithm(signing.OID_SHA256 if arg_hash_name == 'sha256' else signing.OID_SHA1)
+    signer_info = der_encode(0x30, der_int(1) + der_encode(0x30, key['cert']['issuer'] + key['cert']['serial']) + digest_algorithm + der_algorithm(signing.OID_RSA_ENCRYPTION) + der_encode(0x04, rsa_sign(key['key'], signature_file, arg_hash_name)))
+    signed_data = der_encode(0x30, der_int(1) + der_encode(0x31, digest_algorithm) + der_encode(0x30, der_encode(0x06, der_oid(signing.OID_PKCS7_DATA))) + der_encode(0xa0, b''.join(key['certs'])) + der_encode(0x31, signer_info))
+    signature_block = der_encode(0x30, der_encode(0x06, der_oid(signing.OID_PKCS7_SIGNED_DATA)) + der_encode(0xa0, signed_data))
+
+    return {'META-INF/MANIFEST.MF': manifest, 'META-INF/CERT.SF': signature_file, 'META-INF/CERT.RSA': signature_block}
+
+
+
+def zip_write_entry(arg_output_file, arg_entry, arg_data, arg_source_file=None):
+    # writing the local header and the data (bytes or the compressed data copied from the source file), returns the central directory record
+    offset = arg_output_file.tell()
+    if offset > 0xffffffff or arg_entry['compress_size'] >= 0xffffffff or arg_entry['file_size'] >= 0xffffffff:
+        raise signer_error('ZIP64 archives are not supported')
+    # zipalign: the data of uncompressed entries is aligned by 4 bytes (native libraries by 4096 bytes) with the padding in the extra field
+    alignment = 1
+    if arg_entry['method'] == zipfile.ZIP_STORED:
+        alignment = 4096 if arg_entry['name'].endswith(b'.so') else 4
+    extra_size = -(offset + 30 + len(arg_entry['name'])) % alignment
+    arg_output_file.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, arg_entry['version_needed'], arg_entry['flags'], arg_entry['method'], arg_entry['time'], arg_entry['date'], arg_entry['crc'], arg_entry['compress_size'], arg_entry['file_size'], len(arg_entry['name']), extra_size))
+    arg_output_file.write(arg_entry['name'] + b'\x00' * extra_size)
+    if arg_source_file != None:
+        remaining = arg_entry['compress_size']
+        while remaining:
+            chunk = arg_source_file.read(min(remaining, signing.CHUNK_SIZE))
+            if not chunk:
+                raise signer_error('unexpected end of the .apk file')
+            arg_output_file.write(chunk)
+            remaining -= len(chunk)
+    else:
+        arg_output_file.write(arg_data)
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, arg_entry['version_made'], arg_entry['version_needed'], arg_entry['flags'], arg_entry['method'], arg_entry['time'], arg_entry['date'], arg_entry['crc'], arg_entry['compress_size'], arg_entry['file_size'], len(arg_entry['name']), 0, 0, 0, arg_entry['internal_attr'], arg_entry['external_attr'], offset) + arg_entry['name']
+
+
+
+def zip_read_entry(arg_source_file, arg_info):
+    # reading the local header of the entry, the source file is left at the start of the compressed data
+    if arg_info.flag_bits & 0x01:
+        raise signer_error(f'encrypted entry {arg_info.filename}')
+    arg_source_file.seek(arg_info.header_offset)
+    header = arg_source_file.read(30)
+    signature, time, date, name_size, extra_size = struct.unpack('<I6xHH12xHH', header)
+    if signature != 0x04034b50:
+        raise signer_error(f'broken local header of {arg_info.filename}')
+    name = arg_source_file.read(name_size)
+    arg_source_file.seek(extra_size, os.SEEK_CUR)
+    return {
+        'name': name,
+        'version_made': (arg_info.create_system << 8) | arg_info.create_version,
+        'version_needed': arg_info.extract_version,
+        # sizes are written to the local header, the data descriptor is not needed
+        'flags': arg_info.flag_bits & ~0x08,
+        'method': arg_info.compress_type,
+        'time': time,
+        'date': date,
+        'crc': arg_info.CRC,
+        'compress_size': arg_info.compress_size,
+        'file_size': arg_info.file_size,
+        'internal_attr': arg_info.internal_attr,
+        'external_attr': arg_info.external_attr
+    }
+
+
+
+def zip_write_aligned(arg_entries, arg_new_files, arg_output_file):
+    # copying the compressed data of the entries (pairs of the source .apk file and ZipInfo) without decompressing and adding the new files, returns the central directory and its offset
+    central_directory = []
+    with contextlib.ExitStack() as stack:
+        source_files = {}
+        for source_full_path, info in arg_entries:
+            if source_full_path not in source_files:
+                source_files[source_full_path] = stack.enter_context(open(source_full_path, 'rb'))
+            entry = zip_read_entry(source_files[source_full_path], info)
+            central_directory.append(zip_write_entry(arg_output_file, entry, None, source_files[source_full_path]))
+    for name, data in arg_new_files.items():
+        # resources.arsc must be stored uncompressed for Android >= 11
+        if name == 'resources.arsc':
+            method, compressed = zipfile.ZIP_STORED, data
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            method, compressed = zipfile.ZIP_DEFLATED, compressor.compress(data) + compressor.flush()
+        # the fixed date like apksigner does, the output doesn't depend on the current time
+        entry = {'name': name.encode('utf-8'), 'version_made': 20, 'version_needed': 20 if method == zipfile.ZIP_DEFLATED else 10, 'flags': 0x0800, 'method': method, 'time': 0, 'date': ((1981 - 1980) << 9) | (1 << 5) | 1, 'crc': zlib.crc32(data), 'compress_size': len(compressed), 'file_size': len(data), 'internal_attr': 0, 'external_attr': 0}
+        central_directory.append(zip_write_entry(arg_output_file, entry, compressed))
+    if len(central_directory) >= 0xffff:
+        raise signer_error('ZIP64 archives are not supported')
+    return b''.join(central_directory), len(central_directory), arg_output_file.tell()
+
+
+
+def zip_write_apk(arg_entries, arg_new_files, arg_output_full_path):
+    # writing the unsigned .apk file, the arguments are the same as zip_write_aligned() ones
+    with open(arg_output_full_path, 'wb') as output_file:
+        central_directory, count, central_directory_offset = zip_write_aligned(arg_entries, arg_new_files, output_file)
+        output_file.write(central_directory + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, len(central_directory), central_directory_offset, 0))
 
-    # stop script if the directory already exists
-    # most probably script was already executed, but not overwriting the directory to not lose files if it's not
-    if decompiled_path.exists():
-        log_err(f'Directory {decompiled_path} already exists, probably the .apk file {arg_source_apk_full_path} was already processed by the script. Remove the directory and run the script again. Stopping the script')
-        exit_script(1)
 
-    # decompiling .apk file with apktool
-    log_info(f'Processing {colors.WARNING}{Path(arg_source_apk_full_path).name}')
-    log_info('Decompiling the .apk file')
-    command = ['java', '-jar', str(tools.apktool_path), 'decode', str(arg_source_apk_full_path), '--output', str(decompiled_path)]
-    for param in [args.no_src, args.only_main_classes]:
-        if param:
-            command.append(param)
-    subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
+
+def is_raw_copy_allowed(arg_info):
+    # resources.arsc compressed in the source file is stored again, Android >= 11 doesn't install the .apk file with compressed resources.arsc
+    return not is_signature_file(arg_info.filename) and not (arg_info.filename == 'resources.arsc' and arg_info.compress_type != zipfile.ZIP_STORED)
+
+
+
+def merge_built_apk(arg_job, arg_source_apk_full_path, arg_built_apk_full_path):
+    # the entries which apktool produced unchanged are copied from the source .apk file with their original compression, the changed ones are copied from the built file, nothing is recompressed
+    with zipfile.ZipFile(arg_source_apk_full_path, 'r') as source_zip, zipfile.ZipFile(arg_built_apk_full_path, 'r') as built_zip:
+        source_infos = {info.filename: info for info in source_zip.infolist() if is_raw_copy_allowed(info)}
+        entries = []
+        for info in built_zip.infolist():
+            source_info = source_infos.get(info.filename)
+            if source_info != None and source_info.CRC == info.CRC and source_info.file_size == info.file_size:
+                entries.append((arg_source_apk_full_path, source_info))
+            else:
+                entries.append((arg_built_apk_full_path, info))
+    copied = sum(1 for source_full_path, _ in entries if source_full_path == arg_source_apk_full_path)
+    log_info(f'Copying {copied} unchanged entries of {len(entries)} from the source .apk file')
+    merged_apk_full_path = Path(str(arg_built_apk_full_path) + '.merged')
+    arg_job.garbage['files'].append(merged_apk_full_path)
+    try:
+        zip_write_apk(entries, {}, merged_apk_full_path)
+    except signer_error as e:
+        log_warn(f'Unable to copy the unchanged entries from the source .apk file ({e}), the .apk file built by apktool is used')
+        merged_apk_full_path.unlink(missing_ok=True)
+        return {'copied': 0, 'rebuilt': len(entries)}
+    os.replace(merged_apk_full_path, arg_built_apk_full_path)
+    arg_job.garbage['files'].remove(merged_apk_full_path)
+    return {'copied': copied, 'rebuilt': len(entries) - copied}
+
+
+
+def apk_chunk_digest(arg_data):
+    chunk_hash = hashlib.sha256(b'\xa5' + struct.pack('<I', len(arg_data)))
+    chunk_hash.update(arg_data)
+    return chunk_hash.digest()
+
+
+
+def apk_content_digest(arg_output_file, arg_central_directory_offset, arg_central_directory, arg_eocd):
+    # APK Signature Scheme v2/v3 digest: the entries, the central directory and EOCD are split to 1 MiB chunks, the chunks are hashed on all CPU cores
+    arg_output_file.flush()
+    with mmap.mmap(arg_output_file.fileno(), arg_central_directory_offset, access=mmap.ACCESS_READ) as entries_data:
+        def digest_entries_chunk(arg_offset):
+            with memoryview(entries_data) as view:
+                return apk_chunk_digest(view[arg_offset:min(arg_offset + signing.CHUNK_SIZE, arg_central_directory_offset)])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            digests = list(executor.map(digest_entries_chunk, range(0, arg_central_directory_offset, signing.CHUNK_SIZE)))
+    for section in [arg_central_directory, arg_eocd]:
+        for offset in range(0, len(section), signing.CHUNK_SIZE):
+            digests.append(apk_chunk_digest(section[offset:offset + signing.CHUNK_SIZE]))
+    return hashlib.sha256(b'\x5a' + struct.pack('<I', len(digests)) + b''.join(digests)).digest()
+
+
+
+def length_prefixed(arg_data):
+    return struct.pack('<I', len(arg_data)) + arg_data
+
+
+
+def apk_signer_block(arg_content_digest, arg_v3):
+    # the single signer of v2 or v3 signature
+    key = get_signing_key()
+    digests = length_prefixed(length_prefixed(struct.pack('<I', signing.RSA_PKCS1_V1_5_SHA256) + length_prefixed(arg_content_digest)))
+    certs = length_prefixed(b''.join(length_prefixed(cert) for cert in key['certs']))
+    sdk_range = struct.pack('<II', signing.V3_MIN_SDK, signing.V3_MAX_SDK)
+    if arg_v3:
+        signed_data = digests + certs + sdk_range + length_prefixed(b'')
+    else:
+        signed_data = digests + certs + length_prefixed(length_prefixed(struct.pack('<II', signing.STRIPPING_PROTECTION_ATTR_ID, 3)))
+    signatures = length_prefixed(length_prefixed(struct.pack('<I', signing.RSA_PKCS1_V1_5_SHA256) + length_prefixed(rsa_sign(key['key'], signed_data, 'sha256'))))
+    signer = length_prefixed(signed_data) + (sdk_range if arg_v3 else b'') + signatures + length_prefixed(key['cert']['public_key'])
+    return length_prefixed(length_prefixed(signer))
+
+
+
+def apk_signing_block(arg_content_digest):
+    pairs = b''
+    for block_id, v3 in [(signing.V2_BLOCK_ID, False), (signing.V3_BLOCK_ID, True)]:
+        value = apk_signer_block(arg_content_digest, v3)
+        pairs += struct.pack('<QI', len(value) + 4, block_id) + value
+    block_size = len(pairs) + 8 + len(signing.APK_SIG_BLOCK_MAGIC)
+    return struct.pack('<Q', block_size) + pairs + struct.pack('<Q', block_size) + signing.APK_SIG_BLOCK_MAGIC
+
+
+
+def sign_apk_native(arg_job, arg_apk_full_path):
+    # zipalign and v1, v2, v3 signatures without starting JVM, the signed file replaces the source one
+    with zipfile.ZipFile(arg_apk_full_path, 'r') as zip_ref:
+        entries = [info for info in zip_ref.infolist() if not is_signature_file(info.filename)]
+        hash_name = 'sha256' if get_min_sdk_version(zip_ref) >= signing.JAR_SHA256_MIN_SDK else 'sha1'
+        signature_files = jar_signature_files(zip_ref, entries, hash_name)
+
+    signed_apk_full_path = Path(str(arg_apk_full_path) + '.signed')
+    arg_job.garbage['files'].append(signed_apk_full_path)
+    with open(signed_apk_full_path, 'w+b') as output_file:
+        central_directory, count, central_directory_offset = zip_write_aligned([(arg_apk_full_path, info) for info in entries], signature_files, output_file)
+        eocd = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, len(central_directory), central_directory_offset, 0)
+        output_file.write(central_directory + eocd)
+        # the signing block is inserted before the central directory, EOCD points to the new offset of it
+        signing_block = apk_signing_block(apk_content_digest(output_file, central_directory_offset, central_directory, eocd))
+        output_file.seek(central_directory_offset)
+        output_file.write(signing_block + central_directory + eocd[:16] + struct.pack('<IH', central_directory_offset + len(signing_block), 0))
+        output_file.truncate()
+    os.replace(signed_apk_full_path, arg_apk_full_path)
+    arg_job.garbage['files'].remove(signed_apk_full_path)
+
+
+
+def sign_apk(arg_job, arg_apk_full_path):
+    # sign the new .apk file with the built-in signer, uber-apk-signer is used if it's not possible or '--jar-signer' argument was provided
+    log_info('Signing the new .apk file')
+    with phase(arg_job, 'sign', file=Path(arg_apk_full_path).name) as event:
+        if not arg_job.args.jar_signer and signing.keystore != None:
+            try:
+                sign_apk_native(arg_job, arg_apk_full_path)
+                event['signer'] = 'native'
+                return
+            except signer_error as e:
+                log_warn(f'Unable to sign the .apk file with the built-in signer ({e}), signing it with uber-apk-signer')
+        command = ['--apks', str(arg_apk_full_path), '--allowResign', '--overwrite']
+        if arg_job.args.ks:
+            command.extend(['--ks', arg_job.args.ks, '--ksPass', arg_job.args.ks_pass, '--ksAlias', arg_job.args.ks_alias, '--ksKeyPass', arg_job.args.ks_alias_pass])
+        run_jar(arg_job, 'uber-apk-signer', command)
+        event['signer'] = 'uber-apk-signer'
+
+
+
+def patch_decompiled_apk(arg_decompiled_path):
+    # patching network_security_config.xml and AndroidManifest.xml in the directory decompiled by apktool
+    from lxml import etree
 
     # preparing vars for network_security_config.xml processing
-    network_security_config_path = decompiled_path.joinpath('res', 'xml').resolve()
+    network_security_config_path = arg_decompiled_path.joinpath('res', 'xml').resolve()
     network_security_config_full_path = network_security_config_path.joinpath('network_security_config.xml').resolve()
 
     # creating directory to avoid errors
@@ -279,7 +2249,7 @@ def rebuild_single_apk(arg_source_apk_full_path, arg_output_apk_full_path):
             log_succ("File /res/xml/network_security_config.xml meets the requirements")
 
     # processing AndroidManifest.xml
-    android_manifest_full_path = decompiled_path.joinpath('AndroidManifest.xml').resolve()
+    android_manifest_full_path = arg_decompiled_path.joinpath('AndroidManifest.xml').resolve()
     # reading AndroidManifest.xml
     parser = etree.XMLParser(remove_blank_text=True)
     tree = etree.parse(str(android_manifest_full_path), parser=parser)
@@ -296,191 +2266,1350 @@ def rebuild_single_apk(arg_source_apk_full_path, arg_output_apk_full_path):
     else:
         log_succ(f'File AndroidManifest.xml meets the requirements')
 
+
+
+def get_decompiled_path(arg_job, arg_apk_full_path):
+    # the directory which is preserved or changed by the user during the pause is placed next to the .apk file (or in the output directory for .xapk),
+    # in the other cases it's placed to the work directory
+    if arg_job.args.preserve or arg_job.args.pause:
+        return Path(str(arg_apk_full_path) + decomp_dir_suffix).resolve()
+    return arg_job.work_dir.joinpath(Path(arg_apk_full_path).name + decomp_dir_suffix)
+
+
+
+def rebuild_single_apk(arg_job, arg_source_apk_full_path, arg_output_apk_full_path, arg_decompiled_path):
+    # patching the binary files without decompiling if argument '--no-decompile' was provided
+    if arg_job.args.no_decompile:
+        log_info(f'Processing {colors.WARNING}{Path(arg_source_apk_full_path).name}{colors.OKBLUE} without decompiling')
+        try:
+            with phase(arg_job, 'patch binary', file=Path(arg_source_apk_full_path).name):
+                patch_apk_binary(arg_job, arg_source_apk_full_path, arg_output_apk_full_path)
+        except binary_patch_error as e:
+            log_warn(f'Unable to patch the .apk file without decompiling ({e}), decompiling it with apktool')
+            Path(arg_output_apk_full_path).unlink(missing_ok=True)
+        else:
+            # the signing errors are not the errors of the patching, decompiling wouldn't help
+            sign_apk(arg_job, arg_output_apk_full_path)
+            return
+
+    # path of the directory, where .apk file will be decompiled
+    decompiled_path = arg_decompiled_path
+
+    # data about the source .apk file stored in the decompiled directory to reuse it with '--incremental' argument
+    decompiled_stamp_full_path = decompiled_path.joinpath(decomp_stamp_name)
+    decompiled_stamp = {}
+    if arg_job.args.preserve:
+        decompiled_stamp = {'source_file': get_file_hash(arg_source_apk_full_path), 'options': [arg_job.args.no_src, arg_job.args.only_main_classes, arg_job.args.only_pinning_dex]}
+
+    log_info(f'Processing {colors.WARNING}{Path(arg_source_apk_full_path).name}')
+    # stop script if the directory already exists
+    # most probably script was already executed, but not overwriting the directory to not lose files if it's not
+    if decompiled_path.exists():
+        try:
+            reuse_decompiled = arg_job.args.incremental and json.loads(decompiled_stamp_full_path.read_text(encoding='utf-8')) == decompiled_stamp
+        except (OSError, ValueError):
+            reuse_decompiled = False
+        if not reuse_decompiled:
+            if arg_job.args.incremental:
+                raise rebuild_error(f'Directory {decompiled_path} already exists, but it was not created by the script from the .apk file {arg_source_apk_full_path} with the same options. Remove the directory and run the script again. Stopping the script')
+            raise rebuild_error(f'Directory {decompiled_path} already exists, probably the .apk file {arg_source_apk_full_path} was already processed by the script. Remove the directory and run the script again or use --incremental argument. Stopping the script')
+        # the files of the previous build in the 'build' directory are reused by apktool
+        log_info(f'Reusing decompiled directory {colors.WARNING}{decompiled_path}')
+    else:
+        arg_job.garbage['dirs'].append(decompiled_path)
+
+        # decompiling .apk file with apktool
+        log_info('Decompiling the .apk file')
+        command = ['decode', str(arg_source_apk_full_path), '--output', str(decompiled_path)]
+        for param in [arg_job.args.no_src, arg_job.args.only_main_classes]:
+            if param:
+                command.append(param)
+        # processing '--only-pinning-dex' argument, the .dex files without the pinning types are left as is
+        selected_dex = None
+        if arg_job.args.only_pinning_dex and not arg_job.args.no_src:
+            with phase(arg_job, 'dex scan', file=Path(arg_source_apk_full_path).name) as event:
+                dex_index = scan_pinning_dex(arg_source_apk_full_path)
+                selected_dex = [dex_name for dex_name, found in dex_index.items() if found]
+                event.update({'dex_files': len(dex_index), 'selected': len(selected_dex)})
+            arg_job.dex_index[Path(arg_source_apk_full_path).name] = dex_index
+            for dex_name in selected_dex:
+                log_info(f'Found in {colors.WARNING}{dex_name}{colors.OKBLUE}: {", ".join(dex_index[dex_name])}')
+            log_info(f'Decompiling {len(selected_dex)} of {len(dex_index)} .dex files to smali')
+            if len(selected_dex) == len(dex_index):
+                selected_dex = None
+            else:
+                command.append('--no-src')
+        with phase(arg_job, 'decode', file=Path(arg_source_apk_full_path).name):
+            run_jar(arg_job, 'apktool', command, arg_source_apk_full_path)
+            if selected_dex:
+                decode_selected_dex(arg_job, arg_source_apk_full_path, decompiled_path, selected_dex)
+        if arg_job.args.preserve:
+            decompiled_stamp_full_path.write_text(json.dumps(decompiled_stamp), encoding='utf-8')
+
+    with phase(arg_job, 'patch', file=Path(arg_source_apk_full_path).name):
+        patch_decompiled_apk(decompiled_path)
+
     # processing '--pause' argument
-    if args.pause:
-        global start_time
-        global time_sum
+    if arg_job.args.pause:
         # stopping timer
-        time_sum += (time.time() - start_time)
-        log_info('Paused. Perform necessary actions and press ENTER to continue')
+        arg_job.time_sum += (time.time() - arg_job.start_time)
+        log_info(f'Paused. Perform necessary actions in {colors.WARNING}{decompiled_path}{colors.OKBLUE} and press ENTER to continue')
+        pause_start_time = time.perf_counter()
         input('')
+        # the pause is recorded separately and excluded from the phases which contain it
+        pause_time = time.perf_counter() - pause_start_time
+        arg_job.pause_time += pause_time
+        record_event(arg_job, {'type': 'pause', 'name': 'pause', 'start': pause_start_time - trace.start_time, 'wall': pause_time})
         # continue timer
-        start_time = time.time()
+        arg_job.start_time = time.time()
 
     # building a new .apk file with apktool
     log_info('Building a new .apk file')
-    command = ['java', '-jar', str(tools.apktool_path), 'build', str(decompiled_path), '--output', str(arg_output_apk_full_path)]
-    subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
-    garbage['files'].append(arg_output_apk_full_path)
+    command = ['build', str(decompiled_path), '--output', str(arg_output_apk_full_path)]
+    arg_job.garbage['files'].append(arg_output_apk_full_path)
+    with phase(arg_job, 'build', file=Path(arg_source_apk_full_path).name):
+        run_jar(arg_job, 'apktool', command, arg_source_apk_full_path)
+    with phase(arg_job, 'merge', file=Path(arg_source_apk_full_path).name) as event:
+        event.update(merge_built_apk(arg_job, arg_source_apk_full_path, arg_output_apk_full_path))
 
-    # sign the new .apk file with uber-apk-signer
-    log_info('Signing the new .apk file')
-    command = ['java', '-jar', str(tools.uber_apk_signer_path), '--apks', str(arg_output_apk_full_path), '--allowResign', '--overwrite']
-    if args.ks:
-        command.extend(['--ks', args.ks, '--ksPass', args.ks_pass, '--ksAlias', args.ks_alias, '--ksKeyPass', args.ks_alias_pass])
-    subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
+    # sign the new .apk file
+    sign_apk(arg_job, arg_output_apk_full_path)
 
     # removing the decompiled directory if atgument '--preserve' was not provided
-    if not args.preserve:
+    if not arg_job.args.preserve:
         log_info(f'Removing decompiled directory {colors.WARNING}{decompiled_path}')
         shutil.rmtree(decompiled_path, ignore_errors=True)
 
 
 
-def main():
-    # handle Ctrl+C
-    signal(SIGINT, handle_exit)
+def run_with_own_log(arg_function, *arg_args):
+    # every parallel worker writes the log to its own temp file, the log is printed at once when the worker is finished
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as log_file:
+        log_stream.file = log_file
+        try:
+            return arg_function(*arg_args)
+        finally:
+            del log_stream.file
+            log_file.seek(0)
+            with print_lock:
+                sys.stdout.write(log_file.read())
+                sys.stdout.flush()
 
-    # var for garage files and directories
-    global garbage
 
-    # parse script arguments
-    parser = argparse.ArgumentParser(description='The script allows to bypass SSL pinning on Android >= 7 via rebuilding the APK file and making the user credential storage trusted. After processing the output APK file is ready for HTTPS traffic inspection.')
-    parser.add_argument('source_file', metavar='file', help='path to .apk, .aab or .xapk file for rebuilding')
-    parser.add_argument('-v', '--version', action='version', version=f'%(prog)s {script_version}')
-    parser.add_argument('-i', '--install', action='store_true', help='install the rebuilded .apk file(s) via adb')
-    parser.add_argument('--pause', action='store_true', help='pause the script execution before the building the output .apk')
-    parser.add_argument('-p', '--preserve', action='store_true', help='preserve the unpacked content of the .apk file(s)')
-    parser.add_argument('-r', '--remove', action='store_true', help='remove the source file (.apk, .aab or .xapk) after the rebuilding')
-    parser.add_argument('-o', '--output', help='output .apk file name or output directory path (for .xapk source file)')
-    parser.add_argument('--no-src', action='store_const', const='--no-src', help='use --no-src option when decompiling via apktool')
-    parser.add_argument('--only-main-classes', action='store_const', const='--only-main-classes', help='use --only-main-classes option when decompiling via apktool')
-    parser.add_argument('--ks', help='use custom .keystore file for .aab decoding and .apk signing')
-    parser.add_argument('--ks-pass', help='password of the custom keystore')
-    parser.add_argument('--ks-alias', help='key (alias) in the custom keystore')
-    parser.add_argument('--ks-alias-pass', help='password for key (alias) in the custom keystore')
-    global args
-    args = parser.parse_args()
 
-    log_info(f'Script version: {script_version}')
-    log_info(f'Python version: {sys.version}')
+def extract_zip_member(arg_zip_full_path, arg_member_name, arg_output_full_path):
+    # streaming the single member to the file without extracting the whole archive, every caller opens the archive itself to read it from several threads
+    with zipfile.ZipFile(arg_zip_full_path, 'r') as zip_ref:
+        with zip_ref.open(arg_member_name, 'r') as member_file, open(arg_output_full_path, 'wb') as output_file:
+            shutil.copyfileobj(member_file, output_file, 1024 * 1024)
 
-    # stop script if source file doesn't exists
-    if not Path(args.source_file).resolve().exists():
-        log_err(f'File {Path(args.source_file).resolve()} not found, stopping the script')
-        exit_script(1)
 
-    # check if all necessary tools are available
-    check_tools()
 
-    # get necessary data about the source file
-    source_file.ext = Path(args.source_file).resolve().suffix
-    source_file.name_wo_ext = Path(args.source_file).resolve().stem
-    source_file.directory_path = Path(args.source_file).resolve().parent
-    source_file.full_path = Path(args.source_file).resolve()
-    source_file.full_path_wo_ext = source_file.full_path.with_suffix('')
+def publish_output(arg_job, arg_work_full_path, arg_output_full_path):
+    # moving the signed .apk file from the work directory to the output path, the file is copied to the temp file next to the output path first
+    # if the work directory is on the other file system (e.g. /dev/shm), so the output file never appears partially written
+    Path(arg_output_full_path).parent.mkdir(parents=True, exist_ok=True)
+    arg_job.garbage['files'].append(Path(arg_output_full_path))
+    try:
+        os.replace(arg_work_full_path, arg_output_full_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        temp_full_path = Path(f'{arg_output_full_path}.{os.getpid()}.tmp')
+        arg_job.garbage['files'].append(temp_full_path)
+        shutil.copyfile(arg_work_full_path, temp_full_path)
+        os.replace(temp_full_path, arg_output_full_path)
+        arg_job.garbage['files'].remove(temp_full_path)
+        Path(arg_work_full_path).unlink()
+
+
+
+def get_config_split_name(arg_apk_full_path):
+    # name of the configuration split (config.arm64_v8a, config.xxhdpi, config.en) from the 'split' attribute of AndroidManifest.xml,
+    # None for the base and feature splits, the configuration splits contain no manifest entries and network_security_config.xml to patch
+    try:
+        with zipfile.ZipFile(arg_apk_full_path, 'r') as zip_ref:
+            doc = axml_read(zip_ref.read('AndroidManifest.xml'))
+        elem_manifest = axml_find(doc, None, 'manifest')
+    except (KeyError, zipfile.BadZipFile, binary_patch_error, struct.error, IndexError, UnicodeDecodeError):
+        return None
+    if elem_manifest == None:
+        return None
+    attrs = {axml_string(doc, attr['name']): attr for attr in doc['nodes'][elem_manifest]['attrs']}
+    split_name = axml_attr_value(doc, attrs['split']) if 'split' in attrs else None
+    if not split_name or ('isFeatureSplit' in attrs and attrs['isFeatureSplit']['data']):
+        return None
+    if split_name.startswith('config.') or 'configForSplit' in attrs:
+        return split_name
+    return None
+
+
+
+def rebuild_apk_worker(arg_job, arg_archive_full_path, arg_member_name, arg_source_apk_full_path, arg_output_apk_full_path, arg_sign_only=False):
+    # the .apk file is extracted from .xapk (or .apks) to the work directory right before the rebuilding and removed after it, so only the processed files take the disk space
+    log_info(f'Extracting {colors.WARNING}{arg_member_name}')
+    work_apk_full_path = arg_job.work_dir.joinpath(Path(arg_member_name).name)
+    work_output_full_path = arg_job.work_dir.joinpath(Path(arg_output_apk_full_path).name)
+    arg_job.garbage['files'].append(work_apk_full_path)
+    with phase(arg_job, 'extract', file=arg_member_name):
+        extract_zip_member(arg_archive_full_path, arg_member_name, work_apk_full_path)
+    # the configuration splits (and the splits built for the device spec except the base one) are only signed with the same key as the base .apk,
+    # adb install-multiple requires the same signature for all splits
+    split_name = get_config_split_name(work_apk_full_path) if not arg_sign_only else None
+    if split_name != None or arg_sign_only:
+        log_info(f'{colors.WARNING}{arg_member_name}{colors.OKBLUE} is ' + (f'the configuration split {split_name}' if split_name != None else 'not the base split') + ', signing it without rebuilding')
+        arg_job.garbage['files'].append(work_output_full_path)
+        os.replace(work_apk_full_path, work_output_full_path)
+        sign_apk(arg_job, work_output_full_path)
+    else:
+        rebuild_single_apk(arg_job, work_apk_full_path, work_output_full_path, get_decompiled_path(arg_job, arg_source_apk_full_path))
+        work_apk_full_path.unlink()
+    publish_output(arg_job, work_output_full_path, arg_output_apk_full_path)
 
-    # generate pathes for output file(s)
-    if args.output != None:
-        if source_file.ext.lower() == '.xapk':
-            output_files.directory_path = Path(args.output).resolve()
-            Path(output_files.directory_path).mkdir(parents=True, exist_ok=True)
-        else:
-            output_files.directory_path = Path(args.output).parent.resolve()
-            Path(output_files.directory_path).mkdir(parents=True, exist_ok=True)
-            output_files.full_path = Path(str(Path(args.output).resolve()) + output_suffix + output_ext).resolve()
+
+
+def rebuild_apks_parallel(arg_job, arg_apk_list):
+    log_info(f'Processing {len(arg_apk_list)} .apk files in {arg_job.args.jobs} parallel jobs')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=arg_job.args.jobs) as executor:
+        futures = [executor.submit(run_with_own_log, rebuild_apk_worker, arg_job, *apk_args) for apk_args in arg_apk_list]
+        done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        failed = [future for future in done if future.exception()]
+        if failed:
+            # one .apk file failed, cancelling the queued ones and stopping the running ones
+            for future in not_done:
+                future.cancel()
+            for process in list(arg_job.garbage['processes']):
+                process.kill()
+            concurrent.futures.wait(not_done)
+            raise failed[0].exception()
+
+
+
+def get_file_hash(arg_file_path):
+    # reading the file by chunks to not load the multi-GB files into memory
+    file_hash = hashlib.sha256()
+    with open(arg_file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+
+def get_cache_key(arg_job):
+    # the result depends on the source file, tools versions, signing key and decoding options
+    key_data = {
+        'script_version': script_version,
+        'source_file': get_file_hash(arg_job.source_file.full_path),
+        'ext': arg_job.source_file.ext.lower(),
+        'tools': {tool['name']: tool['version'] for tool in tools.tools_data},
+        'keystore': {'file': get_file_hash(signing.resolved_keystore[0]), 'alias': signing.resolved_keystore[2]},
+        'options': {'no_src': arg_job.args.no_src, 'only_main_classes': arg_job.args.only_main_classes, 'only_pinning_dex': arg_job.args.only_pinning_dex, 'no_decompile': arg_job.args.no_decompile, 'jar_signer': arg_job.args.jar_signer},
+        'device_spec': tools.device_spec if is_split_output(arg_job) and arg_job.source_file.ext.lower() == '.aab' else None
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+
+def cache_restore(arg_cache_key, arg_output_dir_path, arg_output_full_path=None):
+    # copying the cached files to the output directory (or to the output file for .apk and .aab), returns the list of the files or None if there is no cached result
+    cache_entry_path = tools.cache_dir.joinpath(arg_cache_key)
+    try:
+        cache_entry = json.loads(cache_entry_path.joinpath('cache.json').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    log_info(f'Found the rebuilded file(s) in the cache {colors.WARNING}{cache_entry_path}')
+    Path(arg_output_dir_path).mkdir(parents=True, exist_ok=True)
+    output_list = []
+    for name, output_name in cache_entry['files']:
+        # the file is copied to the temp file and renamed to be never read partially
+        output_full_path = Path(arg_output_full_path or Path(arg_output_dir_path).joinpath(output_name)).resolve()
+        temp_full_path = Path(f'{output_full_path}.{os.getpid()}.tmp')
+        try:
+            shutil.copyfile(cache_entry_path.joinpath(name), temp_full_path)
+            os.replace(temp_full_path, output_full_path)
+        finally:
+            temp_full_path.unlink(missing_ok=True)
+        output_list.append(output_full_path)
+    # the last used entries are removed last
+    os.utime(cache_entry_path)
+    return output_list
+
+
+
+def cache_store(arg_job, arg_cache_key, arg_output_list):
+    # the entry is written to the temp directory and renamed to be never read partially
+    cache_entry_path = tools.cache_dir.joinpath(arg_cache_key)
+    if cache_entry_path.exists():
+        return
+    log_info('Saving the rebuilded file(s) to the cache')
+    temp_entry_path = tools.cache_dir.joinpath(f'{arg_cache_key}.{os.getpid()}.tmp')
+    arg_job.garbage['dirs'].append(temp_entry_path)
+    temp_entry_path.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i, output_full_path in enumerate(arg_output_list):
+        name = f'{i}{output_ext}'
+        shutil.copyfile(output_full_path, temp_entry_path.joinpath(name))
+        files.append([name, Path(output_full_path).name])
+    temp_entry_path.joinpath('cache.json').write_text(json.dumps({'source_file': str(arg_job.source_file.full_path), 'files': files}, indent=4), encoding='utf-8')
+    try:
+        temp_entry_path.rename(cache_entry_path)
+    except OSError:
+        # the same file was cached by the parallel run
+        shutil.rmtree(temp_entry_path, ignore_errors=True)
+    cache_evict(arg_job)
+
+
+
+def cache_evict(arg_job):
+    # removing the least recently used entries while the cache is bigger than the limit
+    entries = []
+    for cache_entry_path in tools.cache_dir.iterdir():
+        if cache_entry_path.suffix == '.tmp' or not cache_entry_path.is_dir():
+            continue
+        entry_size = sum(file.stat().st_size for file in cache_entry_path.iterdir())
+        entries.append((cache_entry_path.stat().st_mtime, entry_size, cache_entry_path))
+    cache_size = sum(entry[1] for entry in entries)
+    for _, entry_size, cache_entry_path in sorted(entries):
+        if cache_size <= arg_job.args.cache_size * 1024 * 1024:
+            break
+        log_info(f'Removing the least recently used cache entry {colors.WARNING}{cache_entry_path}')
+        shutil.rmtree(cache_entry_path, ignore_errors=True)
+        cache_size -= entry_size
+
+
+
+def get_uncompressed_size(arg_zip_file):
+    # total size of the archive entries, the argument is the path or the file object of the nested .apk file
+    with zipfile.ZipFile(arg_zip_file, 'r') as zip_ref:
+        return sum(info.file_size for info in zip_ref.infolist())
+
+
+
+def estimate_apk_space(arg_job, arg_apk_size, arg_uncompressed_size):
+    # the extracted .apk file, the output .apk file and its signed copy, the decompiled files
+    space = 3 * arg_apk_size
+    if not arg_job.args.no_decompile:
+        space += decompiled_size_ratio * arg_uncompressed_size
+    return space
+
+
+
+def estimate_work_space(arg_job):
+    # space needed in the work directory estimated from the uncompressed size of the source file, 0 if the file can't be read (the error is reported by the processing)
+    source_full_path = arg_job.source_file.full_path
+    try:
+        source_size = source_full_path.stat().st_size
+        if arg_job.source_file.ext.lower() == '.apk':
+            return estimate_apk_space(arg_job, source_size, get_uncompressed_size(source_full_path))
+        if arg_job.source_file.ext.lower() == '.aab':
+            # .apks file and the universal .apk file are about the size of .aab file
+            return 2 * source_size + estimate_apk_space(arg_job, source_size, get_uncompressed_size(source_full_path))
+        estimates = []
+        with zipfile.ZipFile(source_full_path, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                if '/' in info.filename or not info.filename.lower().endswith('.apk'):
+                    continue
+                # the nested .apk files are usually stored, reading the entries of the compressed one requires decompressing it
+                uncompressed_size = 2 * info.file_size
+                if info.compress_type == zipfile.ZIP_STORED:
+                    with zip_ref.open(info) as apk_file:
+                        uncompressed_size = get_uncompressed_size(apk_file)
+                estimates.append(estimate_apk_space(arg_job, info.file_size, uncompressed_size))
+        # the .apk files processed in parallel take the space at the same time
+        return sum(sorted(estimates, reverse=True)[:max(1, arg_job.args.jobs)])
+    except (OSError, zipfile.BadZipFile):
+        return 0
+
+
+
+def reserve_work_space(arg_job):
+    # the job waits while the running jobs take the space, it's refused if the space is not enough even without them
+    space = estimate_work_space(arg_job)
+    waiting = False
+    with work_space.condition:
+        while True:
+            free_space = shutil.disk_usage(arg_job.work_dir).free - work_space.reserved
+            if space <= free_space:
+                break
+            if work_space.reserved == 0:
+                raise rebuild_error(f'Not enough free space in the work directory {arg_job.work_dir.parent}: {space // 1024 // 1024} MB is needed, {max(0, free_space) // 1024 // 1024} MB is available. Free the space or select the other directory with --work-dir argument')
+            if not waiting:
+                log_info(f'Waiting for {space // 1024 // 1024} MB of free space in the work directory {colors.WARNING}{arg_job.work_dir.parent}')
+                waiting = True
+            work_space.condition.wait()
+        work_space.reserved += space
+        arg_job.work_space = space
+
+
+
+def release_work_space(arg_job):
+    with work_space.condition:
+        work_space.reserved -= arg_job.work_space
+        arg_job.work_space = 0
+        work_space.condition.notify_all()
+
+
+
+def rebuild_split_apks(arg_job, arg_archive_full_path, arg_member_list, arg_base_member=None):
+    # rebuilding the .apk files from .xapk or .apks to the output directory, only the base split is rebuilded if it's specified
+    split_dir_full_path = arg_job.output_files.directory_path
+    # only the directory created by the job is removed if the job fails, the existing directory (or the one from '-o' argument) may contain the user's files,
+    # the output .apk files are removed one by one
+    if arg_job.args.output == None and not Path(split_dir_full_path).exists():
+        arg_job.garbage['dirs'].append(split_dir_full_path)
+    Path(split_dir_full_path).mkdir(parents=True, exist_ok=True)
+    apk_files_list = []
+    for member_name in arg_member_list:
+        # the path of the .apk file defines the path of the preserved decompiled directory, the file is extracted to the work directory
+        single_apk = split_dir_full_path.joinpath(Path(member_name).name).resolve()
+        single_apk_new = split_dir_full_path.joinpath(Path(member_name).stem + output_suffix + output_ext).resolve()
+        apk_files_list.append((arg_archive_full_path, member_name, single_apk, single_apk_new, arg_base_member != None and member_name != arg_base_member))
+        arg_job.new_apk_list.append(single_apk_new)
+    if arg_job.args.jobs > 1 and len(apk_files_list) > 1:
+        rebuild_apks_parallel(arg_job, apk_files_list)
     else:
-        if source_file.ext.lower() == '.xapk':
-            output_files.directory_path = Path(source_file.directory_path).joinpath(source_file.name_wo_ext)
-        else:
-            output_files.directory_path = source_file.directory_path
-            output_files.full_path = Path(str(source_file.full_path_wo_ext) + output_suffix + output_ext).resolve()
+        for apk_args in apk_files_list:
+            rebuild_apk_worker(arg_job, *apk_args)
 
-    # source file processing start time
-    global start_time
-    start_time = time.time()
 
-    # processing the source file depending on it extension
-    if source_file.ext.lower() == '.apk':
+
+def process_source_file(arg_job):
+    new_apk_list = arg_job.new_apk_list
+
+    # the output .apk file is written to the work directory and moved to the output path when it's signed
+    work_output_full_path = arg_job.work_dir.joinpath(Path(arg_job.output_files.full_path or 'output').name)
+    if arg_job.source_file.ext.lower() == '.apk':
         # rebuilding .apk
-        rebuild_single_apk(source_file.full_path, output_files.full_path)
-    elif source_file.ext.lower() == '.aab':
+        rebuild_single_apk(arg_job, arg_job.source_file.full_path, work_output_full_path, get_decompiled_path(arg_job, arg_job.source_file.full_path))
+        publish_output(arg_job, work_output_full_path, arg_job.output_files.full_path)
+    elif arg_job.source_file.ext.lower() == '.aab':
         # extracting .apks from .apk with bundletool
-        log_info(f'Extracting .apks from {colors.WARNING}{source_file.full_path}')
-        apks_full_path = source_file.full_path.with_suffix('.apks')
-        garbage['files'].append(apks_full_path)
-        command = ['java', '-jar', str(tools.bundletool_path), 'build-apks', '--bundle=' + str(source_file.full_path), '--output=' + str(apks_full_path), '--mode=universal']
+        log_info(f'Extracting .apks from {colors.WARNING}{arg_job.source_file.full_path}')
+        apks_full_path = arg_job.work_dir.joinpath(arg_job.source_file.name_wo_ext + '.apks')
+        arg_job.garbage['files'].append(apks_full_path)
+        command = ['build-apks', '--bundle=' + str(arg_job.source_file.full_path), '--output=' + str(apks_full_path)]
+        if arg_job.args.device_spec != None:
+            # only the splits matching the device are built instead of the universal .apk file with all ABIs, densities and languages
+            device_spec_full_path = arg_job.work_dir.joinpath('device-spec.json')
+            device_spec_full_path.write_text(json.dumps(tools.device_spec), encoding='utf-8')
+            command.append('--device-spec=' + str(device_spec_full_path))
+        else:
+            command.append('--mode=universal')
         # execute bundletool
-        subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
+        with phase(arg_job, 'build-apks'):
+            run_jar(arg_job, 'bundletool', command, arg_job.source_file.full_path)
+
+        if arg_job.args.device_spec != None:
+            # the base split (or the standalone .apk file for Android < 5) is rebuilded, the other splits are only signed
+            with zipfile.ZipFile(apks_full_path, 'r') as zip_ref:
+                member_list = [info.filename for info in zip_ref.infolist() if info.filename.lower().endswith('.apk')]
+            base_member = next((member_name for member_name in member_list if Path(member_name).name == 'base-master.apk' or member_name.startswith('standalones/')), None)
+            if base_member == None:
+                raise rebuild_error(f'The base split not found in {apks_full_path}')
+            rebuild_split_apks(arg_job, apks_full_path, member_list, base_member)
+            apks_full_path.unlink()
+            return
 
         # extracting .apk from .apks
         log_info(f'Extracting .apk from {colors.WARNING}{str(apks_full_path)}')
-        apks_dir_full_path = source_file.directory_path.joinpath(source_file.name_wo_ext).resolve()
-        garbage['dirs'].append(apks_dir_full_path)
-        with zipfile.ZipFile(apks_full_path, 'r') as zip_ref:
-            zip_ref.extractall(apks_dir_full_path)
+        apk_full_path = arg_job.work_dir.joinpath(arg_job.source_file.name_wo_ext + '.apk')
+        arg_job.garbage['files'].append(apk_full_path)
+        try:
+            with phase(arg_job, 'extract', file='universal.apk'):
+                extract_zip_member(apks_full_path, 'universal.apk', apk_full_path)
+        except KeyError:
+            raise rebuild_error(f'universal.apk not found in {apks_full_path}')
         # remove .apks file
         apks_full_path.unlink()
-        # move .apk file
-        apk_full_path = source_file.full_path.with_suffix('.apk')
-        garbage['files'].append(apk_full_path)
-        shutil.move(apks_dir_full_path.joinpath('universal.apk').resolve(), apk_full_path)
-        # remove unzipped directory
-        shutil.rmtree(apks_dir_full_path, ignore_errors=True)
 
-        # rebuild .apk
-        rebuild_single_apk(apk_full_path, output_files.full_path)
+        # rebuild .apk, the decompiled directory is preserved next to the .aab file
+        rebuild_single_apk(arg_job, apk_full_path, work_output_full_path, get_decompiled_path(arg_job, arg_job.source_file.full_path.with_suffix('.apk')))
+        publish_output(arg_job, work_output_full_path, arg_job.output_files.full_path)
 
         # removing .apk
         apk_full_path.unlink()
-    elif source_file.ext.lower() == '.xapk':
-        # extracting .xapk
-        log_info(f'Extracing .xapk')
-        xapk_dir_full_path = output_files.directory_path
-        garbage['dirs'].append(xapk_dir_full_path)
-        with zipfile.ZipFile(source_file.full_path, 'r') as zip_ref:
-            zip_ref.extractall(xapk_dir_full_path)
-
-        # searching for .apk files
-        log_info(f'Searching for .apk files in {colors.WARNING}{xapk_dir_full_path}')
-        apk_files_list = Path(xapk_dir_full_path).glob('*.apk'.lower())
-        new_apk_list = []
-        for single_apk in apk_files_list:
-            single_apk_new = xapk_dir_full_path.joinpath(str(Path(single_apk.name).with_suffix('')) + output_suffix + output_ext).resolve()
-            rebuild_single_apk(single_apk, single_apk_new)
-            new_apk_list.append(single_apk_new)
-            single_apk.unlink()
+    elif arg_job.source_file.ext.lower() == '.xapk':
+        # searching for .apk files in the root of .xapk, the other files (OBB, icons, manifest.json) are left in the archive
+        log_info(f'Searching for .apk files in {colors.WARNING}{arg_job.source_file.full_path}')
+        with zipfile.ZipFile(arg_job.source_file.full_path, 'r') as zip_ref:
+            member_list = [info.filename for info in zip_ref.infolist() if '/' not in info.filename and info.filename.lower().endswith('.apk')]
+        if not member_list:
+            raise rebuild_error('No .apk files found in the .xapk file')
+        rebuild_split_apks(arg_job, arg_job.source_file.full_path, member_list)
     else:
-        log_err('Unsupported file extension. The script supports .apk, .aab, .xapk')
-        exit_script(1)
+        raise rebuild_error('Unsupported file extension. The script supports .apk, .aab, .xapk')
 
-    # logging time spent for rebuilding source file
-    global time_sum
-    time_sum += (time.time() - start_time)
-    log_succ(f'Rebuilded in {int(time_sum)} seconds')
 
-    # check and removing the source file
-    if args.remove:
-        log_info(f'Removing the source file {colors.WARNING}{source_file.full_path}')
-        source_file.full_path.unlink()
 
-    if args.install:
+def is_split_output(arg_job):
+    # .xapk file and .aab file built for the device spec give several .apk files, they are saved to the output directory
+    return arg_job.source_file.ext.lower() == '.xapk' or (arg_job.source_file.ext.lower() == '.aab' and arg_job.args.device_spec != None)
+
+
+
+def set_output_paths(arg_job):
+    # generate pathes for output file(s)
+    if arg_job.args.output != None:
+        if is_split_output(arg_job):
+            arg_job.output_files.directory_path = Path(arg_job.args.output).resolve()
+            Path(arg_job.output_files.directory_path).mkdir(parents=True, exist_ok=True)
+        else:
+            arg_job.output_files.directory_path = Path(arg_job.args.output).parent.resolve()
+            Path(arg_job.output_files.directory_path).mkdir(parents=True, exist_ok=True)
+            arg_job.output_files.full_path = Path(str(Path(arg_job.args.output).resolve()) + output_suffix + output_ext).resolve()
+    else:
+        if is_split_output(arg_job):
+            arg_job.output_files.directory_path = Path(arg_job.source_file.directory_path).joinpath(arg_job.source_file.name_wo_ext)
+        else:
+            arg_job.output_files.directory_path = arg_job.source_file.directory_path
+            arg_job.output_files.full_path = Path(str(arg_job.source_file.full_path_wo_ext) + output_suffix + output_ext).resolve()
+
+
+
+def get_output_list(arg_job):
+    if is_split_output(arg_job):
+        return arg_job.new_apk_list
+    return [arg_job.output_files.full_path]
+
+
+
+def get_install_devices():
+    # serials from '--devices' argument or all the devices connected to adb
+    try:
         command_output = subprocess.run(['adb', '--version'], stdout=subprocess.PIPE).stdout.decode('utf-8')
-        if 'debug' in command_output.lower():
-            if source_file.ext.lower() == '.xapk':
-                log_info(f'Installing the rebuilded apk files:')
-                command = ['adb', 'install-multiple']
-                for single_apk in new_apk_list:
-                    print(f'{colors.WARNING}{single_apk}{colors.ENDC}')
-                    command.append(str(single_apk))
-                subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
-            else:
-                log_info(f'Installing the rebuilded .apk file {colors.WARNING}{output_files.full_path}')
-                command = ['adb', 'install', str(output_files.full_path)]
-                subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr)
+    except OSError:
+        command_output = ''
+    if 'debug' not in command_output.lower():
+        log_err("adb not found, unable to execute the 'adb install' command")
+        return []
+    if args.devices:
+        return [serial.strip() for serial in args.devices.split(',') if serial.strip()]
+    devices = []
+    command_output = subprocess.run(['adb', 'devices'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8', errors='replace')
+    for line in command_output.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        if fields[1] == 'device':
+            devices.append(fields[0])
         else:
-            log_err("adb not found, unable to execute the 'adb install' command")
-    
-    if source_file.ext.lower() == '.xapk':
+            log_warn(f'Device {fields[0]} is {fields[1]}, the files are not installed on it')
+    return devices
+
+
+
+def install_on_device(arg_job, arg_serial, arg_apk_list):
+    # adb install (or install-multiple for the splits) on the single device, the errors of adb are retried
+    file_name = arg_job.source_file.full_path.name
+    command = ['adb', '-s', arg_serial, 'install-multiple' if len(arg_apk_list) > 1 else 'install'] + [str(apk) for apk in arg_apk_list]
+    result = {'device': arg_serial, 'status': 'failed', 'attempts': 0, 'duration': 0, 'error': None}
+    start_time = time.perf_counter()
+    try:
+        with phase(arg_job, 'install', file=file_name, device=arg_serial) as event:
+            while True:
+                result['attempts'] += 1
+                event['attempts'] = result['attempts']
+                log_info(f'Installing {colors.WARNING}{file_name}{colors.OKBLUE} on {colors.WARNING}{arg_serial}' + (f'{colors.OKBLUE}, attempt {result["attempts"]}' if result['attempts'] > 1 else ''))
+                try:
+                    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    # adb is removed or can't be started, the next attempt gives the same result
+                    result['error'] = f'unable to run adb: {e}'
+                    raise rebuild_error(result['error'])
+                output = process.stdout.decode('utf-8', errors='replace')
+                get_log_stream().write(output)
+                if process.returncode == 0 and 'Failure' not in output:
+                    break
+                output_lines = output.strip().splitlines()
+                result['error'] = output_lines[-1] if output_lines else f'adb failed with exit code {process.returncode}'
+                # the package manager rejected the file (INSTALL_FAILED_*, INSTALL_PARSE_FAILED_*), the next attempt gives the same result
+                if re.search(r'INSTALL_(PARSE_)?FAILED_|Failure \[', output) or result['attempts'] >= install_attempts:
+                    raise rebuild_error(result['error'])
+                log_warn(f'Unable to install {file_name} on {arg_serial} ({result["error"]}), retrying in {install_retry_delay * result["attempts"]} seconds')
+                time.sleep(install_retry_delay * result['attempts'])
+        result['status'] = 'done'
+        result['error'] = None
+        log_succ(f'{file_name} installed on {arg_serial} in {time.perf_counter() - start_time:.1f} seconds')
+    except rebuild_error as e:
+        log_err(f'Unable to install {file_name} on {arg_serial}: {e}')
+    finally:
+        result['duration'] = round(time.perf_counter() - start_time, 3)
+        arg_job.installs.append(result)
+    return result['status'] == 'done'
+
+
+
+def start_install(arg_job):
+    # the installs are queued to the executors of the devices, wait_installs() waits for them
+    apk_list = get_output_list(arg_job)
+    if not installer.devices:
+        log_err(f'No devices to install the rebuilded files, use --devices argument or connect the device')
+        arg_job.installs.append({'device': None, 'status': 'failed', 'attempts': 0, 'duration': 0, 'error': 'no devices'})
+        return
+    log_info(f'Installing the rebuilded .apk file(s) on {len(installer.devices)} device(s): {colors.WARNING}{", ".join(installer.devices)}')
+    with installer.lock:
+        for serial in installer.devices:
+            if serial not in installer.executors:
+                installer.executors[serial] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            installer.futures.append(installer.executors[serial].submit(run_with_own_log, install_on_device, arg_job, serial, apk_list))
+
+
+
+def wait_installs():
+    # returns False if any install failed
+    with installer.lock:
+        futures = installer.futures
+        installer.futures = []
+    return all([future.result() for future in futures])
+
+
+
+def run_job(arg_job):
+    # processing the single source file, returns True if the file was rebuilded
+    active_jobs.append(arg_job)
+    arg_job.status = 'running'
+    # source file processing start time
+    arg_job.start_time = time.time()
+    job_start_time = time.perf_counter()
+    job_succeeded = False
+    try:
+        set_output_paths(arg_job)
+        # the device spec is needed for the cache key of .aab file
+        if is_split_output(arg_job) and arg_job.source_file.ext.lower() == '.aab':
+            load_device_spec(arg_job)
+
+        # searching for the result of the previous run in the cache, the cache is not used if the decompiled files are needed
+        use_cache = not (arg_job.args.no_cache or arg_job.args.pause or arg_job.args.preserve)
+        cached_list = None
+        if use_cache:
+            with phase(arg_job, 'cache restore') as event:
+                cache_key = get_cache_key(arg_job)
+                if is_split_output(arg_job):
+                    cached_list = cache_restore(cache_key, arg_job.output_files.directory_path)
+                else:
+                    cached_list = cache_restore(cache_key, Path(arg_job.output_files.full_path).parent, arg_job.output_files.full_path)
+                event['hit'] = cached_list != None
+        if cached_list != None:
+            if is_split_output(arg_job):
+                arg_job.new_apk_list.extend(cached_list)
+        else:
+            # the intermediate files are written to the temp directory of the job in the work directory
+            arg_job.work_dir = Path(tempfile.mkdtemp(prefix='apk-rebuild-', dir=arg_job.args.work_dir))
+            arg_job.garbage['dirs'].append(arg_job.work_dir)
+            reserve_work_space(arg_job)
+            # processing the source file depending on it extension
+            process_source_file(arg_job)
+        # the output files are signed, they are installed in the background while the job is finishing and the next files of the batch are processed
+        if arg_job.args.install:
+            start_install(arg_job)
+        if cached_list == None and use_cache:
+            with phase(arg_job, 'cache store'):
+                cache_store(arg_job, cache_key, get_output_list(arg_job))
+        job_succeeded = True
+    except rebuild_error as e:
+        log_err(e)
+        log_warn('Removing temp files and directories')
+        clean_garbage(arg_job)
+        arg_job.status = 'failed'
+        arg_job.error = str(e)
+        return False
+    finally:
+        active_jobs.remove(arg_job)
+        release_work_space(arg_job)
+        if arg_job.work_dir != None:
+            shutil.rmtree(arg_job.work_dir, ignore_errors=True)
+        # logging time spent for rebuilding source file
+        arg_job.time_sum += (time.time() - arg_job.start_time)
+        record_event(arg_job, {'type': 'phase', 'name': 'job', 'start': job_start_time - trace.start_time, 'wall': arg_job.time_sum, 'status': 'done' if job_succeeded else 'failed'})
+    arg_job.status = 'done'
+    log_succ(f'Rebuilded in {int(arg_job.time_sum)} seconds')
+    phases = get_phases_summary(arg_job)
+    phases.pop('job', None)
+    if phases:
+        log_info('Phases: ' + ', '.join(f'{name} {wall:.1f} s' for name, wall in phases.items()))
+
+    # check and removing the source file
+    if arg_job.args.remove:
+        log_info(f'Removing the source file {colors.WARNING}{arg_job.source_file.full_path}')
+        arg_job.source_file.full_path.unlink()
+
+    # the files of the service are downloaded by the client
+    if arg_job.service != None:
+        return True
+    if is_split_output(arg_job):
         str_apk_list = ''
-        for single_apk in new_apk_list:
+        for single_apk in arg_job.new_apk_list:
             str_apk_list += f'"{str(single_apk)}" '
         log_info(f'Command for installing: {colors.OKGREEN}adb install-multiple {str_apk_list}')
     else:
-        log_info(f'Command for installing: {colors.OKGREEN}adb install "{str(output_files.full_path)}"')
+        log_info(f'Command for installing: {colors.OKGREEN}adb install "{str(arg_job.output_files.full_path)}"')
+    return True
+
+
+
+def get_source_files(arg_patterns):
+    # directories and glob patterns are expanded to the list of the supported files
+    source_files = []
+    for pattern in arg_patterns:
+        if Path(pattern).is_dir():
+            paths = sorted(Path(pattern).iterdir())
+        elif Path(pattern).exists():
+            paths = [Path(pattern)]
+        else:
+            paths = sorted(Path(path) for path in glob.glob(pattern))
+        for path in paths:
+            if path.is_file() and path.suffix.lower() in source_exts and path.resolve() not in source_files:
+                source_files.append(path.resolve())
+    return source_files
+
+
+
+def get_available_memory():
+    # available memory in bytes or None if it can't be detected
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+
+def get_batch_workers():
+    # parallel jobs are limited by '--jobs' argument (CPU count by default), the tools of the jobs wait for the memory budget
+    workers = args.jobs if args.jobs else os.cpu_count() or 1
+    if args.pause:
+        workers = 1
+    return workers
+
+
+
+def run_batch_job(arg_job):
+    # broken source file must not stop the batch
+    try:
+        run_job(arg_job)
+    except Exception as e:
+        log_err(f'Unable to process the file {arg_job.source_file.full_path}: {e}')
+        clean_garbage(arg_job)
+        arg_job.status = 'failed'
+        arg_job.error = str(e)
+
+
+
+def get_batch_output_key(arg_job):
+    # the output file and the output directory of the splits are named by set_output_paths() after the source file (or '--output' argument of the job),
+    # the jobs with the same key would overwrite the output of each other
+    output_path = Path(arg_job.args.output).resolve() if arg_job.args.output != None else arg_job.source_file.full_path_wo_ext
+    output_key = str(output_path) if is_split_output(arg_job) else str(output_path) + output_suffix + output_ext
+    return output_key.lower() if sys.platform in ['darwin', 'win32'] else output_key
+
+
+
+def set_batch_output_names(arg_batch_jobs):
+    # the source files with the same name (e.g. app.apk and app.aab, or app.apk from two directories with '-o' argument) get the output names
+    # with the extension (app.aab-patched.apk) and then with the parent directory (dir1-app.apk-patched.apk), the jobs which still collide are failed
+    colliding_jobs = arg_batch_jobs
+    for level in range(3):
+        jobs_by_key = {}
+        for single_job in colliding_jobs:
+            jobs_by_key.setdefault(get_batch_output_key(single_job), []).append(single_job)
+        colliding_jobs = [single_job for key_jobs in jobs_by_key.values() if len(key_jobs) > 1 for single_job in key_jobs]
+        if not colliding_jobs:
+            return
+        if level == 2:
+            break
+        for single_job in colliding_jobs:
+            source_full_path = single_job.source_file.full_path
+            output_name = source_full_path.name if level == 0 else f'{source_full_path.parent.name}-{source_full_path.name}'
+            # the directory of the splits must not get the name of the source file next to it
+            if is_split_output(single_job) and args.output == None:
+                output_name += output_suffix
+            single_job.args.output = str(Path(args.output or source_full_path.parent).joinpath(output_name))
+    for single_job in colliding_jobs:
+        single_job.status = 'failed'
+        single_job.error = f'The output path {get_batch_output_key(single_job)} is the same for several source files, rename the file or process it separately'
+        log_err(f'Unable to process the file {single_job.source_file.full_path}: {single_job.error}')
+
+
+
+def run_batch(arg_source_files):
+    workers = get_batch_workers()
+    log_info(f'Batch mode: {len(arg_source_files)} files, {workers} parallel jobs')
+    batch_jobs = []
+    for single_file in arg_source_files:
+        # every job has own arguments, .apk files from .xapk are processed one by one inside the job
+        job_args = argparse.Namespace(**vars(args))
+        job_args.jobs = 1
+        if args.output != None:
+            job_args.output = str(Path(args.output).joinpath(single_file.stem))
+        batch_jobs.append(job(job_args, single_file))
+    set_batch_output_names(batch_jobs)
+
+    batch_start_time = time.time()
+    queued_jobs = [single_job for single_job in batch_jobs if single_job.status == 'queued']
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        if workers > 1:
+            list(executor.map(lambda single_job: run_with_own_log(run_batch_job, single_job), queued_jobs))
+        else:
+            list(executor.map(run_batch_job, queued_jobs))
+    installs_succeeded = wait_installs()
+
+    # machine-readable summary of the batch
+    summary = {
+        'duration': round(time.time() - batch_start_time, 3),
+        'succeeded': len([single_job for single_job in batch_jobs if single_job.status == 'done']),
+        'failed': len([single_job for single_job in batch_jobs if single_job.status != 'done']),
+        'files': [{
+            'source_file': str(single_job.source_file.full_path),
+            'status': single_job.status,
+            'duration': round(single_job.time_sum, 3),
+            'phases': get_phases_summary(single_job),
+            'output_files': [str(output_file) for output_file in get_output_list(single_job)] if single_job.status == 'done' else [],
+            'installs': single_job.installs,
+            'dex_index': single_job.dex_index,
+            'error': single_job.error
+        } for single_job in batch_jobs]
+    }
+    summary_full_path = Path(args.summary or Path(args.output or '.').joinpath('apk-rebuild-summary.json')).resolve()
+    summary_full_path.parent.mkdir(parents=True, exist_ok=True)
+    summary_full_path.write_text(json.dumps(summary, indent=4), encoding='utf-8')
+
+    for single_job in batch_jobs:
+        if single_job.status == 'done':
+            log_succ(f'{single_job.source_file.full_path} rebuilded in {int(single_job.time_sum)} seconds')
+        else:
+            log_err(f'{single_job.source_file.full_path} failed: {single_job.error}')
+    log_info(f'Batch finished in {int(summary["duration"])} seconds: {summary["succeeded"]} succeeded, {summary["failed"]} failed. Summary: {colors.WARNING}{summary_full_path}')
+    return summary['failed'] == 0 and installs_succeeded
+
+
+
+def parse_service_address(arg_address):
+    # Unix socket path or [HOST:]PORT, the service is available only for the local clients by default
+    address = re.sub(r'^(http://|unix:)', '', arg_address)
+    if '/' in address or os.sep in address or address.endswith('.sock'):
+        return ('unix', str(Path(address).resolve()))
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ValueError(f'invalid address of the service {arg_address}, use [HOST:]PORT or the path of Unix socket')
+    return ('tcp', host or '127.0.0.1', int(port))
+
+
+
+def get_job_info(arg_job):
+    return {
+        'id': arg_job.service['id'],
+        'file': arg_job.source_file.full_path.name,
+        'status': arg_job.status,
+        'error': arg_job.error,
+        'queue_time': round((arg_job.service['start_time'] or time.time()) - arg_job.service['submit_time'], 3),
+        'duration': round(arg_job.time_sum, 3),
+        'phases': get_phases_summary(arg_job),
+        'output_files': [Path(output_file).name for output_file in get_output_list(arg_job)] if arg_job.status == 'done' else []
+    }
+
+
+
+def get_service_metrics():
+    # queue depth, the counters of the jobs and the latency of every phase (seconds) of the last finished jobs
+    with service.condition:
+        phases = {}
+        for name, samples in service.phase_samples.items():
+            values = sorted(samples)
+            phases[name] = {
+                'count': len(values),
+                'mean': round(sum(values) / len(values), 3),
+                'p50': round(values[int(0.5 * (len(values) - 1))], 3),
+                'p95': round(values[int(0.95 * (len(values) - 1))], 3),
+                'max': round(values[-1], 3)
+            }
+        return {
+            'uptime': round(time.time() - service.start_time, 3),
+            'workers': service.workers,
+            'queued': len([single_job for single_job in service.jobs.values() if single_job.status == 'queued']),
+            'running': len([single_job for single_job in service.jobs.values() if single_job.status == 'running']),
+            'jobs': dict(service.counters),
+            'cds_saved_time': round(tools.cds_saved_time, 3),
+            'phases': phases
+        }
+
+
+
+def remove_service_job(arg_job):
+    # must be called with service.condition acquired
+    service.jobs.pop(arg_job.service['id'], None)
+    shutil.rmtree(arg_job.service['dir'], ignore_errors=True)
+
+
+
+def service_worker():
+    # the workers share the checked tools, the loaded signing key and AppCDS archives, every job writes the log to its own file
+    while True:
+        single_job = service.queue.get()
+        # the unexpected error of the single job must not stop the worker, the pool would lose it for the life of the service
+        try:
+            run_service_job(single_job)
+        except Exception as e:
+            log_err(f"Job {single_job.service['id']} failed: {e}")
+            with service.condition:
+                if not single_job.service['finished'] and single_job.status != 'cancelled':
+                    single_job.status = 'failed'
+                    single_job.error = single_job.error or str(e)
+                    single_job.service['finished'] = True
+                    service.counters['failed'] += 1
+                service.condition.notify_all()
+
+
+
+def run_service_job(arg_job):
+    with service.condition:
+        if arg_job.status == 'cancelled':
+            return
+        # the job is running since it's taken from the queue, DELETE must not remove its directory before run_job() starts
+        arg_job.status = 'running'
+        arg_job.service['start_time'] = time.time()
+    with open(arg_job.service['log_path'], 'w', encoding='utf-8', buffering=1) as log_file:
+        log_stream.file = log_file
+        try:
+            run_batch_job(arg_job)
+        finally:
+            del log_stream.file
+    with service.condition:
+        arg_job.service['finished'] = True
+        service.counters['done' if arg_job.status == 'done' else 'failed'] += 1
+        samples = [('queue', arg_job.service['start_time'] - arg_job.service['submit_time'])]
+        samples += [(event['name'] if event['type'] == 'phase' else f"tool: {event['name']}", event['wall']) for event in arg_job.events if event['type'] in ['phase', 'process']]
+        for name, wall in samples:
+            service.phase_samples.setdefault(name, []).append(wall)
+            del service.phase_samples[name][:-service.max_samples]
+        finished_jobs = [other_job for other_job in service.jobs.values() if other_job.service['finished']]
+        for old_job in finished_jobs[:-service.max_finished_jobs]:
+            remove_service_job(old_job)
+        service.condition.notify_all()
+    log_info(f"Job {arg_job.service['id']} ({arg_job.source_file.full_path.name}) {arg_job.status} in {arg_job.time_sum:.1f} seconds")
+
+
+
+def get_service_handler():
+    # http.server is imported only in service mode
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    class service_handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *arg_args):
+            log_info(f'{self.command} {self.path}')
+
+        def send_json(self, arg_code, arg_data):
+            body = json.dumps(arg_data, indent=4).encode('utf-8')
+            self.send_response(arg_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def get_job(self, arg_id):
+            with service.condition:
+                single_job = service.jobs.get(arg_id)
+            if single_job == None:
+                self.send_json(404, {'error': f'job {arg_id} not found'})
+            return single_job
+
+        def do_POST(self):
+            # the file is sent as the request body, the name of the file and the options are passed in the query string
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if url.path != '/jobs':
+                return self.send_json(404, {'error': f'{url.path} not found'})
+            file_name = Path(query.get('name', [''])[0]).name
+            if Path(file_name).suffix.lower() not in source_exts:
+                return self.send_json(400, {'error': 'name of .apk, .aab or .xapk file is required'})
+            try:
+                length = int(self.headers['Content-Length'])
+            except (TypeError, ValueError):
+                return self.send_json(411, {'error': 'Content-Length is required'})
+            if length > shutil.disk_usage(service.storage_path).free:
+                return self.send_json(507, {'error': 'not enough free space for the file'})
+
+            job_id = os.urandom(6).hex()
+            job_dir = service.storage_path.joinpath(job_id)
+            job_dir.mkdir()
+            source_full_path = job_dir.joinpath(file_name)
+            with open(source_full_path, 'wb') as source_file:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, 1024 * 1024))
+                    if not chunk:
+                        break
+                    source_file.write(chunk)
+                    length -= len(chunk)
+            if length > 0:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                return self.send_json(400, {'error': 'the file is not received completely'})
+
+            # every job has own arguments like in batch mode, the options which change the files outside of the job directory are not used
+            job_args = argparse.Namespace(**vars(args))
+            job_args.jobs = 1
+            job_args.output = str(job_dir.joinpath('output', source_full_path.stem))
+            for name in ['install', 'pause', 'preserve', 'incremental', 'remove']:
+                setattr(job_args, name, False)
+            for name, value in service.job_options.items():
+                if name in query:
+                    setattr(job_args, name, value if query[name][0].lower() in ['1', 'true', 'yes'] else (None if isinstance(value, str) else False))
+            single_job = job(job_args, source_full_path)
+            single_job.service = {'id': job_id, 'dir': job_dir, 'log_path': job_dir.joinpath('log.txt'), 'submit_time': time.time(), 'start_time': None, 'finished': False}
+            single_job.service['log_path'].touch()
+            with service.condition:
+                service.jobs[job_id] = single_job
+                position = len([other_job for other_job in service.jobs.values() if other_job.status == 'queued'])
+            service.queue.put(single_job)
+            self.send_json(202, {'id': job_id, 'status': 'queued', 'position': position})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            parts = [part for part in url.path.split('/') if part]
+            if parts == ['metrics']:
+                return self.send_json(200, get_service_metrics())
+            if parts == ['jobs']:
+                with service.condition:
+                    jobs_info = [get_job_info(single_job) for single_job in service.jobs.values()]
+                return self.send_json(200, jobs_info)
+            if len(parts) < 2 or parts[0] != 'jobs':
+                return self.send_json(404, {'error': f'{url.path} not found'})
+            single_job = self.get_job(parts[1])
+            if single_job == None:
+                return
+            if len(parts) == 2:
+                # '?wait=1' waits until the job is finished
+                with service.condition:
+                    if query.get('wait', ['0'])[0] in ['1', 'true', 'yes']:
+                        service.condition.wait_for(lambda: single_job.service['finished'] or single_job.status == 'cancelled')
+                    job_info = get_job_info(single_job)
+                return self.send_json(200, job_info)
+            if parts[2:] == ['log']:
+                return self.send_log(single_job)
+            if len(parts) == 4 and parts[2] == 'files':
+                return self.send_output_file(single_job, parts[3])
+            self.send_json(404, {'error': f'{url.path} not found'})
+
+        def send_log(self, arg_job):
+            # the log is streamed while the job is processed, the response is finished when the job is finished
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            with open(arg_job.service['log_path'], 'rb') as log_file:
+                while True:
+                    with service.condition:
+                        finished = arg_job.service['finished'] or arg_job.status == 'cancelled'
+                    chunk = log_file.read(64 * 1024)
+                    if chunk:
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                    elif finished:
+                        break
+                    else:
+                        with service.condition:
+                            service.condition.wait(0.2)
+
+        def send_output_file(self, arg_job, arg_name):
+            output_list = get_output_list(arg_job) if arg_job.status == 'done' else []
+            output_full_path = next((Path(output_file) for output_file in output_list if Path(output_file).name == arg_name), None)
+            if output_full_path == None:
+                return self.send_json(404, {'error': f'file {arg_name} not found'})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.android.package-archive')
+            self.send_header('Content-Length', str(output_full_path.stat().st_size))
+            self.send_header('Content-Disposition', f'attachment; filename="{arg_name}"')
+            self.end_headers()
+            with open(output_full_path, 'rb') as output_file:
+                shutil.copyfileobj(output_file, self.wfile, 1024 * 1024)
+
+        def do_DELETE(self):
+            # the queued job is cancelled, the files of the finished job are removed
+            parts = [part for part in urlsplit(self.path).path.split('/') if part]
+            if len(parts) != 2 or parts[0] != 'jobs':
+                return self.send_json(404, {'error': f'{self.path} not found'})
+            single_job = self.get_job(parts[1])
+            if single_job == None:
+                return
+            with service.condition:
+                running = single_job.status == 'running'
+                if not running:
+                    if single_job.status == 'queued':
+                        single_job.status = 'cancelled'
+                        service.counters['cancelled'] += 1
+                    remove_service_job(single_job)
+                    service.condition.notify_all()
+            if running:
+                return self.send_json(409, {'error': 'the job is running'})
+            self.send_json(200, {'id': parts[1], 'status': 'removed'})
+
+    return service_handler
+
+
+
+def run_service():
+    # the tools are checked once, the jobs are processed by the fixed pool of workers
+    import socketserver, queue
+    from http.server import ThreadingHTTPServer
+    address = parse_service_address(args.serve)
+    service.workers = get_batch_workers()
+    service.queue = queue.Queue()
+    service.start_time = time.time()
+    temp_storage = args.output == None
+    service.storage_path = Path(args.output).resolve() if args.output else Path(tempfile.mkdtemp(prefix='apk-rebuild-service-', dir=args.work_dir))
+    service.storage_path.mkdir(parents=True, exist_ok=True)
+
+    if address[0] == 'unix':
+        class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+        Path(address[1]).unlink(missing_ok=True)
+        server = unix_http_server(address[1], get_service_handler())
+        address_name = f'unix:{address[1]}'
+    else:
+        server = ThreadingHTTPServer((address[1], address[2]), get_service_handler())
+        address_name = f'http://{address[1]}:{address[2]}'
+    for i in range(service.workers):
+        threading.Thread(target=service_worker, name=f'worker-{i + 1}', daemon=True).start()
+    log_info(f'Service is started on {colors.WARNING}{address_name}{colors.OKBLUE}, {service.workers} workers, files are stored in {colors.WARNING}{service.storage_path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if address[0] == 'unix':
+            Path(address[1]).unlink(missing_ok=True)
+        if temp_storage:
+            shutil.rmtree(service.storage_path, ignore_errors=True)
+
+
+
+def get_service_connection(arg_address):
+    import http.client, socket
+    address = parse_service_address(arg_address)
+    if address[0] == 'tcp':
+        return http.client.HTTPConnection(address[1], address[2])
+
+    class unix_connection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address[1])
+    return unix_connection('localhost')
+
+
+
+def service_request(arg_method, arg_path, arg_body=None, arg_headers={}):
+    # the new connection for every request, the service closes it after the response
+    connection = get_service_connection(args.server)
+    connection.request(arg_method, arg_path, body=arg_body, headers=arg_headers)
+    return connection.getresponse()
+
+
+
+def submit_to_service(arg_job):
+    # sending the file to the service, printing the log of the job and downloading the rebuilded files
+    from urllib.parse import quote
+    set_output_paths(arg_job)
+    options = ''.join(f'&{name}=1' for name in service.job_options if getattr(arg_job.args, name))
+    log_info(f'Sending {colors.WARNING}{arg_job.source_file.full_path}{colors.OKBLUE} to the service {colors.WARNING}{args.server}')
+    with open(arg_job.source_file.full_path, 'rb') as source_file:
+        response = service_request('POST', f'/jobs?name={quote(arg_job.source_file.full_path.name)}{options}', source_file, {'Content-Length': str(arg_job.source_file.full_path.stat().st_size)})
+        result = json.loads(response.read())
+    if response.status != 202:
+        raise rebuild_error(f"The service didn't accept the file: {result.get('error')}")
+    job_path = f"/jobs/{result['id']}"
+    log_info(f"Job {result['id']} is queued, position {result['position']}")
+
+    response = service_request('GET', job_path + '/log')
+    while chunk := response.read1(64 * 1024):
+        get_log_stream().write(chunk.decode('utf-8', errors='replace'))
+        get_log_stream().flush()
+    info = json.loads(service_request('GET', job_path + '?wait=1').read())
+    if info['status'] != 'done':
+        service_request('DELETE', job_path).read()
+        raise rebuild_error(f"The service failed to rebuild the file: {info['error']}")
+
+    # the files are downloaded to the temp files and renamed to be never read partially
+    for name in info['output_files']:
+        # several files are saved to the output directory, e.g. the splits of .aab file built by the service for its device spec
+        output_full_path = Path(arg_job.output_files.directory_path).joinpath(name) if is_split_output(arg_job) or len(info['output_files']) > 1 else Path(arg_job.output_files.full_path)
+        output_full_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_full_path = Path(f'{output_full_path}.{os.getpid()}.tmp')
+        arg_job.garbage['files'].append(temp_full_path)
+        response = service_request('GET', f'{job_path}/files/{quote(name)}')
+        if response.status != 200:
+            raise rebuild_error(f'Unable to download {name} from the service')
+        with open(temp_full_path, 'wb') as output_file:
+            shutil.copyfileobj(response, output_file, 1024 * 1024)
+        os.replace(temp_full_path, output_full_path)
+        arg_job.garbage['files'].remove(temp_full_path)
+        arg_job.new_apk_list.append(output_full_path)
+        log_info(f'Saved {colors.WARNING}{output_full_path}')
+    service_request('DELETE', job_path).read()
+
+
+
+def run_client(arg_source_files):
+    # the files are rebuilded by the service one by one, the output paths are the same as for the local processing
+    failed = 0
+    for single_file in arg_source_files:
+        job_args = argparse.Namespace(**vars(args))
+        if args.output != None and len(arg_source_files) > 1:
+            job_args.output = str(Path(args.output).joinpath(Path(single_file).stem))
+        single_job = job(job_args, single_file)
+        try:
+            submit_to_service(single_job)
+        except (rebuild_error, OSError, ValueError) as e:
+            log_err(f'Unable to process the file {single_job.source_file.full_path} by the service: {e}')
+            clean_garbage(single_job)
+            failed += 1
+    return failed == 0
+
+
+
+def main():
+    # handle Ctrl+C
+    signal(SIGINT, handle_exit)
+
+    # parse script arguments, '--version' and '--help' are processed here
+    parser = argparse.ArgumentParser(description='The script allows to bypass SSL pinning on Android >= 7 via rebuilding the APK file and making the user credential storage trusted. After processing the output APK file is ready for HTTPS traffic inspection.')
+    parser.add_argument('source_file', metavar='file', nargs='*', help='path to .apk, .aab or .xapk file for rebuilding, several files, directories or glob patterns for batch mode')
+    parser.add_argument('-v', '--version', action='version', version=f'%(prog)s {script_version}')
+    parser.add_argument('-i', '--install', action='store_true', help='install the rebuilded .apk file(s) via adb on all connected devices')
+    parser.add_argument('--devices', help='comma-separated serials of the devices for installing the rebuilded .apk file(s), implies --install')
+    parser.add_argument('--pause', action='store_true', help='pause the script execution before the building the output .apk')
+    parser.add_argument('-p', '--preserve', action='store_true', help='preserve the unpacked content of the .apk file(s)')
+    parser.add_argument('-r', '--remove', action='store_true', help='remove the source file (.apk, .aab or .xapk) after the rebuilding')
+    parser.add_argument('-o', '--output', help='output .apk file name or output directory path (for .xapk source file and batch mode)')
+    parser.add_argument('--incremental', action='store_true', help='reuse the decompiled directory preserved by the previous run for the same .apk file, implies --preserve')
+    parser.add_argument('--no-src', action='store_const', const='--no-src', help='use --no-src option when decompiling via apktool')
+    parser.add_argument('--only-main-classes', action='store_const', const='--only-main-classes', help='use --only-main-classes option when decompiling via apktool')
+    parser.add_argument('--only-pinning-dex', action='store_true', help='decompile to smali only the .dex files which reference SSL pinning types (OkHttp CertificatePinner, X509TrustManager etc.), the other .dex files are left as is')
+    parser.add_argument('--ks', help='use custom .keystore file for .aab decoding and .apk signing')
+    parser.add_argument('--ks-pass', help='password of the custom keystore')
+    parser.add_argument('--ks-alias', help='key (alias) in the custom keystore')
+    parser.add_argument('--ks-alias-pass', help='password for key (alias) in the custom keystore')
+    parser.add_argument('--jar-signer', action='store_true', help='sign the .apk files with uber-apk-signer instead of the built-in signer')
+    parser.add_argument('--no-decompile', action='store_true', help='patch binary AndroidManifest.xml and resources.arsc without decompiling via apktool, apktool is used if it\'s not possible')
+    parser.add_argument('--device-spec', help='build the splits for the device spec from .aab file instead of the universal .apk file, only the base split is rebuilded, DEVICE_SPEC is .json file or \'device\' to read it from the connected device')
+    parser.add_argument('--work-dir', help='directory for the intermediate files (decompiled and extracted files), e.g. /dev/shm (default: system temp directory)')
+    parser.add_argument('--no-cds', action='store_true', help='do not use AppCDS archives for faster startup of apktool, bundletool and uber-apk-signer')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the cache of the rebuilded files')
+    parser.add_argument('--cache-size', type=int, default=2048, help='maximum size of the cache of the rebuilded files in MB (default: 2048)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of .apk files from .xapk (or source files in batch mode) processed in parallel, 0 - number of CPU cores (default: 1, number of CPU cores in batch mode)')
+    parser.add_argument('--trace', help='save the phases of the processing and the launched tools to .json file in Chrome trace format (can be opened in Perfetto UI)')
+    parser.add_argument('--metrics', help='save the phases of the processing and the launched tools to .jsonl file, one JSON object per line')
+    parser.add_argument('--summary', help='path of .json file with the results of batch mode (default: apk-rebuild-summary.json in the output directory)')
+    parser.add_argument('--serve', metavar='ADDRESS', help='run the service which rebuilds the files sent via HTTP, ADDRESS is [HOST:]PORT (127.0.0.1 by default) or the path of Unix socket, -o is the directory for the files of the jobs')
+    parser.add_argument('--server', metavar='ADDRESS', help='send the file(s) to the service started with --serve instead of rebuilding them locally')
+    global args
+    args = parser.parse_args()
+    if not args.source_file and not args.serve:
+        parser.error('the following arguments are required: file')
+    init_colors()
+
+    # processing '--incremental' argument, the decompiled directory is preserved for the next run
+    if args.incremental:
+        args.preserve = True
+
+    # processing '--devices' argument
+    if args.devices:
+        args.install = True
+
+    # processing '--only-pinning-dex' argument
+    if args.only_pinning_dex and args.no_src:
+        log_warn('Argument --no-src disables decompiling of all .dex files, ignoring --only-pinning-dex argument')
+        args.only_pinning_dex = False
+
+    # processing '--no-decompile' argument
+    if args.no_decompile and (args.pause or args.preserve):
+        log_warn('Arguments --pause and --preserve require the decompiled .apk file, ignoring --no-decompile argument')
+        args.no_decompile = False
+
+    # processing '--work-dir' argument, the system temp directory is used by default
+    args.work_dir = str(Path(args.work_dir or tempfile.gettempdir()).resolve())
+    try:
+        Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        log_err(f'Unable to create the work directory {args.work_dir}: {e}')
+        exit_script(1)
+
+    # processing '--serve' and '--server' arguments, the service processes the files in parallel like batch mode
+    try:
+        for address in [args.serve, args.server]:
+            if address != None:
+                parse_service_address(address)
+    except ValueError as e:
+        log_err(e)
+        exit_script(1)
+    if args.serve and (args.pause or args.install):
+        log_warn('Arguments --pause and --install are not supported by the service, ignoring them')
+        args.pause = args.install = False
+    if args.server and args.install:
+        log_warn('Argument --install is not supported with --server, install the downloaded files with adb')
+        args.install = False
+    if args.server and args.device_spec != None:
+        log_warn('Argument --device-spec is not supported with --server, the service uses its own --device-spec argument')
+        args.device_spec = None
+
+    # processing '--jobs' argument
+    batch_mode = bool(args.serve) or len(args.source_file) > 1 or Path(args.source_file[0]).is_dir() or not Path(args.source_file[0]).exists() and glob.has_magic(args.source_file[0])
+    if args.jobs == None:
+        args.jobs = 0 if batch_mode else 1
+    elif args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+    if args.jobs != 1 and args.pause:
+        log_warn('Argument --pause is not supported for parallel processing, processing the files one by one')
+        args.jobs = 1
+
+    log_info(f'Script version: {script_version}')
+    log_info(f'Python version: {sys.version}')
+
+    if args.serve:
+        source_files = []
+    elif batch_mode:
+        source_files = get_source_files(args.source_file)
+        if not source_files:
+            log_err('No .apk, .aab or .xapk files found, stopping the script')
+            exit_script(1)
+    # stop script if source file doesn't exists
+    elif not Path(args.source_file[0]).resolve().exists():
+        log_err(f'File {Path(args.source_file[0]).resolve()} not found, stopping the script')
+        exit_script(1)
+
+    # the tools are not needed to send the files to the service
+    if args.server:
+        exit_script(0 if run_client(source_files if batch_mode else [Path(args.source_file[0]).resolve()]) else 1)
+
+    # check if all necessary tools are available
+    with phase(None, 'check tools'):
+        check_tools()
+
+    # the devices for '--install' argument are detected once
+    if args.install:
+        installer.devices = get_install_devices()
+
+    if args.serve:
+        # the service is stopped by CTRL-C
+        run_service()
+        succeeded = True
+    elif batch_mode:
+        succeeded = run_batch(source_files)
+    else:
+        succeeded = run_job(job(args, args.source_file[0]))
+        succeeded = wait_installs() and succeeded
+    if tools.cds_saved_time:
+        log_info(f'AppCDS archives saved {tools.cds_saved_time:.1f} seconds of JVM startup')
+    if args.trace:
+        save_trace(args.trace)
+    if args.metrics:
+        save_metrics(args.metrics)
 
     # script end
-    exit_script(0)
+    exit_script(0 if succeeded else 1)
 
 
 
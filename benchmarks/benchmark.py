@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+# benchmark of apk-rebuild.py: generates synthetic .apk, .xapk and .aab files, rebuilds them with the real tools or with the stub toolchain
+# and compares the time and memory of every phase with the stored baseline
+
+import os, sys, argparse, importlib.util, json, random, shutil, statistics, struct, subprocess, tempfile, time, zipfile, zlib, hashlib
+from pathlib import Path
+
+benchmarks_dir = Path(__file__).resolve().parent
+script_path = benchmarks_dir.parent.joinpath('apk-rebuild.py')
+stub_dir = benchmarks_dir.joinpath('stub')
+default_baseline_path = benchmarks_dir.joinpath('baseline.json')
+
+# sizes of the generated files, every parameter can be overridden by the arguments
+profiles = {
+    'small': {'resources': 50, 'resource_size': 2048, 'dex_files': 1, 'dex_size': 1024 * 1024, 'splits': 2, 'split_size': 256 * 1024, 'obb_size': 1024 * 1024},
+    'medium': {'resources': 500, 'resource_size': 4096, 'dex_files': 2, 'dex_size': 4 * 1024 * 1024, 'splits': 4, 'split_size': 2 * 1024 * 1024, 'obb_size': 16 * 1024 * 1024},
+    'large': {'resources': 3000, 'resource_size': 8192, 'dex_files': 6, 'dex_size': 8 * 1024 * 1024, 'splits': 8, 'split_size': 8 * 1024 * 1024, 'obb_size': 128 * 1024 * 1024}
+}
+
+# every source file is rebuilded in these modes
+modes = {
+    'decompile': [],
+    'no-decompile': ['--no-decompile']
+}
+
+android_ns = 'http://schemas.android.com/apk/res/android'
+package_name = 'com.example.benchmark'
+# android:label, android:minSdkVersion
+attr_label = 0x01010001
+attr_min_sdk_version = 0x0101020c
+
+
+
+def load_script():
+    # the functions of the script are used to write the binary XML and resources.arsc
+    spec = importlib.util.spec_from_file_location('apk_rebuild', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+
+ar = load_script()
+
+
+
+def random_bytes(arg_random, arg_size, arg_compressible=False):
+    # dex files are compressed by ~50% in the real .apk files, the images are not compressed at all
+    if not arg_compressible:
+        return arg_random.randbytes(arg_size)
+    half = arg_random.randbytes(arg_size // 2)
+    return half + bytes(arg_size - len(half))
+
+
+
+def zip_entry(arg_name, arg_compressed=True):
+    # the fixed date makes the generated files identical on every run
+    info = zipfile.ZipInfo(arg_name, (2020, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED if arg_compressed else zipfile.ZIP_STORED
+    return info
+
+
+
+def build_manifest(arg_split=None, arg_min_sdk=24):
+    doc = ar.axml_new()
+    nodes = doc['nodes']
+    no_index = ar.res_values.NO_INDEX
+    # the strings of the attributes with resource id must be added first
+    label = ar.axml_add_string(doc, 'label', attr_label)
+    min_sdk = ar.axml_add_string(doc, 'minSdkVersion', attr_min_sdk_version)
+    ns = ar.axml_add_string(doc, android_ns)
+    prefix = ar.axml_add_string(doc, 'android')
+
+    def start(arg_name, arg_attrs, arg_line):
+        nodes.append({'type': ar.chunk_types.XML_START_ELEMENT, 'line': arg_line, 'comment': no_index, 'ns': no_index, 'name': ar.axml_add_string(doc, arg_name), 'id_index': 0, 'class_index': 0, 'style_index': 0, 'attrs': arg_attrs})
+
+    def end(arg_name, arg_line):
+        nodes.append({'type': ar.chunk_types.XML_END_ELEMENT, 'line': arg_line, 'comment': no_index, 'ns': no_index, 'name': ar.axml_add_string(doc, arg_name)})
+
+    def string_attr(arg_ns, arg_name, arg_value):
+        value = ar.axml_add_string(doc, arg_value)
+        return {'ns': arg_ns, 'name': arg_name if isinstance(arg_name, int) else ar.axml_add_string(doc, arg_name), 'raw': value, 'type': ar.res_values.TYPE_STRING, 'data': value}
+
+    nodes.append({'type': ar.chunk_types.XML_START_NAMESPACE, 'line': 1, 'comment': no_index, 'prefix': prefix, 'uri': ns})
+    manifest_attrs = [string_attr(no_index, 'package', package_name)]
+    if arg_split:
+        manifest_attrs.append(string_attr(no_index, 'split', arg_split))
+    start('manifest', manifest_attrs, 2)
+    start('uses-sdk', [{'ns': ns, 'name': min_sdk, 'raw': no_index, 'type': ar.res_values.TYPE_INT_DEC, 'data': arg_min_sdk}], 3)
+    end('uses-sdk', 3)
+    start('application', [string_attr(ns, label, 'Benchmark')], 4)
+    end('application', 4)
+    end('manifest', 2)
+    nodes.append({'type': ar.chunk_types.XML_END_NAMESPACE, 'line': 1, 'comment': no_index, 'prefix': prefix, 'uri': ns})
+    return ar.axml_write(doc)
+
+
+
+def build_network_security_config():
+    # existing config without user certificates, the script has to patch it
+    doc = ar.axml_new()
+    root = ar.axml_append_element(doc, None, 'network-security-config')
+    elem_base = ar.axml_append_element(doc, root, 'base-config', {'cleartextTrafficPermitted': 'true'})
+    elem_trust = ar.axml_append_element(doc, elem_base, 'trust-anchors')
+    ar.axml_append_element(doc, elem_trust, 'certificates', {'src': 'system'})
+    return ar.axml_write(doc)
+
+
+
+def build_string_pool(arg_strings, arg_utf8=True):
+    pool = {'flags': ar.res_values.STRING_POOL_UTF8 if arg_utf8 else 0, 'strings': [], 'raw': [], 'style_offsets': [], 'styles': b''}
+    for value in arg_strings:
+        ar.string_pool_add(pool, value)
+    return ar.string_pool_write(pool)
+
+
+
+def build_resources(arg_types):
+    # resources.arsc with the single package and the default configuration, arg_types is {type: [(name, file path)]}
+    global_strings, key_strings, chunks = [], [], b''
+    type_names = list(arg_types)
+    for type_index, type_name in enumerate(type_names):
+        entries = arg_types[type_name]
+        type_id = type_index + 1
+        chunks += struct.pack('<HHIBBHI', ar.chunk_types.TABLE_TYPE_SPEC, 16, 16 + 4 * len(entries), type_id, 0, 0, len(entries)) + bytes(4 * len(entries))
+        offsets, data = b'', b''
+        for key, path in entries:
+            if key not in key_strings:
+                key_strings.append(key)
+            global_strings.append(path)
+            offsets += struct.pack('<I', len(data))
+            data += struct.pack('<HHIHBBI', 8, 0, key_strings.index(key), 8, 0, ar.res_values.TYPE_STRING, len(global_strings) - 1)
+        config = struct.pack('<I', 64) + bytes(60)
+        header_size = 20 + len(config)
+        chunks += struct.pack('<HHIBBHII', ar.chunk_types.TABLE_TYPE, header_size, header_size + len(offsets) + len(data), type_id, 0, 0, len(entries), header_size + len(offsets)) + config + offsets + data
+    type_pool = build_string_pool(type_names, False)
+    key_pool = build_string_pool(key_strings)
+    name = package_name.encode('utf-16-le').ljust(256, b'\x00')
+    package = struct.pack('<HHII', ar.chunk_types.TABLE_PACKAGE, 288, 288 + len(type_pool) + len(key_pool) + len(chunks), 0x7f) + name + struct.pack('<IIIII', 288, len(type_names), 288 + len(type_pool), len(key_strings), 0) + type_pool + key_pool + chunks
+    global_pool = build_string_pool(global_strings)
+    return struct.pack('<HHII', ar.chunk_types.TABLE, 12, 12 + len(global_pool) + len(package), 1) + global_pool + package
+
+
+
+def build_dex(arg_random, arg_size, arg_index):
+    # dex header with the string table, the rest of the file is the filler
+    strings = [f'Lcom/example/benchmark/Class{arg_index}_{i};' for i in range(100)] + ['Ljava/lang/Object;', 'Landroid/app/Activity;']
+    header_size = 0x70
+    string_data = b''
+    string_offsets = []
+    data_offset = header_size + 4 * len(strings)
+    for value in strings:
+        string_offsets.append(data_offset + len(string_data))
+        string_data += bytes([len(value)]) + value.encode('utf-8') + b'\x00'
+    body = struct.pack(f'<{len(strings)}I', *string_offsets) + string_data
+    body += random_bytes(arg_random, max(0, arg_size - header_size - len(body)), True)
+    file_size = header_size + len(body)
+    # file size, header size, endian tag, link, map, string ids, type, proto, field, method and class ids (empty), data
+    header = struct.pack('<20I', file_size, header_size, 0x12345678, 0, 0, 0, len(strings), header_size, *[0] * 10, file_size - data_offset, data_offset)
+    signed = header + body
+    signature = hashlib.sha1(signed).digest()
+    checksum = zlib.adler32(signature + signed)
+    return b'dex\n035\x00' + struct.pack('<I', checksum) + signature + signed
+
+
+
+def write_apk(arg_path, arg_params, arg_random, arg_with_config, arg_prefix='', arg_split=None):
+    # the same files are used for .apk, the base of .xapk and the base module of .aab (with the prefixes of the module)
+    types = {'drawable': [], 'xml': [('file_paths', 'res/xml/file_paths.xml')]}
+    with zipfile.ZipFile(arg_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        zip_out.writestr(zip_entry(arg_prefix.replace('base/', 'base/manifest/') + 'AndroidManifest.xml'), build_manifest(arg_split))
+        for i in range(arg_params['dex_files']):
+            dex_name = 'classes.dex' if i == 0 else f'classes{i + 1}.dex'
+            zip_out.writestr(zip_entry(arg_prefix.replace('base/', 'base/dex/') + dex_name), build_dex(arg_random, arg_params['dex_size'], i))
+        for i in range(arg_params['resources']):
+            path = f'res/drawable/image_{i}.png'
+            types['drawable'].append((f'image_{i}', path))
+            zip_out.writestr(zip_entry(arg_prefix + path, False), random_bytes(arg_random, arg_params['resource_size']))
+        file_paths = ar.axml_new()
+        ar.axml_append_element(file_paths, None, 'paths')
+        zip_out.writestr(zip_entry(arg_prefix + 'res/xml/file_paths.xml'), ar.axml_write(file_paths))
+        if arg_with_config:
+            types['xml'].append(('network_security_config', 'res/xml/network_security_config.xml'))
+            zip_out.writestr(zip_entry(arg_prefix + 'res/xml/network_security_config.xml'), build_network_security_config())
+        zip_out.writestr(zip_entry(arg_prefix + 'resources.arsc', False), build_resources(types))
+
+
+
+def write_split(arg_path, arg_name, arg_params, arg_random):
+    # config split with the native library, the split has no code and no xml resources
+    with zipfile.ZipFile(arg_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        zip_out.writestr(zip_entry('AndroidManifest.xml'), build_manifest(arg_name))
+        zip_out.writestr(zip_entry('resources.arsc', False), build_resources({'drawable': [('split_image', 'res/drawable/split_image.png')]}))
+        zip_out.writestr(zip_entry('res/drawable/split_image.png', False), random_bytes(arg_random, 1024))
+        zip_out.writestr(zip_entry(f'lib/{arg_name}/libnative.so'), random_bytes(arg_random, arg_params['split_size'], True))
+
+
+
+def generate_corpus(arg_corpus_dir, arg_params, arg_seed):
+    # the files are generated from the seed, the same parameters always give the same files
+    arg_corpus_dir.mkdir(parents=True, exist_ok=True)
+    corpus = {}
+    for with_config in [False, True]:
+        name = 'app-with-config.apk' if with_config else 'app.apk'
+        write_apk(arg_corpus_dir.joinpath(name), arg_params, random.Random(arg_seed), with_config)
+        corpus[name] = arg_corpus_dir.joinpath(name)
+
+    rand = random.Random(arg_seed)
+    xapk_path = arg_corpus_dir.joinpath('app.xapk')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_apk(Path(temp_dir).joinpath('base.apk'), arg_params, rand, False)
+        split_names = [f'config.split{i}' for i in range(arg_params['splits'])]
+        for split_name in split_names:
+            write_split(Path(temp_dir).joinpath(f'{split_name}.apk'), split_name, arg_params, rand)
+        with zipfile.ZipFile(xapk_path, 'w', zipfile.ZIP_STORED) as zip_out:
+            for apk_name in ['base'] + split_names:
+                zip_out.writestr(zip_entry(f'{apk_name}.apk', False), Path(temp_dir).joinpath(f'{apk_name}.apk').read_bytes())
+            zip_out.writestr(zip_entry('manifest.json'), json.dumps({'package_name': package_name, 'split_apks': [{'file': f'{apk_name}.apk', 'id': apk_name} for apk_name in ['base'] + split_names]}))
+            zip_out.writestr(zip_entry(f'Android/obb/{package_name}/main.1.{package_name}.obb', False), random_bytes(rand, arg_params['obb_size']))
+    corpus['app.xapk'] = xapk_path
+
+    # the base module in the binary format instead of protobuf, it's understood by the stub bundletool only
+    aab_path = arg_corpus_dir.joinpath('bundle.aab')
+    write_apk(aab_path, arg_params, random.Random(arg_seed), False, 'base/')
+    with zipfile.ZipFile(aab_path, 'a') as zip_out:
+        zip_out.writestr(zip_entry('BundleConfig.pb'), b'')
+    corpus['bundle.aab'] = aab_path
+    return corpus
+
+
+
+def prepare_stub_home(arg_home_dir):
+    # the tools directory with the empty jar files, the stub java doesn't read them
+    for variable in ['HOME', 'USERPROFILE', 'APPDATA']:
+        os.environ[variable] = str(arg_home_dir)
+    # the tools directory is found by the script when it's loaded
+    tools_dir = load_script().tools.tools_dir
+    tools_dir.mkdir(parents=True, exist_ok=True)
+    for tool in ar.tools.tools_data:
+        tools_dir.joinpath(tool['file_name'] + tool['version'] + '.jar').touch()
+
+
+
+def run_case(arg_source_path, arg_mode_args, arg_run_dir, arg_env):
+    # running the script as the separate process, the phases are read from --metrics file
+    metrics_path = arg_run_dir.joinpath('metrics.jsonl')
+    command = [sys.executable, str(script_path), str(arg_source_path), '-o', str(arg_run_dir.joinpath('out', arg_source_path.stem)), '--no-cache', '--metrics', str(metrics_path)] + arg_mode_args
+    start_time = time.perf_counter()
+    with open(arg_run_dir.joinpath('log.txt'), 'w') as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=arg_env)
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(process.pid, 0)
+            return_code = os.waitstatus_to_exitcode(status)
+            cpu = rusage.ru_utime + rusage.ru_stime
+            peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            return_code, cpu, peak_rss = process.wait(), None, None
+    wall = time.perf_counter() - start_time
+    if return_code != 0:
+        raise RuntimeError(f'{arg_source_path.name} {" ".join(arg_mode_args)} failed with exit code {return_code}, see {arg_run_dir.joinpath("log.txt")}')
+
+    # the phases with the same name (e.g. for every .apk from .xapk) are summed up
+    phases = {'total': {'wall': wall, 'cpu': cpu, 'peak_rss': peak_rss}}
+    with open(metrics_path, encoding='utf-8') as metrics_file:
+        for line in metrics_file:
+            event = json.loads(line)
+            if event['type'] not in ['phase', 'process']:
+                continue
+            name = event['name'] if event['type'] == 'phase' else f"tool: {event['name']}"
+            phase = phases.setdefault(name, {'wall': 0, 'cpu': None, 'peak_rss': None})
+            phase['wall'] += event['wall']
+            if event.get('cpu') != None:
+                phase['cpu'] = (phase['cpu'] or 0) + event['cpu']
+            if event.get('peak_rss') != None:
+                phase['peak_rss'] = max(phase['peak_rss'] or 0, event['peak_rss'])
+    return phases
+
+
+
+def run_benchmark(arg_args, arg_params):
+    work_dir = Path(tempfile.mkdtemp(prefix='apk-rebuild-benchmark-'))
+    env = dict(os.environ)
+    try:
+        corpus = generate_corpus(Path(arg_args.corpus).resolve() if arg_args.corpus else work_dir.joinpath('corpus'), arg_params, arg_args.seed)
+        if arg_args.tools == 'stub':
+            prepare_stub_home(work_dir.joinpath('home'))
+            env = dict(os.environ)
+            env['PATH'] = str(stub_dir) + os.pathsep + env.get('PATH', '')
+        else:
+            # the synthetic .aab file is not readable by the real bundletool
+            corpus.pop('bundle.aab')
+
+        # AppCDS archives are created by the first runs of the tools, it's done before the measured runs
+        warmup_name = 'bundle.aab' if 'bundle.aab' in corpus else 'app.apk'
+        warmup_dir = work_dir.joinpath('runs', 'warmup')
+        warmup_dir.mkdir(parents=True)
+        run_case(corpus[warmup_name], arg_args.script_args, warmup_dir, env)
+
+        results = {}
+        for source_name, source_path in corpus.items():
+            for mode_name, mode_args in modes.items():
+                case_name = f'{source_name} {mode_name}'
+                runs = []
+                for i in range(arg_args.repeat):
+                    run_dir = work_dir.joinpath('runs', case_name.replace(' ', '_'), str(i))
+                    run_dir.mkdir(parents=True)
+                    runs.append(run_case(source_path, mode_args + arg_args.script_args, run_dir, env))
+                    shutil.rmtree(run_dir.joinpath('out'), ignore_errors=True)
+                input_size = source_path.stat().st_size
+                phases = {}
+                for name in runs[0]:
+                    walls = [run[name]['wall'] for run in runs if name in run]
+                    wall = statistics.median(walls)
+                    cpus = [run[name]['cpu'] for run in runs if name in run and run[name]['cpu'] != None]
+                    rss = [run[name]['peak_rss'] for run in runs if name in run and run[name]['peak_rss']]
+                    phases[name] = {
+                        'wall': round(wall, 4),
+                        'cpu': round(statistics.median(cpus), 4) if cpus else None,
+                        'peak_rss': max(rss) if rss else None,
+                        'throughput': round(input_size / 1024 / 1024 / wall, 2) if wall > 0 else None
+                    }
+                results[case_name] = {'input_size': input_size, 'phases': phases}
+                print(f'{case_name}: {phases["total"]["wall"]:.2f} s', flush=True)
+        return results
+    finally:
+        if arg_args.keep:
+            print(f'Work directory: {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+def print_report(arg_results, arg_comparison):
+    print(f'{"case":<32} {"phase":<28} {"wall, s":>9} {"MB/s":>9} {"cpu, s":>9} {"peak RSS, MB":>13} {"baseline, s":>12} {"status":>10}')
+    for case_name, case in arg_results.items():
+        for name, phase in case['phases'].items():
+            compared = arg_comparison.get((case_name, name), {})
+            baseline_wall = compared.get('baseline_wall')
+            throughput = f'{phase["throughput"]:.1f}' if phase['throughput'] != None else '-'
+            cpu = f'{phase["cpu"]:.3f}' if phase['cpu'] != None else '-'
+            peak_rss = f'{phase["peak_rss"] / 1024 / 1024:.1f}' if phase['peak_rss'] != None else '-'
+            print(f'{case_name:<32} {name:<28} {phase["wall"]:>9.3f} {throughput:>9} {cpu:>9} {peak_rss:>13} {baseline_wall if baseline_wall != None else "-":>12} {compared.get("status", "new"):>10}')
+
+
+
+def compare(arg_results, arg_baseline, arg_args):
+    # the phase regressed if it's slower by the threshold and by the absolute delta (to ignore the noise of the short phases) or takes more memory
+    comparison = {}
+    for case_name, case in arg_results.items():
+        baseline_case = arg_baseline.get('cases', {}).get(case_name, {}).get('phases', {})
+        for name, phase in case['phases'].items():
+            baseline_phase = baseline_case.get(name)
+            if baseline_phase == None:
+                continue
+            status = 'ok'
+            if phase['wall'] > baseline_phase['wall'] * (1 + arg_args.threshold) and phase['wall'] - baseline_phase['wall'] > arg_args.min_delta:
+                status = 'slower'
+            elif phase['peak_rss'] and baseline_phase.get('peak_rss') and phase['peak_rss'] > baseline_phase['peak_rss'] * (1 + arg_args.memory_threshold):
+                status = 'memory'
+            comparison[(case_name, name)] = {'status': status, 'baseline_wall': round(baseline_phase['wall'], 3)}
+    return comparison
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of apk-rebuild.py on the synthetic .apk, .xapk and .aab files.')
+    parser.add_argument('--tools', choices=['stub', 'real'], default='stub', help='run the real apktool, bundletool and uber-apk-signer or the stub toolchain from benchmarks/stub which reproduces their I/O (default: stub)')
+    parser.add_argument('--profile', choices=list(profiles), default='small', help='sizes of the generated files (default: small)')
+    for name, value in profiles['small'].items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=int, help=f'override {name} of the profile (small: {value})')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated files (default: 1)')
+    parser.add_argument('--corpus', help='directory for the generated files (default: temp directory)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every case, the median is reported (default: 3)')
+    parser.add_argument('--baseline', default=str(default_baseline_path), help='baseline .json file (default: benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slowdown of the phase (default: 0.25)')
+    parser.add_argument('--min-delta', type=float, default=0.1, help='slowdown in seconds which is ignored (default: 0.1)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25, help='allowed relative growth of the peak RSS (default: 0.25)')
+    parser.add_argument('--output', help='save the results to .json file')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with the logs and metrics of the runs')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='arguments passed to apk-rebuild.py after --, e.g. -- --jobs 4')
+    args = parser.parse_args()
+    args.script_args = [arg for arg in args.script_args if arg != '--']
+
+    params = dict(profiles[args.profile])
+    for name in params:
+        if getattr(args, name) != None:
+            params[name] = getattr(args, name)
+
+    results = run_benchmark(args, params)
+    info = {'tools': args.tools, 'profile': args.profile, 'params': params, 'script_args': args.script_args, 'python_version': sys.version.split()[0], 'platform': sys.platform, 'tools_versions': {tool['name']: tool['version'] for tool in ar.tools.tools_data}}
+    data = {'info': info, 'cases': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(data, indent=4), encoding='utf-8')
+
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(data, indent=4) + '\n', encoding='utf-8')
+        print_report(results, {})
+        print(f'Baseline saved to {Path(args.baseline).resolve()}')
+        return 0
+
+    try:
+        baseline = json.loads(Path(args.baseline).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        print(f'Baseline {args.baseline} not found, run with --save-baseline first')
+        baseline = {}
+    if baseline and [baseline['info'][key] for key in ['tools', 'params', 'script_args']] != [info[key] for key in ['tools', 'params', 'script_args']]:
+        print('Warning: the baseline was recorded with the other tools, sizes or arguments, the results are not compared')
+        baseline = {}
+    comparison = compare(results, baseline, args)
+    print_report(results, comparison)
+    regressions = [key for key, value in comparison.items() if value['status'] != 'ok']
+    if regressions:
+        print(f'{len(regressions)} regressions: ' + ', '.join(f'{case_name} / {name}' for case_name, name in regressions))
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# check of the built-in signer of apk-rebuild.py: signs the generated .apk files with debug.keystore and verifies them like apksigner does,
+# the ZIP alignment, v1 digests and PKCS#7 signature, v2 and v3 digests of 1 MiB chunks and the signatures against the certificate
+
+import sys, argparse, base64, hashlib, random, struct, tempfile, zipfile
+from pathlib import Path
+
+import benchmark
+from benchmark import ar, zip_entry, build_manifest, build_resources, random_bytes
+
+keystore = [benchmark.script_path.parent.joinpath('debug.keystore'), 'android', 'androiddebugkey', 'android']
+
+# the generated files: minSdkVersion defines the digest of v1 signature (SHA1 before Android 4.3), the entries are bigger than the chunk of v2 digest
+cases = {
+    'sha256.apk': {'min_sdk': 24, 'dex_size': 3 * 1024 * 1024},
+    'sha1.apk': {'min_sdk': 16, 'dex_size': 512 * 1024}
+}
+
+chunk_size = 1024 * 1024
+v2_block_id = 0x7109871a
+v3_block_id = 0xf05368c0
+stripping_protection_attr_id = 0xbeeff00d
+# RSASSA-PKCS1-v1_5 with SHA2-256, the only algorithm of the built-in signer
+rsa_pkcs1_sha256 = 0x0103
+digest_info_prefix = {'sha1': bytes.fromhex('3021300906052b0e03021a05000414'), 'sha256': bytes.fromhex('3031300d060960864801650304020105000420')}
+oid_sha256 = bytes.fromhex('608648016503040201')
+oid_signed_data = bytes.fromhex('2a864886f70d010702')
+oid_message_digest = bytes.fromhex('2a864886f70d010904')
+
+
+
+class verify_error(Exception):
+    pass
+
+
+
+def check(arg_condition, arg_message):
+    if not arg_condition:
+        raise verify_error(arg_message)
+
+
+
+def write_apk(arg_path, arg_params, arg_random):
+    # deflated and stored entries, the native library (aligned by 4096 bytes) and the entry bigger than 1 MiB
+    with zipfile.ZipFile(arg_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        zip_out.writestr(zip_entry('AndroidManifest.xml'), build_manifest(None, arg_params['min_sdk']))
+        zip_out.writestr(zip_entry('classes.dex'), random_bytes(arg_random, arg_params['dex_size'], True))
+        zip_out.writestr(zip_entry('resources.arsc', False), build_resources({'drawable': [('image', 'res/drawable/image.png')]}))
+        zip_out.writestr(zip_entry('res/drawable/image.png', False), random_bytes(arg_random, 4099))
+        zip_out.writestr(zip_entry('lib/arm64-v8a/libnative.so', False), random_bytes(arg_random, 10000))
+        zip_out.writestr(zip_entry('assets/name with spaces and a long path which is wrapped in MANIFEST.MF by seventy bytes.txt'), b'text')
+        # the old signature must be replaced
+        zip_out.writestr(zip_entry('META-INF/OLD.SF'), b'Signature-Version: 1.0\r\n')
+
+
+
+# DER reader independent from the signer: (tag, start of the element, start of the value, end of the element)
+def der_element(arg_data, arg_offset):
+    tag, length = arg_data[arg_offset], arg_data[arg_offset + 1]
+    value_start = arg_offset + 2
+    if length & 0x80:
+        value_start += length & 0x7f
+        length = int.from_bytes(arg_data[arg_offset + 2:value_start], 'big')
+    check(value_start + length <= len(arg_data), 'DER element is out of bounds')
+    return tag, arg_offset, value_start, value_start + length
+
+
+
+def der_items(arg_data, arg_element):
+    items = []
+    offset = arg_element[2]
+    while offset < arg_element[3]:
+        items.append(der_element(arg_data, offset))
+        offset = items[-1][3]
+    return items
+
+
+
+def der_value(arg_data, arg_element):
+    return arg_data[arg_element[2]:arg_element[3]]
+
+
+
+def der_raw(arg_data, arg_element):
+    return arg_data[arg_element[1]:arg_element[3]]
+
+
+
+def read_certificate(arg_cert):
+    # issuer, serial number and RSA public key (modulus, exponent) of X.509 certificate
+    tbs = der_items(arg_cert, der_element(arg_cert, 0))[0]
+    fields = der_items(arg_cert, tbs)
+    if fields[0][0] == 0xa0:
+        fields = fields[1:]
+    serial, _, issuer, _, _, public_key_info = fields[:6]
+    return {'serial': der_raw(arg_cert, serial), 'issuer': der_raw(arg_cert, issuer), 'public_key_info': der_raw(arg_cert, public_key_info)}
+
+
+
+def read_public_key(arg_public_key_info):
+    bit_string = der_items(arg_public_key_info, der_element(arg_public_key_info, 0))[1]
+    rsa_key = der_value(arg_public_key_info, bit_string)[1:]
+    modulus, exponent = der_items(rsa_key, der_element(rsa_key, 0))
+    return int.from_bytes(der_value(rsa_key, modulus), 'big'), int.from_bytes(der_value(rsa_key, exponent), 'big')
+
+
+
+def rsa_verify(arg_public_key_info, arg_signature, arg_data, arg_hash_name):
+    # RSA PKCS#1 v1.5: the decrypted signature must be the padded DigestInfo of the data
+    modulus, exponent = read_public_key(arg_public_key_info)
+    key_size = (modulus.bit_length() + 7) // 8
+    check(len(arg_signature) == key_size, 'wrong size of RSA signature')
+    digest_info = digest_info_prefix[arg_hash_name] + hashlib.new(arg_hash_name, arg_data).digest()
+    expected = b'\x00\x01' + b'\xff' * (key_size - len(digest_info) - 3) + b'\x00' + digest_info
+    check(pow(int.from_bytes(arg_signature, 'big'), exponent, modulus).to_bytes(key_size, 'big') == expected, 'RSA signature does not match the certificate')
+
+
+
+def verify_zip(arg_data, arg_zip_ref):
+    # all entries are readable with the correct CRC, the data of the stored entries is aligned like zipalign does
+    check(arg_zip_ref.testzip() == None, 'broken entry')
+    for info in arg_zip_ref.infolist():
+        if info.compress_type != zipfile.ZIP_STORED:
+            continue
+        name_size, extra_size = struct.unpack_from('<HH', arg_data, info.header_offset + 26)
+        data_offset = info.header_offset + 30 + name_size + extra_size
+        alignment = 4096 if info.filename.endswith('.so') else 4
+        check(data_offset % alignment == 0, f'{info.filename} is not aligned by {alignment} bytes')
+
+
+
+def parse_manifest(arg_data):
+    # main section and the named sections with their raw bytes, continuation lines start with the space
+    sections = []
+    for raw_section in arg_data.split(b'\r\n\r\n'):
+        if not raw_section:
+            continue
+        lines = []
+        for line in raw_section.split(b'\r\n'):
+            if line.startswith(b' '):
+                lines[-1] += line[1:]
+            else:
+                lines.append(line)
+        attrs = dict(line.decode('utf-8').split(': ', 1) for line in lines)
+        sections.append((attrs, raw_section + b'\r\n\r\n'))
+    return sections[0][0], {attrs['Name']: (attrs, raw) for attrs, raw in sections[1:]}
+
+
+
+def verify_v1(arg_zip_ref):
+    names = arg_zip_ref.namelist()
+    check(not [name for name in names if name.startswith('META-INF/OLD.')], 'the old signature is not removed')
+    signature_block_names = [name for name in names if name.startswith('META-INF/') and name.endswith('.RSA')]
+    check(len(signature_block_names) == 1, 'v1 signature block not found')
+    signer_name = signature_block_names[0][:-len('.RSA')]
+    manifest = arg_zip_ref.read('META-INF/MANIFEST.MF')
+    signature_file = arg_zip_ref.read(signer_name + '.SF')
+    _, manifest_sections = parse_manifest(manifest)
+    sf_main, sf_sections = parse_manifest(signature_file)
+    hash_name = 'sha256' if any(name.startswith('SHA-256') for name in sf_main) else 'sha1'
+    digest_name = 'SHA-256' if hash_name == 'sha256' else 'SHA1'
+
+    def digest(arg_value):
+        return base64.b64encode(hashlib.new(hash_name, arg_value).digest()).decode('ascii')
+
+    # MANIFEST.MF covers every entry except the signature files
+    entries = [name for name in names if not name.endswith('/') and not (name.startswith('META-INF/') and name.count('/') == 1 and name.split('.')[-1] in ['MF', 'SF', 'RSA', 'DSA', 'EC'])]
+    check(sorted(entries) == sorted(manifest_sections), 'MANIFEST.MF does not list all the entries')
+    for name in entries:
+        check(manifest_sections[name][0].get(f'{digest_name}-Digest') == digest(arg_zip_ref.read(name)), f'digest of {name} in MANIFEST.MF does not match')
+    # CERT.SF: the digest of the whole manifest and of every section
+    check(sf_main.get(f'{digest_name}-Digest-Manifest') == digest(manifest), 'digest of MANIFEST.MF in the signature file does not match')
+    check('2' in sf_main.get('X-Android-APK-Signed', '').replace(' ', '').split(','), 'X-Android-APK-Signed does not protect v2 signature')
+    check(sorted(sf_sections) == sorted(manifest_sections), 'the signature file does not list all the sections of MANIFEST.MF')
+    for name, (attrs, _) in sf_sections.items():
+        check(attrs.get(f'{digest_name}-Digest') == digest(manifest_sections[name][1]), f'digest of the section {name} does not match')
+
+    # PKCS#7 SignedData: the certificate of the signer and the signature of CERT.SF
+    block = arg_zip_ref.read(signer_name + '.RSA')
+    content_type, content = der_items(block, der_element(block, 0))
+    check(der_value(block, content_type) == oid_signed_data, 'not PKCS#7 SignedData')
+    signed_data = der_items(block, der_items(block, content)[0])
+    certs = [der_raw(block, cert) for cert in der_items(block, [item for item in signed_data if item[0] == 0xa0][0])]
+    signer_info = der_items(block, der_items(block, signed_data[-1])[0])
+    issuer_and_serial = der_items(block, signer_info[1])
+    cert = read_certificate(certs[0])
+    check(der_raw(block, issuer_and_serial[0]) == cert['issuer'] and der_raw(block, issuer_and_serial[1]) == cert['serial'], 'the signer is not the first certificate')
+    signer_hash = 'sha256' if der_value(block, der_items(block, signer_info[2])[0]) == oid_sha256 else 'sha1'
+    signature = der_value(block, signer_info[-1])
+    if signer_info[3][0] == 0xa0:
+        # the signed attributes are signed instead of the content, the message digest attribute must match the content
+        attributes = der_raw(block, signer_info[3])
+        message_digest = [der_items(block, der_items(block, attribute)[1])[0] for attribute in der_items(block, signer_info[3]) if der_value(block, der_items(block, attribute)[0]) == oid_message_digest]
+        check(message_digest and der_value(block, message_digest[0]) == hashlib.new(signer_hash, signature_file).digest(), 'message digest of the signed attributes does not match')
+        rsa_verify(cert['public_key_info'], signature, b'\x31' + attributes[1:], signer_hash)
+    else:
+        rsa_verify(cert['public_key_info'], signature, signature_file, signer_hash)
+    return hash_name, certs[0]
+
+
+
+def read_length_prefixed(arg_data, arg_offset):
+    # the value prefixed by uint32 length and the offset after it
+    size = struct.unpack_from('<I', arg_data, arg_offset)[0]
+    check(arg_offset + 4 + size <= len(arg_data), 'length-prefixed value is out of bounds')
+    return arg_data[arg_offset + 4:arg_offset + 4 + size], arg_offset + 4 + size
+
+
+
+def length_prefixed_items(arg_data):
+    items = []
+    offset = 0
+    while offset < len(arg_data):
+        item, offset = read_length_prefixed(arg_data, offset)
+        items.append(item)
+    return items
+
+
+
+def algorithm_items(arg_data):
+    # sequence of (algorithm id, length-prefixed value) of the digests and the signatures
+    items = []
+    for item in length_prefixed_items(arg_data):
+        items.append((struct.unpack_from('<I', item, 0)[0], read_length_prefixed(item, 4)[0]))
+    return items
+
+
+
+def content_digest(arg_data, arg_block_start, arg_central_directory_offset, arg_eocd_offset):
+    # SHA-256 of 1 MiB chunks of the entries, the central directory and EOCD with the offset of the signing block instead of the central directory
+    eocd = bytearray(arg_data[arg_eocd_offset:])
+    struct.pack_into('<I', eocd, 16, arg_block_start)
+    chunk_digests = []
+    for section in [arg_data[:arg_block_start], arg_data[arg_central_directory_offset:arg_eocd_offset], bytes(eocd)]:
+        for offset in range(0, len(section), chunk_size):
+            chunk = section[offset:offset + chunk_size]
+            chunk_digests.append(hashlib.sha256(b'\xa5' + struct.pack('<I', len(chunk)) + chunk).digest())
+    return hashlib.sha256(b'\x5a' + struct.pack('<I', len(chunk_digests)) + b''.join(chunk_digests)).digest()
+
+
+
+def verify_v2_v3(arg_data):
+    eocd_offset = arg_data.rfind(b'PK\x05\x06')
+    check(eocd_offset >= 0 and len(arg_data) - eocd_offset == 22, 'EOCD not found')
+    central_directory_offset = struct.unpack_from('<I', arg_data, eocd_offset + 16)[0]
+    check(arg_data[central_directory_offset - 16:central_directory_offset] == b'APK Sig Block 42', 'APK signing block not found')
+    block_size = struct.unpack_from('<Q', arg_data, central_directory_offset - 24)[0]
+    block_start = central_directory_offset - block_size - 8
+    check(struct.unpack_from('<Q', arg_data, block_start)[0] == block_size, 'sizes of APK signing block do not match')
+    blocks = {}
+    offset = block_start + 8
+    while offset < central_directory_offset - 24:
+        pair_size, block_id = struct.unpack_from('<QI', arg_data, offset)
+        blocks[block_id] = arg_data[offset + 12:offset + 8 + pair_size]
+        offset += 8 + pair_size
+    check(offset == central_directory_offset - 24, 'broken pairs of APK signing block')
+
+    expected_digest = content_digest(arg_data, block_start, central_directory_offset, eocd_offset)
+    certs = {}
+    for block_id, name in [(v2_block_id, 'v2'), (v3_block_id, 'v3')]:
+        check(block_id in blocks, f'{name} signature not found')
+        signers = length_prefixed_items(read_length_prefixed(blocks[block_id], 0)[0])
+        check(len(signers) == 1, f'{name} signature must have one signer')
+        # signer: signed data, (v3: SDK range), signatures, public key
+        signed_data, offset = read_length_prefixed(signers[0], 0)
+        if name == 'v3':
+            sdk_range = struct.unpack_from('<II', signers[0], offset)
+            offset += 8
+        signatures, offset = read_length_prefixed(signers[0], offset)
+        public_key_info, offset = read_length_prefixed(signers[0], offset)
+        # signed data: digests, certificates, (v3: SDK range), attributes
+        digests, offset = read_length_prefixed(signed_data, 0)
+        certificates, offset = read_length_prefixed(signed_data, offset)
+        if name == 'v3':
+            check(struct.unpack_from('<II', signed_data, offset) == sdk_range, 'SDK range of v3 signer does not match the signed data')
+            offset += 8
+        attributes, offset = read_length_prefixed(signed_data, offset)
+
+        certificates = length_prefixed_items(certificates)
+        check(certificates and read_certificate(certificates[0])['public_key_info'] == public_key_info, f'public key of {name} signer does not match its certificate')
+        signature_items = algorithm_items(signatures)
+        digest_items = algorithm_items(digests)
+        check(signature_items and [algorithm for algorithm, _ in signature_items] == [algorithm for algorithm, _ in digest_items], f'algorithms of {name} signatures and digests do not match')
+        for (algorithm, signature), (_, digest) in zip(signature_items, digest_items):
+            check(algorithm == rsa_pkcs1_sha256, f'unexpected {name} signature algorithm {algorithm:#x}')
+            rsa_verify(public_key_info, signature, signed_data, 'sha256')
+            check(digest == expected_digest, f'{name} content digest does not match')
+        if name == 'v2':
+            check(stripping_protection_attr_id in [attr_id for attr_id, _ in [(struct.unpack_from('<I', item, 0)[0], item[4:]) for item in length_prefixed_items(attributes)]], 'v2 signature does not protect v3 signature from stripping')
+        certs[name] = certificates[0]
+    return certs
+
+
+
+def verify_apk(arg_path):
+    # returns the hash of v1 signature, raises verify_error if any check fails
+    data = Path(arg_path).read_bytes()
+    with zipfile.ZipFile(arg_path, 'r') as zip_ref:
+        verify_zip(data, zip_ref)
+        hash_name, v1_cert = verify_v1(zip_ref)
+    certs = verify_v2_v3(data)
+    check(v1_cert == certs['v2'] == certs['v3'], 'v1, v2 and v3 signatures have different certificates')
+    return hash_name
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check of the built-in signer of apk-rebuild.py on the generated .apk files.')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated files (default: 1)')
+    parser.add_argument('--keep', help='directory for the generated and signed files, they are removed by default')
+    parser.add_argument('apk', nargs='*', help='verify these signed .apk files instead of generating and signing the files')
+    args = parser.parse_args()
+
+    failed = 0
+    if args.apk:
+        paths = [Path(path) for path in args.apk]
+    else:
+        work_dir = Path(args.keep or tempfile.mkdtemp(prefix='verify-signer-'))
+        work_dir.mkdir(parents=True, exist_ok=True)
+        ar.signing.keystore = keystore
+        paths = []
+        for name, params in cases.items():
+            path = work_dir.joinpath(name)
+            write_apk(path, params, random.Random(args.seed))
+            ar.sign_apk_native(ar.job(argparse.Namespace(), path), path)
+            paths.append(path)
+    for path in paths:
+        try:
+            hash_name = verify_apk(path)
+            print(f'{path.name}: ok (v1 {hash_name}, v2, v3)')
+        except (verify_error, struct.error, IndexError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            print(f'{path.name}: FAILED: {e}')
+            failed += 1
+    if not args.apk and not args.keep:
+        for path in paths:
+            path.unlink()
+        paths[0].parent.rmdir()
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())